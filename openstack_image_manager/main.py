@@ -1,21 +1,35 @@
 # SPDX-License-Identifier: Apache-2.0
 
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import threading
 import time
 import openstack
 import requests
 import shutil
 import subprocess
 import tempfile
+import itertools
+import json
 import yaml
 import os
 import re
+import secrets
+import socket
+import stat
 import sys
 import typer
 import typing
 from typing import Dict, Set
+from collections.abc import Mapping
 import yamale
 import urllib.parse
 import pkgutil
+import queue
+import random
+import statistics
 
 from datetime import datetime, date
 from decimal import Decimal, ROUND_UP
@@ -29,12 +43,79 @@ from openstack.image.v2.image import Image
 # timeout in seconds for HTTP requests fetching checksum files
 REQUESTS_TIMEOUT = 30
 
+# retries of upstream requests answered with one of these status codes
+UPSTREAM_RETRY_STATUS = (429, 500, 502, 503, 504)
+UPSTREAM_RETRIES = 3
+# upper bound in seconds of a Retry-After honoured by an upstream retry
+UPSTREAM_RETRY_AFTER_MAX = 60.0
+
+# concurrent URL probes of the preflight, in total and per host
+PREFLIGHT_WORKERS = 16
+PREFLIGHT_HOST_CONNECTIONS = 4
+
 # maps digest algorithm names to the dashed form aria2c's --checksum expects
 _ARIA2_ALGO = {"md5": "md5", "sha1": "sha-1", "sha256": "sha-256", "sha512": "sha-512"}
 
+# hex digest lengths of the algorithms above
+_DIGEST_ALGO = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+_DIGEST_RE = re.compile(
+    r"[0-9a-fA-F]{32}|[0-9a-fA-F]{40}|[0-9a-fA-F]{64}|[0-9a-fA-F]{128}"
+)
+# "SHA256 (name) = <hex>" as written by BSD tools and `sha256sum --tag`
+_BSD_CHECKSUM_RE = re.compile(r"(\w+) \((.+)\) = ([0-9a-fA-F]+)")
+
 
 PREFETCH_CHOICES = ("never", "on-stuck", "always")
 
+# bounds in seconds of the adaptive status polling of importing images
+POLL_MIN_INTERVAL = 2.0
+POLL_MAX_INTERVAL = 60.0
+
+
+# bounds of the aria2 segmentation of a prefetch download
+DOWNLOAD_MAX_SPLIT = 16
+DOWNLOAD_MIN_SPLIT_SIZE = 20 * 2**20
+DOWNLOAD_MAX_SPLIT_SIZE = 1024 * 2**20
+
+
+def download_tuning(
+    size: typing.Optional[int], throughput: typing.Optional[float]
+) -> typing.Tuple[int, int, int]:
+    """
+    Segmentation of an aria2 download as (split, connections, min_split_size)
+
+    Images are split into at most DOWNLOAD_MAX_SPLIT segments of at least
+    20 MiB, so a small image is fetched with a single connection. The
+    connections per server follow the host's observed throughput per
+    connection (bytes per second): fast hosts (CDNs) get up to 16, unknown
+    hosts 4 and slow mirrors 2.
+    """
+    if throughput is None:
+        connections = 4
+    elif throughput >= 8 * 2**20:
+        connections = DOWNLOAD_MAX_SPLIT
+    elif throughput >= 2**20:
+        connections = 4
+    else:
+        connections = 2
+    if not size:
+        return min(4, connections), min(4, connections), DOWNLOAD_MIN_SPLIT_SIZE
+    min_split_size = -(-size // DOWNLOAD_MAX_SPLIT // 2**20) * 2**20
+    min_split_size = max(DOWNLOAD_MIN_SPLIT_SIZE, min_split_size)
+    min_split_size = min(DOWNLOAD_MAX_SPLIT_SIZE, min_split_size)
+    split = max(1, min(DOWNLOAD_MAX_SPLIT, size // min_split_size))
+    return split, min(connections, split), min_split_size
+
+
+# image property holding the fingerprint of the desired state it was set to
+FINGERPRINT_PROPERTY = "image_manager_fingerprint"
+
+
+def desired_state_fingerprint(state: dict) -> str:
+    """Compact hash of the desired state of an image, see set_properties()"""
+    encoded = json.dumps(state, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
 
 def _validate_prefetch(value: str) -> str:
     """Reject --prefetch values outside the allowed set."""
@@ -43,30 +124,1659 @@ def _validate_prefetch(value: str) -> str:
     return value
 
 
-def checksum_to_aria2(checksum: typing.Optional[str]) -> typing.Optional[str]:
-    """Convert a 'sha256:<hex>' or bare '<hex>' digest to aria2's '<algo>=<hex>'."""
+def parse_checksum(
+    checksum: typing.Optional[str],
+) -> typing.Optional[typing.Tuple[str, str]]:
+    """Split a 'sha256:<hex>' or bare sha256 '<hex>' digest into (algo, hex)."""
     if not checksum:
         return None
     if ":" in checksum:
         algo, _, digest = checksum.partition(":")
-        aria2_algo = _ARIA2_ALGO.get(algo.lower())
-        if not aria2_algo or not digest:
+        if algo.lower() not in _ARIA2_ALGO or not digest:
             return None
-        return f"{aria2_algo}={digest}"
+        return algo.lower(), digest
     if len(checksum) == 64 and re.fullmatch(r"[0-9a-fA-F]+", checksum):
-        return f"sha-256={checksum}"
+        return "sha256", checksum
     return None
 
 
+def parse_checksums_file(text: str) -> Dict[str, typing.Tuple[str, str]]:
+    """
+    Index a checksums file by filename, as {filename: (algo, hex)}
+
+    Understands GNU ("<hex>  name", "<hex> *name", also separated by tabs)
+    and BSD ("SHA256 (name) = <hex>") lines and skips everything else, e.g. the
+    PGP armor of signed files. Files listed with a directory can also be
+    looked up by their basename.
+    """
+    index: Dict[str, typing.Tuple[str, str]] = {}
+    basenames: Dict[str, typing.Tuple[str, str]] = {}
+    for line in text.splitlines():
+        line = line.strip()
+        bsd = _BSD_CHECKSUM_RE.fullmatch(line)
+        if bsd:
+            tag, name, digest = bsd.groups()
+        else:
+            digest, name = (line.split(maxsplit=1) + [""])[:2]
+            tag = ""
+            if name.startswith("*"):
+                name = name[1:]
+        if not name or not _DIGEST_RE.fullmatch(digest):
+            continue
+        algo = tag.lower().replace("-", "") or _DIGEST_ALGO[len(digest)]
+        index[name] = (algo, digest)
+        basenames.setdefault(name.rsplit("/", 1)[-1], (algo, digest))
+    return {**basenames, **index}
+
+
+def checksum_to_aria2(checksum: typing.Optional[str]) -> typing.Optional[str]:
+    """Convert a 'sha256:<hex>' or bare '<hex>' digest to aria2's '<algo>=<hex>'."""
+    parsed = parse_checksum(checksum)
+    if parsed is None:
+        return None
+    return f"{_ARIA2_ALGO[parsed[0]]}={parsed[1]}"
+
+
+class _UpstreamRetry(requests.adapters.Retry):
+    """Retry policy honouring Retry-After, but never waiting for too long"""
+
+    def get_retry_after(self, response) -> typing.Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, UPSTREAM_RETRY_AFTER_MAX)
+
+
+def upstream_session() -> requests.Session:
+    """
+    HTTP session for upstream probes, checksum files and downloads
+
+    Keeps alive a pool of connections per host and retries idempotent
+    requests with exponential backoff on connection errors and on 429 and
+    5xx responses, honouring Retry-After. Callers pass REQUESTS_TIMEOUT.
+    """
+    retry = _UpstreamRetry(
+        total=UPSTREAM_RETRIES,
+        backoff_factor=1.0,
+        status_forcelist=UPSTREAM_RETRY_STATUS,
+        allowed_methods=frozenset(["HEAD", "GET"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=DOWNLOAD_MAX_SPLIT,
+        pool_maxsize=DOWNLOAD_MAX_SPLIT,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class _HashingStream:
+    """Chunks of a streamed HTTP response, hashed and counted on the fly"""
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, response: requests.Response, algo: typing.Optional[str]) -> None:
+        self._response = response
+        self.hash = hashlib.new(algo) if algo else None
+        self.size = 0
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        for chunk in self._response.iter_content(chunk_size=self.CHUNK_SIZE):
+            if self.hash is not None:
+                self.hash.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+
+class UpstreamMemo:
+    """
+    Results of upstream lookups (HEAD probes, checksum files) by key
+
+    Filled by the preflight and shared by the ImageManagers of a multi-cloud
+    run, so every URL is looked up once. Concurrent callers asking for the
+    same key wait for the first caller's lookup instead of repeating it.
+    """
+
+    def __init__(self) -> None:
+        self._results: Dict[tuple, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, lookup: typing.Callable[[], typing.Any]) -> typing.Any:
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if future is None:
+                future = self._results[key] = concurrent.futures.Future()
+        if owner:
+            try:
+                future.set_result(lookup())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+
+class UrlMetadata:
+    """
+    What a HEAD probe revealed about an upstream URL
+
+    status is the status of the first response, i.e. 302 for a redirect,
+    final_status, size, last_modified and etag belong to the response at
+    final_url after following the redirects.
+    """
+
+    FIELDS = (
+        "url",
+        "final_url",
+        "status",
+        "final_status",
+        "size",
+        "last_modified",
+        "etag",
+        "accept_ranges",
+        "fetched_at",
+    )
+
+    def __init__(
+        self,
+        url: str,
+        final_url: str,
+        status: int,
+        final_status: int,
+        size: typing.Optional[int] = None,
+        last_modified: typing.Optional[str] = None,
+        etag: typing.Optional[str] = None,
+        accept_ranges: typing.Optional[str] = None,
+        fetched_at: typing.Optional[float] = None,
+    ) -> None:
+        self.url = url
+        self.final_url = final_url
+        self.status = status
+        self.final_status = final_status
+        self.size = size
+        self.last_modified = last_modified
+        self.etag = etag
+        self.accept_ranges = accept_ranges
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    @classmethod
+    def from_response(cls, url: str, response: requests.Response) -> "UrlMetadata":
+        length = response.headers.get("Content-Length", "")
+        return cls(
+            url,
+            response.url or url,
+            (
+                response.history[0].status_code
+                if response.history
+                else response.status_code
+            ),
+            response.status_code,
+            int(length) if length.isdigit() else None,
+            response.headers.get("Last-Modified"),
+            response.headers.get("ETag"),
+            response.headers.get("Accept-Ranges"),
+        )
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+
+class UrlMetadataCache:
+    """
+    UrlMetadata of upstream URLs, kept across runs in a JSON file
+
+    Entries younger than ttl seconds are used without a request, older ones
+    are revalidated with a conditional request (If-None-Match or
+    If-Modified-Since).
+    """
+
+    def __init__(self, path: typing.Optional[str] = None, ttl: float = 0) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._entries: Dict[str, UrlMetadata] = {}
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as fp:
+                    self._entries = {x["url"]: UrlMetadata(**x) for x in json.load(fp)}
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable URL metadata {path}: {e}")
+
+    def get(self, url: str) -> typing.Optional[UrlMetadata]:
+        with self._lock:
+            return self._entries.get(url)
+
+    def fresh(self, url: str) -> typing.Optional[UrlMetadata]:
+        """The entry of url when it is younger than the ttl and no error"""
+        entry = self.get(url)
+        if entry is None or entry.final_status >= 400:
+            return None
+        return entry if time.time() - entry.fetched_at < self.ttl else None
+
+    def put(self, metadata: UrlMetadata) -> None:
+        with self._lock:
+            self._entries[metadata.url] = metadata
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            entries = [x.to_dict() for x in self._entries.values()]
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as fp:
+                json.dump(entries, fp)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            logger.warning(f"Could not write URL metadata {self.path}: {e}")
+
+
+class ChecksumFileCache:
+    """
+    Parsed checksum files with their validators, kept across runs in a JSON file
+
+    An entry is {"etag", "last_modified", "result"}, where result is what the
+    checksum file was parsed into. Later runs send a conditional request and
+    reuse the result when upstream answers 304 Not Modified.
+    """
+
+    def __init__(self, path: typing.Optional[str] = None) -> None:
+        self.path = path
+        self._entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as fp:
+                    self._entries = json.load(fp)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable checksum files {path}: {e}")
+
+    def get(self, url: str) -> typing.Optional[dict]:
+        with self._lock:
+            return self._entries.get(url)
+
+    def put(self, url: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[url] = entry
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as fp:
+                json.dump(entries, fp)
+            os.replace(f"{self.path}.tmp", self.path)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Could not write checksum files {self.path}: {e}")
+
+
+def _apply_image_attrs(image: Image, attrs: dict) -> None:
+    """Apply Glance attribute changes to a locally held Image.
+
+    Well-known attributes are set under their SDK name (e.g. os_hidden on
+    is_hidden), everything else is a custom property.
+    """
+    body_mapping = Image._body_mapping()
+    for key, value in attrs.items():
+        if key in body_mapping:
+            setattr(image, body_mapping[key], value)
+        else:
+            if image.properties is None:
+                image.properties = {}
+            image.properties[key] = value
+
+
+def _image_property(image: Image, key: str) -> typing.Optional[str]:
+    """Return a custom property of an image or None when it is not set"""
+    return (image.properties or {}).get(key)
+
+
+def _import_stores(image: Image, key: str) -> str:
+    """
+    Comma-separated stores of a multi-store import, "" when there are none
+
+    key is stores for the stores holding the image data,
+    os_glance_importing_to_stores for the stores still in progress or
+    os_glance_failed_import for the stores whose import failed.
+    """
+    stores = _image_property(image, key)
+    return stores if isinstance(stores, str) else ""
+
+
+class ImageCatalog(Mapping):
+    """Managed Glance images keyed by name, with secondary indexes.
+
+    Besides the name, images are indexed by id, by their image_description
+    group (kept naturally sorted), by the internal_version and
+    upstream_checksum properties and by os_hash_value. Indexes are
+    maintained on put()/discard()/update(), so lookups never rescan the
+    catalog. All methods are safe to use from several threads.
+    """
+
+    INDEXED_PROPERTIES = ("internal_version", "upstream_checksum")
+
+    def __init__(self, images: typing.Iterable[Image] = ()) -> None:
+        self._by_name: Dict[str, Image] = {}
+        self._by_id: Dict[str, Image] = {}
+        self._groups: Dict[str, Set[str]] = {}
+        self._sorted_groups: Dict[str, typing.List[str]] = {}
+        self._indexes: Dict[str, Dict[str, Set[str]]] = {
+            key: {} for key in self.INDEXED_PROPERTIES + ("os_hash_value",)
+        }
+        self._searches: Dict[str, Set[str]] = {}
+        self._lock = threading.RLock()
+        for image in images:
+            self.put(image)
+
+    def __getitem__(self, name: str) -> Image:
+        return self._by_name[name]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        with self._lock:
+            return iter(list(self._by_name))
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def _index_values(self, image: Image) -> typing.Iterator[tuple]:
+        for key in self.INDEXED_PROPERTIES:
+            yield key, _image_property(image, key)
+        yield "os_hash_value", image.hash_value
+
+    def put(self, image: Image) -> None:
+        """Add an image, replacing an entry with the same id or name"""
+        with self._lock:
+            self.discard(image.id)
+            if image.name in self._by_name:
+                self.discard(self._by_name[image.name].id)
+
+            self._by_name[image.name] = image
+            self._by_id[image.id] = image
+            description = _image_property(image, "image_description")
+            if description is not None:
+                self._groups.setdefault(description, set()).add(image.name)
+                self._sorted_groups.pop(description, None)
+            for key, value in self._index_values(image):
+                if value is not None:
+                    self._indexes[key].setdefault(value, set()).add(image.id)
+            self._searches.clear()
+
+    def discard(self, image_id: str) -> typing.Optional[Image]:
+        """Remove an image by id and return it, if it is in the catalog"""
+        with self._lock:
+            image = self._by_id.pop(image_id, None)
+            if image is None:
+                return None
+
+            del self._by_name[image.name]
+            description = _image_property(image, "image_description")
+            if description is not None:
+                self._groups[description].discard(image.name)
+                if not self._groups[description]:
+                    del self._groups[description]
+                self._sorted_groups.pop(description, None)
+            for key, value in self._index_values(image):
+                if value is not None:
+                    self._indexes[key][value].discard(image.id)
+            self._searches.clear()
+            return image
+
+    def update(self, image_id: str, attrs: dict) -> None:
+        """Apply attribute changes to an image and reindex it"""
+        with self._lock:
+            image = self.discard(image_id)
+            if image is not None:
+                _apply_image_attrs(image, attrs)
+                self.put(image)
+
+    def get_by_id(self, image_id: str) -> typing.Optional[Image]:
+        return self._by_id.get(image_id)
+
+    def group(self, description: str) -> typing.List[str]:
+        """Names of all images with the given image_description, naturally sorted"""
+        with self._lock:
+            if description not in self._sorted_groups:
+                self._sorted_groups[description] = natsorted(
+                    self._groups.get(description, ())
+                )
+            return self._sorted_groups[description]
+
+    def groups(self) -> Dict[str, typing.List[str]]:
+        """All image_description groups with their naturally sorted image names"""
+        with self._lock:
+            return {x: self.group(x) for x in self._groups}
+
+    def find(self, key: str, value: str) -> typing.List[Image]:
+        """Images whose indexed property (or os_hash_value) equals value"""
+        with self._lock:
+            return [self._by_id[x] for x in self._indexes[key].get(value, ())]
+
+    def search(self, pattern: str) -> Set[str]:
+        """Names matching the regex pattern, memoized until the catalog changes"""
+        with self._lock:
+            if pattern not in self._searches:
+                self._searches[pattern] = {
+                    name for name in self._by_name if re.search(pattern, name)
+                }
+            return self._searches[pattern]
+
+
+def import_poll_interval(elapsed: float, predicted: typing.Optional[float]) -> float:
+    """
+    Seconds until the next status check of an importing image
+
+    Without a predicted import duration the fixed 10 s interval is used.
+    Otherwise the image is checked rarely at first, densely around the
+    predicted completion time and again less often once the import takes
+    longer than predicted. A jitter of +-20% spreads the checks of
+    concurrent imports.
+    """
+    if predicted is None:
+        return 10.0
+    remaining = predicted - elapsed
+    if remaining > POLL_MIN_INTERVAL:
+        interval = remaining / 2
+    else:
+        interval = POLL_MIN_INTERVAL + (elapsed - predicted) / 4
+    interval = min(max(interval, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+    return interval * random.uniform(0.8, 1.2)
+
+
+class ImportHistory:
+    """
+    Observed import throughput per import method
+
+    Keeps the last samples (bytes per second) of each method ("web-download",
+    "glance-direct", "prefetch") and predicts the duration of an import from
+    the image size and the median throughput. With a path, the samples are
+    loaded from and saved to a JSON file, so predictions improve across runs.
+    """
+
+    MAX_SAMPLES = 20
+    KIND = "import history"
+
+    def __init__(self, path: typing.Optional[str] = None) -> None:
+        self.path = path
+        self._samples: Dict[str, typing.List[float]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as fp:
+                    self._samples = json.load(fp)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable {self.KIND} {path}: {e}")
+
+    def record(self, method: str, size: int, duration: float) -> None:
+        if size <= 0 or duration <= 0:
+            return
+        with self._lock:
+            samples = self._samples.setdefault(method, [])
+            samples.append(size / duration)
+            del samples[: -self.MAX_SAMPLES]
+
+    def predict(
+        self, method: typing.Optional[str], size: typing.Optional[int]
+    ) -> typing.Optional[float]:
+        """Predicted import duration in seconds, None without size or history"""
+        with self._lock:
+            samples = self._samples.get(method or "")
+            if not size or not samples:
+                return None
+            return size / statistics.median(samples)
+
+    def throughput(self, method: str) -> typing.Optional[float]:
+        """Median throughput in bytes per second, None without history"""
+        with self._lock:
+            samples = self._samples.get(method)
+            return statistics.median(samples) if samples else None
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(f"{self.path}.tmp", "w") as fp:
+                    json.dump(self._samples, fp)
+                os.replace(f"{self.path}.tmp", self.path)
+            except OSError as e:
+                logger.warning(f"Could not write {self.KIND} {self.path}: {e}")
+
+
+class DownloadHistory(ImportHistory):
+    """
+    Observed download throughput per upstream host
+
+    Keeps the last samples (bytes per second and connection) of each host
+    the images are downloaded from, which size the connections of the next
+    downloads from that host (download_tuning).
+    """
+
+    KIND = "download history"
+
+
+class _ImportWatch:
+    """State of one import tracked by the ImportWatcher"""
+
+    def __init__(
+        self,
+        image: Image,
+        deadline: float,
+        predicted: typing.Optional[float],
+        stores: typing.Optional[typing.List[str]] = None,
+    ) -> None:
+        self.image = image
+        self.deadline = deadline
+        self.predicted = predicted
+        # the target stores of a copy-image import
+        self.stores = stores
+        self.started = time.monotonic()
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.next_poll = 0.0
+        self.retry_attempts_for_queued_state = 4
+        self.consecutive_errors = 0
+
+
+class ImportWatcher:
+    """
+    Wait for many imports at once with one background poller
+
+    Instead of one get_image() loop per image, every tick fetches the status
+    of all imports that are due for a check with a batched listing
+    (id=in:<id>,<id>,...) and resolves their futures. The deadline,
+    stuck-in-queued and consecutive-error handling match
+    ImageManager.wait_for_image().
+    """
+
+    TICK = 1.0
+    QUEUED_INTERVAL = 2.0
+    # keeps the id=in: query string well below common URL length limits
+    BATCH_SIZE = 50
+
+    def __init__(self, image_proxy: ImageProxy) -> None:
+        self.image_proxy = image_proxy
+        self._watches: Dict[str, _ImportWatch] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="import-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def watch(
+        self,
+        image: Image,
+        deadline: float,
+        predicted: typing.Optional[float] = None,
+        stores: typing.Optional[typing.List[str]] = None,
+    ) -> concurrent.futures.Future:
+        """Track an import; the future resolves to the active Image or None
+
+        predicted is the expected import duration in seconds, which spaces
+        the status checks of the importing image (see import_poll_interval()).
+        For a copy-image import, stores are its target stores: the image is
+        active all along, so the copy is done once each of them holds the
+        image or is listed in os_glance_failed_import. An image that is
+        watched already keeps its watch and all callers share its future.
+        """
+        with self._lock:
+            watch = self._watches.get(image.id)
+            if watch is None:
+                watch = _ImportWatch(image, deadline, predicted, stores)
+                self._watches[image.id] = watch
+        return watch.future
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.TICK):
+            self.tick()
+
+    def _resolve(self, watch: _ImportWatch, result: typing.Optional[Image]) -> None:
+        with self._lock:
+            self._watches.pop(watch.image.id, None)
+        watch.future.set_result(result)
+
+    def tick(self) -> None:
+        """Check all imports that are due in batched listings"""
+        now = time.monotonic()
+        with self._lock:
+            due = [x for x in self._watches.values() if x.next_poll <= now]
+
+        for watch in [x for x in due if now > x.deadline]:
+            logger.error(f"Image {watch.image.name} import timed out")
+            self._resolve(watch, None)
+        due = [x for x in due if now <= x.deadline]
+
+        for start in range(0, len(due), self.BATCH_SIZE):
+            end = start + self.BATCH_SIZE
+            batch = due[start:end]
+            ids = ",".join(x.image.id for x in batch)
+            try:
+                images = {x.id: x for x in self.image_proxy.images(id=f"in:{ids}")}
+            except Exception as e:
+                for watch in batch:
+                    self._error(watch, now, e)
+                continue
+
+            for watch in batch:
+                if watch.image.id in images:
+                    watch.consecutive_errors = 0
+                    self._observe(watch, now, images[watch.image.id])
+                else:
+                    self._error(watch, now, "image not found")
+
+    def _observe(self, watch: _ImportWatch, now: float, image: Image) -> None:
+        status = image.status
+        if watch.stores is not None and status == "active":
+            # os_glance_importing_to_stores is only filled once the task flow
+            # of the copy started, so it cannot tell a finished copy
+            done = _import_stores(image, "stores").split(",") + _import_stores(
+                image, "os_glance_failed_import"
+            ).split(",")
+            if all(x in done for x in watch.stores):
+                self._resolve(watch, image)
+            else:
+                logger.debug(f"Waiting for copies of {image.name} to complete...")
+                watch.next_poll = now + import_poll_interval(
+                    now - watch.started, watch.predicted
+                )
+        elif status == "active" and not _import_stores(
+            image, "os_glance_importing_to_stores"
+        ):
+            self._resolve(watch, image)
+        elif status == "queued":
+            if watch.retry_attempts_for_queued_state < 0:
+                logger.error(f"Image {image.name} seems stuck in queued state")
+                self._resolve(watch, None)
+                return
+            watch.retry_attempts_for_queued_state -= 1
+            watch.next_poll = now + self.QUEUED_INTERVAL
+        elif status in ("killed", "deleted", "pending_delete"):
+            logger.error(f"Image {image.name} entered terminal state '{status}'")
+            self._resolve(watch, None)
+        else:
+            logger.debug(f"Waiting for import of {image.name} to complete...")
+            watch.next_poll = now + import_poll_interval(
+                now - watch.started, watch.predicted
+            )
+
+    def _error(self, watch: _ImportWatch, now: float, error) -> None:
+        watch.consecutive_errors += 1
+        logger.error(f"Exception while importing image {watch.image.name}\n{error}")
+        if watch.consecutive_errors >= 5:
+            logger.error(f"Giving up on image {watch.image.name} after repeated errors")
+            self._resolve(watch, None)
+        else:
+            watch.next_poll = now + self.QUEUED_INTERVAL
+
+
+class Aria2Daemon:
+    """
+    One aria2c process with JSON-RPC interface serving all prefetches of a run
+
+    The daemon is started with the first download. Downloads are submitted
+    with aria2.addUri and polled with aria2.tellStatus, which reports progress
+    and speed and allows to cancel a download exactly at its deadline. The
+    connections of the daemon (CONNECTIONS) are divided among the downloads
+    in progress, a download uses at most the split it asks for.
+    """
+
+    CONNECTIONS = 16
+    POLL_INTERVAL = 1.0
+    PROGRESS_INTERVAL = 30.0
+    START_TIMEOUT = 10.0
+    START_ATTEMPTS = 3
+
+    def __init__(self) -> None:
+        self._process: typing.Optional[subprocess.Popen] = None
+        self._url = ""
+        self._secret = ""
+        self._session = requests.Session()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def _start(self) -> None:
+        for attempt in range(1, self.START_ATTEMPTS + 1):
+            if self._launch():
+                return
+            logger.warning(
+                f"aria2c RPC daemon exited on start ({attempt}/{self.START_ATTEMPTS})"
+            )
+        raise RuntimeError("aria2c RPC daemon did not start")
+
+    def _launch(self) -> bool:
+        """
+        Start aria2c on a free port
+
+        Returns False when aria2c exited right away, e.g. because another
+        process took the port between its lookup and aria2c binding it.
+        """
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self._url = f"http://127.0.0.1:{port}/jsonrpc"
+        self._secret = secrets.token_hex(16)
+        # every local user can read the command line, so the secret is
+        # passed in a configuration file only readable by this user
+        with tempfile.TemporaryDirectory(prefix="openstack-image-manager-") as tmp:
+            conf = os.path.join(tmp, "aria2.conf")
+            fd = os.open(conf, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as fp:
+                fp.write(f"rpc-secret={self._secret}\n")
+            self._process = subprocess.Popen(
+                [
+                    "aria2c",
+                    f"--conf-path={conf}",
+                    "--enable-rpc",
+                    "--rpc-listen-all=false",
+                    f"--rpc-listen-port={port}",
+                    f"--max-concurrent-downloads={self.CONNECTIONS}",
+                    "--quiet",
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+            deadline = time.monotonic() + self.START_TIMEOUT
+            while True:
+                try:
+                    self.call("aria2.getVersion")
+                    return True
+                except requests.RequestException:
+                    if self._process.poll() is not None:
+                        self._process = None
+                        return False
+                    if time.monotonic() > deadline:
+                        self.stop()
+                        raise RuntimeError("aria2c RPC daemon did not start")
+                    time.sleep(0.1)
+
+    def call(self, method: str, *params) -> typing.Any:
+        """Call an aria2 RPC method, raising RuntimeError for an RPC error"""
+        payload = {
+            "jsonrpc": "2.0",
+            "id": str(next(self._ids)),
+            "method": method,
+            "params": [f"token:{self._secret}", *params],
+        }
+        response = self._session.post(self._url, json=payload, timeout=REQUESTS_TIMEOUT)
+        body = response.json()
+        if "error" in body:
+            raise RuntimeError(f"{method} failed: {body['error'].get('message')}")
+        return body["result"]
+
+    def stop(self) -> None:
+        if self._process is None:
+            return
+        with contextlib.suppress(Exception):
+            self.call("aria2.shutdown")
+        try:
+            self._process.wait(timeout=self.START_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+    def download(
+        self,
+        urls: typing.List[str],
+        dest: str,
+        checksum: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+        split: int = 4,
+        connections: int = 4,
+        min_split_size: int = DOWNLOAD_MIN_SPLIT_SIZE,
+    ) -> bool:
+        """
+        Download urls, alternative sources of the same file, to dest
+
+        Returns False on failure or when timeout elapses.
+        """
+        url = urls[0]
+        with self._lock:
+            if self._process is None:
+                try:
+                    self._start()
+                except Exception as e:
+                    logger.error(f"aria2c failed to run: {e}")
+                    return False
+            self._active += 1
+            split = max(1, min(split, self.CONNECTIONS // self._active))
+
+        directory, filename = os.path.split(dest)
+        options = {
+            "dir": directory,
+            "out": filename,
+            "split": str(split),
+            "max-connection-per-server": str(min(connections, split)),
+            "min-split-size": f"{min_split_size // 2**20}M",
+            "max-tries": "5",
+            "retry-wait": "10",
+            "timeout": "60",
+            "connect-timeout": "30",
+            "continue": "true",
+            "allow-overwrite": "true",
+            "auto-file-renaming": "false",
+        }
+        aria2_checksum = checksum_to_aria2(checksum)
+        if aria2_checksum:
+            options["checksum"] = aria2_checksum
+
+        started = time.monotonic()
+        deadline = started + timeout if timeout else None
+        gid = None
+        try:
+            gid = self.call("aria2.addUri", urls, options)
+            return self._wait(gid, url, started, deadline)
+        except Exception as e:
+            logger.error(f"aria2 RPC failed for {url}: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._active -= 1
+            if gid is not None:
+                with contextlib.suppress(Exception):
+                    self.call("aria2.removeDownloadResult", gid)
+
+    def _wait(
+        self, gid: str, url: str, started: float, deadline: typing.Optional[float]
+    ) -> bool:
+        keys = ["status", "completedLength", "totalLength", "downloadSpeed"]
+        next_report = started + self.PROGRESS_INTERVAL
+        while True:
+            status = self.call("aria2.tellStatus", gid, keys + ["errorMessage"])
+            state = status["status"]
+            now = time.monotonic()
+            completed = int(status.get("completedLength", 0))
+            if state == "complete":
+                speed = completed / max(now - started, 1e-3)
+                logger.info(
+                    f"aria2 downloaded {url}: {completed} bytes at "
+                    f"{speed / 2**20:.1f} MiB/s"
+                )
+                return True
+            if state in ("error", "removed"):
+                message = status.get("errorMessage") or state
+                logger.error(f"aria2 failed to download {url}: {message}")
+                return False
+            if deadline is not None and now > deadline:
+                logger.error(f"aria2c timed out downloading {url}")
+                with contextlib.suppress(Exception):
+                    self.call("aria2.forceRemove", gid)
+                return False
+            if now >= next_report:
+                total = int(status.get("totalLength", 0))
+                speed = int(status.get("downloadSpeed", 0))
+                percent = f"{100 * completed // total}%" if total else "?"
+                logger.info(
+                    f"aria2 downloading {url}: {percent} of {total} bytes at "
+                    f"{speed / 2**20:.1f} MiB/s"
+                )
+                next_report = now + self.PROGRESS_INTERVAL
+            time.sleep(self.POLL_INTERVAL)
+
+
+class RangeDownloader:
+    """
+    Segmented HTTP downloads without aria2c
+
+    The file is preallocated and its segments are fetched with Range requests
+    by a thread pool over one pooled requests.Session, round-robin across the
+    sources. Finished segments are recorded in a sidecar state file next to
+    the target, so an interrupted download resumes with the missing segments.
+    A declared checksum is verified once all segments are written.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    SEGMENT_ATTEMPTS = 3
+
+    def __init__(self, session: typing.Optional[requests.Session] = None) -> None:
+        self._session = session or upstream_session()
+
+    def download(
+        self,
+        urls: typing.List[str],
+        dest: str,
+        checksum: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+        split: int = 4,
+        min_split_size: int = DOWNLOAD_MIN_SPLIT_SIZE,
+        metadata: typing.Optional[UrlMetadata] = None,
+    ) -> bool:
+        """
+        Download urls, alternative sources of the same file, to dest
+
+        metadata is the probe of the first URL, e.g. from ImageManager._probe();
+        without it the URL is probed here.
+        """
+        url = urls[0]
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            if metadata is None:
+                resp = self._session.head(
+                    url, timeout=REQUESTS_TIMEOUT, allow_redirects=True
+                )
+                metadata = UrlMetadata.from_response(url, resp)
+            if metadata.final_status >= 400:
+                raise requests.RequestException(f"HTTP {metadata.final_status}")
+            if not metadata.size or metadata.accept_ranges != "bytes":
+                logger.info(f"No range support for {url}, downloading in one piece")
+                self._fetch_whole(url, dest, deadline)
+            else:
+                self._fetch_segments(
+                    urls,
+                    dest,
+                    metadata.size,
+                    metadata.etag,
+                    deadline,
+                    split,
+                    min_split_size,
+                )
+        except (OSError, requests.RequestException, TimeoutError) as e:
+            logger.error(f"Download of {url} failed: {e}")
+            return False
+
+        parsed = parse_checksum(checksum)
+        if parsed is not None:
+            digest = hashlib.new(parsed[0])
+            with open(dest, "rb") as fp:
+                for chunk in iter(lambda: fp.read(self.CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() != parsed[1].lower():
+                logger.error(f"Checksum mismatch for {url}, discarding the download")
+                os.remove(dest)
+                return False
+        return True
+
+    def _fetch_whole(
+        self, url: str, dest: str, deadline: typing.Optional[float]
+    ) -> None:
+        with self._session.get(url, stream=True, timeout=REQUESTS_TIMEOUT) as resp:
+            resp.raise_for_status()
+            with open(dest, "wb") as fp:
+                for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError("deadline passed")
+                    fp.write(chunk)
+
+    def _fetch_segments(
+        self,
+        urls: typing.List[str],
+        dest: str,
+        size: int,
+        etag: typing.Optional[str],
+        deadline: typing.Optional[float],
+        split: int,
+        min_split_size: int,
+    ) -> None:
+        segment_size = max(min_split_size, -(-size // split))
+        segments = [
+            (offset, min(offset + segment_size, size))
+            for offset in range(0, size, segment_size)
+        ]
+        state_path = f"{dest}.state"
+        state: Dict[str, typing.Any] = {
+            "url": urls[0],
+            "size": size,
+            "etag": etag,
+            "done": [],
+        }
+        if os.path.isfile(state_path) and os.path.isfile(dest):
+            try:
+                with open(state_path) as fp:
+                    previous = json.load(fp)
+                if all(previous.get(k) == state[k] for k in ("url", "size", "etag")):
+                    state["done"] = previous.get("done", [])
+                    logger.info(
+                        f"Resuming download of {urls[0]}: "
+                        f"{len(state['done'])} of {len(segments)} segments done"
+                    )
+            except (OSError, ValueError):
+                pass
+        lock = threading.Lock()
+        # set once a segment failed for good, ends the others early
+        stop = threading.Event()
+
+        fd = os.open(dest, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+
+            def fetch(index: int) -> None:
+                start, end = segments[index]
+                source = urls[index % len(urls)]
+                for attempt in range(1, self.SEGMENT_ATTEMPTS + 1):
+                    try:
+                        self._fetch_segment(source, fd, start, end, deadline, stop)
+                        break
+                    except requests.RequestException as e:
+                        if attempt == self.SEGMENT_ATTEMPTS:
+                            raise
+                        logger.warning(
+                            f"Segment {index} of {source} failed, retrying: {e}"
+                        )
+                with lock:
+                    state["done"].append(index)
+                    with open(f"{state_path}.tmp", "w") as fp:
+                        json.dump(state, fp)
+                    os.replace(f"{state_path}.tmp", state_path)
+
+            missing = [i for i in range(len(segments)) if i not in state["done"]]
+            workers = max(1, min(split, len(missing)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(fetch, i) for i in missing]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    stop.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(state_path)
+
+    def _fetch_segment(
+        self,
+        url: str,
+        fd: int,
+        start: int,
+        end: int,
+        deadline: typing.Optional[float],
+        stop: typing.Optional[threading.Event] = None,
+    ) -> None:
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        with self._session.get(
+            url, headers=headers, stream=True, timeout=REQUESTS_TIMEOUT
+        ) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise requests.RequestException(f"{url} ignored the Range header")
+            offset = start
+            for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError("deadline passed")
+                if stop is not None and stop.is_set():
+                    raise InterruptedError("another segment failed")
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+            if offset != end:
+                raise requests.RequestException(
+                    f"Segment {start}-{end} of {url} ended after {offset - start} bytes"
+                )
+
+
+def default_partial_directory() -> str:
+    """Per-user directory for partial downloads, below $XDG_CACHE_HOME"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "openstack-image-manager", "partial")
+
+
+class PartialDownloads:
+    """
+    Stable places for unfinished downloads, so that a later attempt resumes them
+
+    A download is written to a directory keyed by its URL and checksum and
+    only moved to its destination once it is complete. After a failure the
+    partial file stays, together with the resume state of aria2c (.aria2) or
+    of the RangeDownloader (.state). Partial downloads untouched for MAX_AGE
+    seconds are removed.
+
+    The directory must be private to the current user (mode 0700), otherwise
+    another user could plant a partial file that the next attempt resumes.
+    If it is not, every download starts over in a fresh temporary directory.
+    """
+
+    MAX_AGE = 7 * 86400
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._private: typing.Optional[bool] = None
+
+    def path(self, url: str, checksum: typing.Optional[str]) -> str:
+        """Directory of the partial download of url, created on demand"""
+        with self._lock:
+            if self._private is None:
+                self._private = self._make_private(self.directory)
+                if self._private:
+                    self._prune()
+            if not self._private:
+                return tempfile.mkdtemp(prefix="openstack-image-manager-")
+            key = hashlib.sha256(f"{url}\n{checksum or ''}".encode()).hexdigest()[:32]
+            path = os.path.join(self.directory, key)
+            if not self._make_private(path) or not self._owned(path):
+                logger.warning(f"Not resuming the partial download in {path}")
+                shutil.rmtree(path, ignore_errors=True)
+                os.mkdir(path, 0o700)
+        return path
+
+    def discard(self, path: str) -> None:
+        """Remove a failed download that cannot be resumed later"""
+        if not self._private:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def lock(self, path: str) -> threading.Lock:
+        """Lock serializing the downloads into one partial directory"""
+        with self._lock:
+            return self._key_locks.setdefault(path, threading.Lock())
+
+    @staticmethod
+    def _make_private(directory: str) -> bool:
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            st = os.lstat(directory)
+        except OSError as e:
+            logger.warning(f"Could not create {directory}: {e}")
+            return False
+        if (
+            not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or st.st_mode & 0o077
+        ):
+            logger.warning(
+                f"{directory} is not a directory private to this user, "
+                "downloads are not resumed"
+            )
+            return False
+        return True
+
+    @staticmethod
+    def _owned(directory: str) -> bool:
+        for name in os.listdir(directory):
+            st = os.lstat(os.path.join(directory, name))
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+                return False
+        return True
+
+    def _prune(self) -> None:
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            with contextlib.suppress(OSError):
+                if time.time() - os.lstat(path).st_mtime > self.MAX_AGE:
+                    logger.info(f"Removing stale partial download {path}")
+                    shutil.rmtree(path, ignore_errors=True)
+
+
+class PrefetchCache:
+    """
+    Persistent, content-addressed cache of prefetched images
+
+    Entries are keyed by the declared checksum of an image or, without one,
+    by its URL and ETag, so a retried run or another cloud reuses a download.
+    Files are downloaded into an incoming directory next to the entries and
+    published with an atomic rename. Once the total size exceeds the budget,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, budget: int) -> None:
+        self.directory = directory
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(
+        checksum: typing.Optional[str], url: str, etag: typing.Optional[str]
+    ) -> typing.Optional[str]:
+        """Cache key of an image, None when it cannot be identified"""
+        parsed = parse_checksum(checksum)
+        if parsed is not None:
+            return f"{parsed[0]}-{parsed[1].lower()}"
+        if etag:
+            digest = hashlib.sha256(f"{url}\n{etag}".encode()).hexdigest()
+            return f"url-{digest}"
+        return None
+
+    def lock(self, key: str) -> threading.Lock:
+        """Lock serializing the lookup and download of one entry"""
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key: str, checksum: typing.Optional[str]) -> typing.Optional[str]:
+        """Path of a cached image, verified against checksum, or None"""
+        path = os.path.join(self.directory, key)
+        with self._lock:
+            if not os.path.isfile(path):
+                self.misses += 1
+                return None
+        parsed = parse_checksum(checksum)
+        if parsed is not None:
+            digest = hashlib.new(parsed[0])
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() != parsed[1].lower():
+                logger.warning(f"Removing corrupt prefetch cache entry {key}")
+                with self._lock:
+                    self.misses += 1
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+                return None
+        with self._lock:
+            # the modification time orders the entries for the LRU eviction
+            os.utime(path)
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(path)
+        return path
+
+    def incoming(self) -> str:
+        """A fresh directory for a download that is to be published"""
+        return tempfile.mkdtemp(prefix=".incoming-", dir=self.directory)
+
+    def put(self, key: str, path: str) -> str:
+        """Publish a downloaded file and return the path of the entry"""
+        entry = os.path.join(self.directory, key)
+        with self._lock:
+            os.replace(path, entry)
+            self._evict(keep=key)
+        return entry
+
+    def _evict(self, keep: str) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, name, path))
+        total = sum(x[1] for x in entries)
+        for _, size, name, path in sorted(entries):
+            if total <= self.budget:
+                break
+            if name == keep:
+                continue
+            logger.info(f"Evicting prefetch cache entry {name} ({size} bytes)")
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+
+class _PrefetchJob:
+    """An image on its way through the PrefetchPipeline"""
+
+    def __init__(
+        self,
+        properties: dict,
+        name: str,
+        url: str,
+        checksum: typing.Optional[str],
+        stores: typing.Optional[dict] = None,
+    ) -> None:
+        self.properties = properties
+        self.name = name
+        self.url = url
+        self.checksum = checksum
+        self.stores = stores
+        # the import budget starts with the download, not with the submission
+        self.started = 0.0
+        self.deadline = 0.0
+        self.path: typing.Optional[str] = None
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class PrefetchPipeline:
+    """
+    Prefetch imports with overlapping download and staging
+
+    A download thread fetches the images with aria2 while a stage thread
+    uploads the previous download to Glance, so network ingress and the upload
+    to Glance are busy at the same time. At most DEPTH downloaded files exist
+    at once, which bounds the disk usage; each file is deleted as soon as it
+    is staged.
+
+    download(job, directory) returns the path of the downloaded file or None.
+    stage(job) stages job.path, starts its import and returns a future of the
+    import (see ImportWatcher.watch()) or None; job.future follows it.
+    """
+
+    DEPTH = 2
+
+    def __init__(
+        self,
+        download: typing.Callable[[_PrefetchJob, str], typing.Optional[str]],
+        stage: typing.Callable[
+            [_PrefetchJob], typing.Optional[concurrent.futures.Future]
+        ],
+    ) -> None:
+        self._download = download
+        self._stage = stage
+        self._slots = threading.Semaphore(self.DEPTH)
+        self._downloads: queue.Queue = queue.Queue()
+        self._stages: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(
+                target=self._run_downloads, name="prefetch-download", daemon=True
+            ),
+            threading.Thread(
+                target=self._run_stages, name="prefetch-stage", daemon=True
+            ),
+        ]
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """Wait for the running download and stage, resolve queued jobs to None"""
+        self._stop.set()
+        self._downloads.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, job: _PrefetchJob) -> concurrent.futures.Future:
+        self._downloads.put(job)
+        return job.future
+
+    def _run_downloads(self) -> None:
+        while True:
+            job = self._downloads.get()
+            if job is None:
+                break
+            if self._stop.is_set():
+                job.future.set_result(None)
+                continue
+            self._slots.acquire()
+            directory = tempfile.mkdtemp(prefix="openstack-image-manager-")
+            try:
+                job.path = self._download(job, directory)
+            except Exception as e:
+                logger.error(f"PREFETCH: download failed for '{job.name}'\n{e}")
+                job.path = None
+            if job.path is None:
+                shutil.rmtree(directory, ignore_errors=True)
+                self._slots.release()
+                job.future.set_result(None)
+            else:
+                self._stages.put((job, directory))
+        self._stages.put(None)
+
+    def _run_stages(self) -> None:
+        while True:
+            item = self._stages.get()
+            if item is None:
+                break
+            job, directory = item
+            try:
+                imported = self._stage(job)
+            except Exception as e:
+                logger.error(f"PREFETCH: staging failed for '{job.name}'\n{e}")
+                imported = None
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+                self._slots.release()
+            self._follow(job, imported)
+
+    @staticmethod
+    def _follow(
+        job: _PrefetchJob, imported: typing.Optional[concurrent.futures.Future]
+    ) -> None:
+        if imported is None:
+            job.future.set_result(None)
+        else:
+            imported.add_done_callback(lambda x: job.future.set_result(x.result()))
+
+
+class _PendingImport:
+    """An import submitted ahead by the two-phase mode"""
+
+    def __init__(
+        self,
+        method: str,
+        future: concurrent.futures.Future,
+        started: float,
+        image: typing.Optional[Image] = None,
+        size: typing.Optional[int] = None,
+    ) -> None:
+        self.method = method
+        self.future = future
+        self.started = started
+        # the created image, deleted when its import fails
+        self.image = image
+        # the upstream size, for the import history
+        self.size = size
+
+
+class PlanAction:
+    """
+    One change of a Plan
+
+    kind is one of Plan.KINDS. An update carries the changed attributes,
+    properties and tags (including renames and hiding) in params. after
+    holds the indexes of the actions that have to be applied before.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        image_id: typing.Optional[str],
+        name: str,
+        params: typing.Optional[dict] = None,
+        after: typing.Optional[typing.List[int]] = None,
+    ) -> None:
+        self.kind = kind
+        self.image_id = image_id
+        self.name = name
+        self.params = params or {}
+        self.after = after or []
+
+    def __str__(self) -> str:
+        params = ", ".join(f"{k}={v!r}" for k, v in self.params.items())
+        target = f"'{self.name}'" + (f" ({self.image_id})" if self.image_id else "")
+        return f"{self.kind} {target}" + (f": {params}" if params else "")
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "image_id": self.image_id,
+            "name": self.name,
+            "params": self.params,
+            "after": self.after,
+        }
+
+
+class Plan:
+    """
+    Changes of a cloud's images, built by a --dry-run and applied later
+
+    Actions on the same image are applied in order, renames in the order
+    they were planned and changes to existing images after all imports.
+    Everything else is applied concurrently. A definition is imported as a
+    whole, so there is one import action per definition, listing the URLs
+    of all its missing versions.
+    """
+
+    KINDS = (
+        "import",
+        "update",
+        "deactivate",
+        "reactivate",
+        "delete",
+        "share",
+        "unshare",
+    )
+
+    def __init__(self, cloud: str) -> None:
+        self.cloud = cloud
+        self.actions: typing.List[PlanAction] = []
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        kind: str,
+        image_id: typing.Optional[str],
+        name: str,
+        params: typing.Optional[dict] = None,
+    ) -> PlanAction:
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown plan action {kind}")
+        params = params or {}
+        with self._lock:
+            definition = params.get("definition")
+            for action in self.actions:
+                if kind == action.kind == "import" and (
+                    action.params.get("definition") == definition
+                ):
+                    urls = action.params.get("urls", []) + params.get("urls", [])
+                    action.params["urls"] = urls
+                    return action
+            after = []
+            for index, action in enumerate(self.actions):
+                if kind == "import":
+                    continue
+                if (
+                    action.kind == "import"
+                    or (image_id is not None and action.image_id == image_id)
+                    or ("name" in params and "name" in action.params)
+                ):
+                    after.append(index)
+            action = PlanAction(kind, image_id, name, params, after)
+            self.actions.append(action)
+            return action
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.tmp", "w") as fp:
+            json.dump(
+                {"cloud": self.cloud, "actions": [x.to_dict() for x in self.actions]},
+                fp,
+                indent=2,
+            )
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "Plan":
+        with open(path) as fp:
+            data = json.load(fp)
+        plan = cls(data["cloud"])
+        plan.actions = [PlanAction(**x) for x in data["actions"]]
+        return plan
+
+    def apply(self, execute: typing.Callable[[PlanAction], None], workers: int) -> bool:
+        """
+        Execute all actions, each once the actions it depends on succeeded
+
+        Returns False when an action failed or was skipped because an action
+        it depends on failed.
+        """
+        pending = list(range(len(self.actions)))
+        running: Dict[concurrent.futures.Future, int] = {}
+        done: Set[int] = set()
+        failed: Set[int] = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for index in list(pending):
+                    action = self.actions[index]
+                    if any(x in failed for x in action.after):
+                        logger.error(f"Skipping {action}, a previous action failed")
+                        failed.add(index)
+                        pending.remove(index)
+                    elif all(x in done for x in action.after):
+                        logger.info(f"Applying {action}")
+                        running[pool.submit(execute, action)] = index
+                        pending.remove(index)
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    index = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(index)
+                    except Exception as e:
+                        logger.error(f"Failed to apply {self.actions[index]}: {e}")
+                        failed.add(index)
+        return not failed
+
+
 class ImageManager:
     def __init__(self) -> None:
-        self.exit_with_error = False
+        # an Event, so workers of --parallel can flag errors safely
+        self._error = threading.Event()
+        # the errors flagged by the current thread, see apply_plan()
+        self._thread_errors = threading.local()
+        # serializes the initial listing of the catalog between workers
+        self._catalog_lock = threading.Lock()
+        # shared poller for the imports of --parallel workers
+        self._watcher: typing.Optional[ImportWatcher] = None
+        # sizes in bytes of upstream images, as reported by HEAD requests
+        self._upstream_sizes: Dict[str, int] = {}
+        # alternative download sources of a URL, see --prefetch-mirrors
+        self._download_mirrors: Dict[str, typing.List[str]] = {}
+        # replaced by a persisted history for the cloud in main()
+        self._import_history = ImportHistory()
+        self._download_history = DownloadHistory()
+        # set during the submit phase of --two-phase
+        self._submitting = False
+        self._submitted: Dict[str, _PendingImport] = {}
+        # download/stage pipeline for --two-phase with --prefetch always
+        self._pipeline: typing.Optional[PrefetchPipeline] = None
+        self._prefetch_cache: typing.Optional[PrefetchCache] = None
+        self._aria2: typing.Optional[Aria2Daemon] = None
+        # one pooled session for all upstream HTTP requests of a run
+        self._http = upstream_session()
+        self._range_downloader = RangeDownloader(self._http)
+        self._partials = PartialDownloads(default_partial_directory())
+        # changes planned by --dry-run instead of applying them
+        self._plan: typing.Optional[Plan] = None
+        # shared by the per-cloud managers of a multi-cloud run
+        self._upstream: typing.Optional[UpstreamMemo] = None
+        self._url_cache = UrlMetadataCache()
+        self._checksum_cache = ChecksumFileCache()
+        # background copies of imported images to further stores
+        self._replicator: typing.Optional[ImportWatcher] = None
+        self._replications: typing.List[tuple] = []
+        self._replication_lock = threading.Lock()
+        self._log_prefix = ""
+        # run-scoped snapshot of the managed Glance images, see get_images()
+        self._cloud_images: typing.Optional[ImageCatalog] = None
+        # time.time() of the last full listing the catalog is based on
+        self._catalog_listed_at = 0.0
+
+    @property
+    def exit_with_error(self) -> bool:
+        return self._error.is_set()
+
+    @exit_with_error.setter
+    def exit_with_error(self, value: bool) -> None:
+        if value:
+            self._error.set()
+            self._thread_errors.failed = True
+        else:
+            self._error.clear()
 
     def create_cli_args(
         self,
         debug: bool = typer.Option(False, "--debug", help="Enable debug logging"),
         dry_run: bool = typer.Option(
-            False, "--dry-run", help="Do not perform any changes"
+            False,
+            "--dry-run",
+            help="Do not perform any changes, print the planned changes instead",
         ),
         check_age: bool = typer.Option(
             False, "--check-age", help="Check openstack image age against definition"
@@ -84,7 +1794,11 @@ class ImageManager:
             "--keep",
             help="Keep versions of images where the version is not longer defined",
         ),
-        cloud: str = typer.Option("openstack", help="Cloud name in clouds.yaml"),
+        cloud: str = typer.Option(
+            "openstack",
+            help="Cloud name in clouds.yaml, a comma-separated list of cloud "
+            "names or the name of a list in the 'groups' section of clouds.yaml",
+        ),
         images: str = typer.Option(
             "etc/images/",
             help="Path to the directory containing all image files or path to "
@@ -112,6 +1826,18 @@ class ImageManager:
         use_os_hidden: bool = typer.Option(
             False, "--use-os-hidden", help="Use the os_hidden property"
         ),
+        url_cache_ttl: int = typer.Option(
+            0,
+            "--url-cache-ttl",
+            help="Seconds to reuse the metadata of upstream URLs kept in --cache-dir "
+            "without asking upstream again",
+            min=0,
+        ),
+        reconcile: bool = typer.Option(
+            False,
+            "--reconcile",
+            help="Also check the properties of existing images, not only of new imports",
+        ),
         share_image: str = typer.Option(
             None, "--share-image", help="Share - Image to share"
         ),
@@ -148,11 +1874,87 @@ class ImageManager:
             callback=_validate_prefetch,
             help="Download via aria2 + glance-direct: never | on-stuck | always",
         ),
+        prefetch_mirrors: bool = typer.Option(
+            False,
+            "--prefetch-mirrors",
+            help="Download prefetches from both mirror_url and url as alternative "
+            "sources of the same file",
+        ),
+        plan_file: str = typer.Option(
+            None,
+            "--plan-file",
+            help="Write the plan of a dry run to this file ({cloud} is replaced "
+            "by the cloud name)",
+        ),
+        apply_plan: str = typer.Option(
+            None, "--apply-plan", help="Apply a plan written by --plan-file"
+        ),
+        aria2_rpc: bool = typer.Option(
+            False,
+            "--aria2-rpc",
+            help="Run prefetch downloads in one aria2c RPC daemon instead of one "
+            "aria2c process per image",
+        ),
+        stores: str = typer.Option(
+            None,
+            "--stores",
+            help="Comma-separated list of Glance stores to import images into",
+        ),
+        all_stores: bool = typer.Option(
+            False, "--all-stores", help="Import images into all Glance stores"
+        ),
+        prefetch_cache: str = typer.Option(
+            None,
+            "--prefetch-cache",
+            help="Directory keeping prefetched images for later runs and other "
+            "clouds (disabled when unset)",
+        ),
+        prefetch_cache_size: int = typer.Option(
+            50,
+            "--prefetch-cache-size",
+            min=1,
+            help="Size budget of the prefetch cache in GiB",
+        ),
+        prefetch_stream: bool = typer.Option(
+            False,
+            "--prefetch-stream",
+            help="Stream prefetched images from the upstream URL straight into "
+            "the glance-direct staging area instead of downloading them first",
+        ),
         import_timeout: int = typer.Option(
             1800,
             "--import-timeout",
             help="Overall per-image import wait budget in seconds",
         ),
+        copy_timeout: int = typer.Option(
+            3600,
+            "--copy-timeout",
+            help="Wait budget in seconds for copying an imported image to the "
+            "stores in copy_to_stores",
+        ),
+        cache_dir: str = typer.Option(
+            None,
+            "--cache-dir",
+            help="Directory for state kept between runs, e.g. a snapshot of the "
+            "Glance catalog (disabled when unset)",
+        ),
+        catalog_max_age: int = typer.Option(
+            86400,
+            "--catalog-max-age",
+            help="Age in seconds after which the catalog snapshot is replaced "
+            "by a full listing",
+        ),
+        parallel: int = typer.Option(
+            1,
+            "--parallel",
+            min=1,
+            help="Number of image definitions processed concurrently",
+        ),
+        two_phase: bool = typer.Option(
+            False,
+            "--two-phase",
+            help="Submit all web-download imports first and collect them afterwards",
+        ),
     ):
         self.CONF = Munch.fromDict(locals())
         self.CONF.pop("self")  # remove the self object from CONF
@@ -161,16 +1963,19 @@ class ImageManager:
             level = "DEBUG"
             log_fmt = (
                 "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
-                "<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+                "<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+                "{extra[context]}<level>{message}</level>"
             )
         else:
             level = "INFO"
             log_fmt = (
                 "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
-                "<level>{message}</level>"
+                "{extra[context]}<level>{message}</level>"
             )
 
         logger.remove()
+        # workers of --parallel set the context to the processed image
+        logger.configure(extra={"context": ""})
         logger.add(sys.stderr, format=log_fmt, level=level, colorize=True)
 
         if __name__ == "__main__" or __name__ == "openstack_image_manager.main":
@@ -221,19 +2026,16 @@ class ImageManager:
         return all_images
 
     def is_checksum(self, string: str) -> bool:
-        return bool(
-            re.fullmatch(
-                r"[0-9a-fA-F]{32}|[0-9a-fA-F]{40}|[0-9a-fA-F]{64}|[0-9a-fA-F]{128}",
-                string,
-            )
-        )
+        return bool(_DIGEST_RE.fullmatch(string))
 
     def get_checksum_from_checksums_url(self, url: str, checksums_url: str) -> str:
         """
         Get the checksum of an upstream image by parsing its corresponding checksums file
 
         The checksums file contains one or more lines of the form
-        "<digest> <filename>"; the line containing the image filename is used.
+        "<digest> <filename>" or "<ALGO> (<filename>) = <digest>"; the line of
+        the image filename is used. Each checksums file is fetched and indexed
+        once per run.
 
         Params:
             url: the download URL of the image
@@ -244,26 +2046,53 @@ class ImageManager:
         """
         filename = url.split("/")[-1]
         try:
-            response = requests.get(checksums_url, timeout=REQUESTS_TIMEOUT)
-            response.raise_for_status()
+            index = self._lookup(
+                ("checksums", checksums_url),
+                lambda: self._fetch_checksum_file(checksums_url, parse_checksums_file),
+            )
         except requests.RequestException as e:
             logger.error(f"Failed to fetch checksums file from {checksums_url}: {e}")
             return ""
-        checksums_file = response.text
-        for line in checksums_file.splitlines():
-            if filename in line:
-                split = line.split(" ")
-                for elem in split:
-                    if self.is_checksum(elem):
-                        return elem
-        return ""
+        if filename not in index:
+            return ""
+        return index[filename][1]
+
+    def _fetch_checksum_file(
+        self, url: str, parse: typing.Callable[[str], typing.Any]
+    ) -> typing.Any:
+        """
+        Download and parse a checksum file, unless it is unchanged since the last run
+
+        With a cached entry the request is conditional, and a 304 Not Modified
+        returns the result parsed back then.
+        """
+        cached = self._checksum_cache.get(url)
+        headers = {}
+        if cached is not None and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        elif cached is not None and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        response = self._http.get(url, timeout=REQUESTS_TIMEOUT, headers=headers)
+        if cached is not None and response.status_code == 304:
+            logger.debug(f"Checksum file {url} is unchanged")
+            return cached["result"]
+        response.raise_for_status()
+        result = parse(response.text)
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        if validators["etag"] or validators["last_modified"]:
+            self._checksum_cache.put(url, dict(validators, result=result))
+        return result
 
     def get_checksum_from_checksum_url(self, checksum_url: str) -> str:
         """
         Get the checksum from a checksum_url
 
         The checksum file is expected to contain a single bare digest and
-        nothing else (no filename), as published e.g. by Alpine.
+        nothing else (no filename), as published e.g. by Alpine. Each
+        checksum file is fetched once per run.
 
         Params:
             checksum_url: the URL of the checksum file
@@ -271,18 +2100,19 @@ class ImageManager:
         Returns:
             the checksum, if it is available or else an empty string
         """
+
+        def parse(text: str) -> str:
+            checksum = text.strip()
+            return checksum if self.is_checksum(checksum) else ""
+
         try:
-            response = requests.get(checksum_url, timeout=REQUESTS_TIMEOUT)
-            response.raise_for_status()
+            return self._lookup(
+                ("checksum", checksum_url),
+                lambda: self._fetch_checksum_file(checksum_url, parse),
+            )
         except requests.RequestException as e:
             logger.error(f"Failed to fetch checksum file from {checksum_url}: {e}")
             return ""
-        checksum_file_content = response.text.strip()
-
-        if self.is_checksum(checksum_file_content):
-            return checksum_file_content
-
-        return ""
 
     def create_connection(self) -> None:
         if "OS_AUTH_URL" in os.environ:
@@ -319,65 +2149,424 @@ class ImageManager:
         if self.CONF.check_only:
             return
 
-        # share image (previously share.py)
-        if self.CONF.share_image:
-            self.create_connection()
-            image = self.conn.get_image(self.CONF.share_image)
+        # share image (previously share.py)
+        if self.CONF.share_image:
+            self.create_connection()
+            image = self.conn.get_image(self.CONF.share_image)
+
+            if self.CONF.share_type == "project":
+                domain = self.conn.get_domain(name_or_id=self.CONF.share_domain)
+                project = self.conn.get_project(
+                    self.CONF.share_target, domain_id=domain.id
+                )
+
+                if self.CONF.share_action == "add":
+                    self.share_image_with_project(image, project)
+                elif self.CONF.share_action == "del":
+                    self.unshare_image_with_project(image, project)
+
+            elif self.CONF.share_type == "domain":
+                domain = self.conn.get_domain(name_or_id=self.CONF.share_target)
+                projects = self.conn.list_projects(domain_id=domain.id)
+                for project in projects:
+                    if self.CONF.share_action == "add":
+                        self.share_image_with_project(image, project)
+                    elif self.CONF.share_action == "del":
+                        self.unshare_image_with_project(image, project)
+
+            if self.CONF.dry_run:
+                self.report_plan()
+
+        # manage images
+        else:
+            if self.CONF.prefetch_cache:
+                self._prefetch_cache = PrefetchCache(
+                    self.CONF.prefetch_cache, self.CONF.prefetch_cache_size * 2**30
+                )
+                self._partials = PartialDownloads(
+                    os.path.join(self.CONF.prefetch_cache, ".partial")
+                )
+            elif self.CONF.cache_dir:
+                self._partials = PartialDownloads(
+                    os.path.join(self.CONF.cache_dir, "partial")
+                )
+            if self.CONF.aria2_rpc:
+                self._aria2 = Aria2Daemon()
+            if self.CONF.cache_dir:
+                self._url_cache = UrlMetadataCache(
+                    os.path.join(self.CONF.cache_dir, "url-metadata.json"),
+                    self.CONF.url_cache_ttl,
+                )
+                self._checksum_cache = ChecksumFileCache(
+                    os.path.join(self.CONF.cache_dir, "checksum-files.json")
+                )
+            clouds = self.resolve_clouds()
+            try:
+                if self.CONF.apply_plan:
+                    plan = Plan.load(self.CONF.apply_plan)
+                    self.CONF.cloud = plan.cloud
+                    self.create_connection()
+                    if self.CONF.dry_run:
+                        self._plan = plan
+                        self.report_plan()
+                    else:
+                        self.apply_plan(plan)
+                        self.save_catalog_snapshot()
+                elif len(clouds) > 1:
+                    self.manage_clouds(clouds)
+                else:
+                    self.create_connection()
+                    self.manage()
+            finally:
+                if self._aria2 is not None:
+                    self._aria2.stop()
+                self._url_cache.save()
+                self._checksum_cache.save()
+
+            if self._prefetch_cache is not None:
+                cache = self._prefetch_cache
+                logger.info(
+                    f"Prefetch cache: {cache.hits} hits, {cache.misses} misses, "
+                    f"{cache.bytes_saved} bytes not downloaded"
+                )
+
+        if self.exit_with_error:
+            sys.exit(
+                "\nERROR: One or more errors occurred during the execution of the program, "
+                "please check the output."
+            )
+
+    def resolve_clouds(self) -> typing.List[str]:
+        """
+        Names of the clouds to manage
+
+        --cloud is a single cloud, a comma-separated list of clouds or the
+        name of a list of clouds in the 'groups' section of clouds.yaml.
+        """
+        clouds = [x.strip() for x in self.CONF.cloud.split(",") if x.strip()]
+        if len(clouds) != 1:
+            return clouds
+        try:
+            config = openstack.config.loader.OpenStackConfig().cloud_config
+        except Exception as e:
+            logger.debug(f"Could not read clouds.yaml: {e}")
+            return clouds
+        groups = config.get("groups") or {}
+        if clouds[0] not in config.get("clouds", {}) and clouds[0] in groups:
+            return list(groups[clouds[0]])
+        return clouds
+
+    def manage_clouds(self, clouds: typing.List[str]) -> None:
+        """
+        Manage the images of several clouds at once
+
+        The clouds are processed concurrently by one ImageManager each, every
+        one with its own --parallel workers. Upstream lookups and prefetched
+        downloads are shared: a URL is probed and an image downloaded once
+        for all clouds. Without --prefetch-cache, a cache in a temporary
+        directory serves the downloads of this run. It is bounded by half of
+        the free space of the temporary directory, so it cannot fill the
+        filesystem the downloads are written to.
+        """
+        logger.info(f"Managing images of the clouds {', '.join(clouds)}")
+        self._upstream = UpstreamMemo()
+        with contextlib.ExitStack() as stack:
+            if self._prefetch_cache is None:
+                directory = stack.enter_context(
+                    tempfile.TemporaryDirectory(prefix="openstack-image-manager-")
+                )
+                budget = min(
+                    self.CONF.prefetch_cache_size * 2**30,
+                    shutil.disk_usage(directory).free // 2,
+                )
+                logger.debug(f"Temporary prefetch cache limited to {budget} bytes")
+                self._prefetch_cache = PrefetchCache(directory, budget)
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(clouds)
+            ) as executor:
+                results = dict(zip(clouds, executor.map(self._manage_cloud, clouds)))
+
+        for cloud, ok in results.items():
+            if ok:
+                logger.info(f"Cloud {cloud}: images successfully managed")
+            else:
+                logger.error(f"Cloud {cloud}: errors occurred, check the output")
+                self.exit_with_error = True
+
+    def _manage_cloud(self, cloud: str) -> bool:
+        """Manage the images of one cloud of a multi-cloud run"""
+        manager = ImageManager()
+        manager.CONF = Munch(self.CONF, cloud=cloud)
+        manager._upstream_sizes = self._upstream_sizes
+        manager._download_mirrors = self._download_mirrors
+        manager._prefetch_cache = self._prefetch_cache
+        manager._aria2 = self._aria2
+        manager._http = self._http
+        manager._range_downloader = self._range_downloader
+        manager._partials = self._partials
+        manager._upstream = self._upstream
+        manager._url_cache = self._url_cache
+        manager._checksum_cache = self._checksum_cache
+        manager._log_prefix = f"[{cloud}] "
+        with logger.contextualize(context=manager._log_prefix):
+            try:
+                manager.conn = openstack.connect(cloud=cloud)
+                manager.manage()
+            except Exception as e:
+                logger.error(f"Managing images of cloud {cloud} failed\n{e}")
+                return False
+        return not manager.exit_with_error
+
+    def _probe(self, url: str) -> UrlMetadata:
+        """Metadata of an upstream URL, probed at most once per run"""
+        return self._lookup(("head", url), lambda: self._probe_url(url))
+
+    def _probe_url(self, url: str) -> UrlMetadata:
+        cached = self._url_cache.fresh(url)
+        if cached is not None:
+            return cached
+        previous = self._url_cache.get(url)
+        headers = {}
+        if previous is not None and previous.etag:
+            headers["If-None-Match"] = previous.etag
+        elif previous is not None and previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+        response = self._http.head(
+            url, allow_redirects=True, timeout=REQUESTS_TIMEOUT, headers=headers
+        )
+        if previous is not None and response.status_code == 304:
+            metadata = UrlMetadata(**dict(previous.to_dict(), fetched_at=None))
+        else:
+            metadata = UrlMetadata.from_response(url, response)
+        self._url_cache.put(metadata)
+        return metadata
+
+    def _lookup(self, key: tuple, lookup: typing.Callable[[], typing.Any]):
+        """Run an upstream lookup, once for all clouds of a multi-cloud run"""
+        if self._upstream is None:
+            return lookup()
+        return self._upstream.get(key, lookup)
+
+    def manage(self) -> None:
+        """Process all image definitions and clean up the outdated images"""
+        self._import_history = ImportHistory(self._state_path("import-history"))
+        self._download_history = DownloadHistory(self._state_path("download-history"))
+        if self.CONF.dry_run:
+            self._plan = Plan(self.CONF.cloud)
+        images = self.read_image_files()
+        managed_images = self.process_images(images)
+
+        # ignore all non-specified images when using --filter
+        if self.CONF.filter:
+            cloud_images = self.get_images()
+            managed_images.update(
+                set(cloud_images) - cloud_images.search(self.CONF.filter)
+            )
+
+        if self.CONF.check_age:
+            self.check_image_age()
+
+        if self.exit_with_error:
+            # an image that failed to process is missing from
+            # managed_images and would be treated as a removal candidate
+            logger.error(
+                "Skipping cleanup of outdated images because of previous errors"
+            )
+        else:
+            self.manage_outdated_images(managed_images)
+
+        self.finish_replications()
+        self.save_catalog_snapshot()
+        self._import_history.save()
+        self._download_history.save()
+        if self.CONF.dry_run:
+            self.report_plan()
+
+    def process_images(self, images) -> set:
+        """Process each image from images.yaml
+
+        With --parallel N, up to N image definitions are processed
+        concurrently. The versions of one definition, including the renames
+        of a multi image, are always handled in order by the same worker.
+        The imports of all workers are awaited by one shared ImportWatcher.
+
+        With --two-phase, all required web-download imports are submitted to
+        Glance first, so Glance downloads and converts them side by side. The
+        definitions are then processed by up to --parallel workers, which
+        rename the images and set their properties as each import becomes
+        active. With --prefetch always, the submitted images go through a
+        PrefetchPipeline that downloads one image while it stages the
+        previous one.
+        """
+        managed_images: Set[str] = set()
+        two_phase = self.CONF.two_phase and not self.CONF.dry_run
+        # upstream lookups are done once per run
+        if self._upstream is None:
+            self._upstream = UpstreamMemo()
+        self.preflight(images)
+
+        if self.CONF.parallel > 1 or two_phase:
+            self._watcher = ImportWatcher(self.image_proxy)
+            self._watcher.start()
+            try:
+                if two_phase:
+                    self._submit_imports(images)
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.CONF.parallel
+                ) as executor:
+                    for existing_images in executor.map(
+                        self._process_definition, images
+                    ):
+                        managed_images = managed_images.union(existing_images)
+            finally:
+                if self._pipeline is not None:
+                    self._pipeline.stop()
+                    self._pipeline = None
+                self._watcher.stop()
+                self._watcher = None
+                self._discard_submitted()
+        else:
+            for image in images:
+                existing_images = self._process_definition(image)
+                managed_images = managed_images.union(existing_images)
+
+        return managed_images
+
+    def preflight(self, images) -> None:
+        """
+        Probe the URLs of all versions that will be imported, concurrently
+
+        The results are kept in the upstream memo, so process_image() tests
+        every URL without a request of its own. Unreachable URLs are reported
+        up front; process_image() still skips their versions with an error.
+        """
+        urls = self._preflight_urls(images)
+        if not urls:
+            return
+        if self._upstream is None:
+            self._upstream = UpstreamMemo()
 
-            if self.CONF.share_type == "project":
-                domain = self.conn.get_domain(name_or_id=self.CONF.share_domain)
-                project = self.conn.get_project(
-                    self.CONF.share_target, domain_id=domain.id
-                )
+        hosts: Dict[str, threading.Semaphore] = {}
+        for url in urls:
+            host = urllib.parse.urlparse(url).netloc
+            hosts.setdefault(host, threading.Semaphore(PREFLIGHT_HOST_CONNECTIONS))
 
-                if self.CONF.share_action == "add":
-                    self.share_image_with_project(image, project)
-                elif self.CONF.share_action == "del":
-                    self.unshare_image_with_project(image, project)
+        def probe(url: str) -> typing.Optional[str]:
+            with hosts[urllib.parse.urlparse(url).netloc]:
+                try:
+                    status = self._probe(url).status
+                except requests.RequestException as e:
+                    return str(e)
+            return None if status in [200, 302] else f"HTTP {status}"
+
+        logger.info(f"Preflight: testing {len(urls)} URLs")
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(PREFLIGHT_WORKERS, len(urls))
+        ) as executor:
+            failures = [
+                (url, error)
+                for url, error in zip(urls, executor.map(probe, urls))
+                if error is not None
+            ]
+        for url, error in failures:
+            logger.warning(f"Preflight: {url} is not reachable: {error}")
+        if failures:
+            logger.warning(f"Preflight: {len(failures)} of {len(urls)} URLs failed")
+
+    def _preflight_urls(self, images) -> typing.List[str]:
+        """URLs of the versions missing in the cloud, in the order of the imports"""
+        cloud_images = self.get_images()
+        urls: typing.List[str] = []
+        for image in images:
+            separator = image.get("separator", " ")
+            # the versions are imported in natural order, see process_image()
+            versions = natsorted(
+                image.get("versions", []), key=lambda x: str(x.get("version"))
+            )
+            if image.get("multi") and self.CONF.latest:
+                versions = versions[-1:]
+            for index, version in enumerate(versions):
+                tag = str(version.get("version"))
+                if image.get("multi"):
+                    name = f"{image['name']}{separator}({tag})"
+                else:
+                    name = f"{image['name']}{separator}{tag}"
+                if name in cloud_images:
+                    continue
+                current = cloud_images.get(image["name"])
+                if tag == "latest" and current is not None:
+                    # imported again only when the upstream checksum changed
+                    continue
+                if (
+                    image.get("multi")
+                    and index == len(versions) - 1
+                    and current is not None
+                    and _image_property(current, "internal_version") == tag
+                ):
+                    continue
+                url = version.get("mirror_url", version.get("url"))
+                if url and urllib.parse.urlparse(url).scheme in ("http", "https"):
+                    if url not in urls:
+                        urls.append(url)
+        return urls
 
-            elif self.CONF.share_type == "domain":
-                domain = self.conn.get_domain(name_or_id=self.CONF.share_target)
-                projects = self.conn.list_projects(domain_id=domain.id)
-                for project in projects:
-                    if self.CONF.share_action == "add":
-                        self.share_image_with_project(image, project)
-                    elif self.CONF.share_action == "del":
-                        self.unshare_image_with_project(image, project)
+    def _submit_imports(self, images) -> None:
+        """
+        Submit phase of --two-phase
 
-        # manage images
+        Runs through the image definitions without waiting for imports:
+        import_image() only creates the images and starts their web-download
+        imports, which the ImportWatcher tracks from then on. Existing images
+        that are not active yet are awaited in the collect phase.
+        """
+        logger.info("Submitting all required web-download imports")
+        self._submitting = True
+        try:
+            for image in images:
+                # the definitions are processed once more in the collect phase
+                self._process_definition(copy.deepcopy(image))
+        finally:
+            self._submitting = False
+        logger.info(f"Submitted {len(self._submitted)} imports, collecting them")
+
+    def _process_definition(self, image: dict) -> Set[str]:
+        """Process one image definition and return the names of its managed images"""
+        log_context: typing.ContextManager
+        if self._watcher is not None and not self._submitting:
+            # prefix the log lines of this worker with the image name
+            log_context = logger.contextualize(
+                context=f"{self._log_prefix}[{image['name']}] "
+            )
         else:
-            self.create_connection()
-            images = self.read_image_files()
-            managed_images = self.process_images(images)
-
-            # ignore all non-specified images when using --filter
-            if self.CONF.filter:
-                cloud_images = self.get_images()
-                for image in cloud_images:
-                    if not re.search(self.CONF.filter, image):
-                        managed_images.add(image)
-
-            if self.CONF.check_age:
-                self.check_image_age()
-
-            if self.exit_with_error:
-                # an image that failed to process is missing from
-                # managed_images and would be treated as a removal candidate
-                logger.error(
-                    "Skipping cleanup of outdated images because of previous errors"
-                )
-            else:
-                self.manage_outdated_images(managed_images)
+            log_context = contextlib.nullcontext()
 
-        if self.exit_with_error:
-            sys.exit(
-                "\nERROR: One or more errors occurred during the execution of the program, "
-                "please check the output."
+        with log_context:
+            prepared = self._prepare_definition(image)
+            if prepared is None:
+                return set()
+            versions, sorted_versions = prepared
+
+            existing_images, imported_image, previous_image = self.process_image(
+                image, versions, sorted_versions, image["meta"].copy()
             )
 
-    def process_images(self, images) -> set:
-        """Process each image from images.yaml"""
+            if imported_image and image["multi"]:
+                self.rename_images(
+                    image, sorted_versions, imported_image, previous_image
+                )
+
+        return existing_images
+
+    def _prepare_definition(self, image: dict) -> typing.Optional[tuple]:
+        """
+        Validate an image definition and build its versions dict
+
+        Also adds the managed and os: tags as well as the default
+        image_description and image_name properties to the definition.
 
+        Returns:
+            Tuple with (versions, sorted_versions), or None when the definition is invalid
+        """
         REQUIRED_KEYS = [
             "format",
             "name",
@@ -386,114 +2575,96 @@ class ImageManager:
             "versions",
             "visibility",
         ]
-        managed_images: Set[str] = set()
-
-        for image in images:
-            for required_key in REQUIRED_KEYS:
-                if required_key not in image:
-                    logger.error(
-                        f"'{image['name']}' lacks the necessary key {required_key}"
-                    )
-                    self.exit_with_error = True
-                    continue
 
-            logger.debug(f"Processing '{image['name']}'")
+        for required_key in REQUIRED_KEYS:
+            if required_key not in image:
+                logger.error(
+                    f"'{image['name']}' lacks the necessary key {required_key}"
+                )
+                self.exit_with_error = True
+                continue
 
-            try:
-                versions = dict()
-                for version in image["versions"]:
-                    versions[str(version["version"])] = {"url": version["url"]}
+        logger.debug(f"Processing '{image['name']}'")
 
-                    if "mirror_url" in version:
-                        versions[version["version"]]["mirror_url"] = version[
-                            "mirror_url"
-                        ]
+        try:
+            versions = dict()
+            for version in image["versions"]:
+                versions[str(version["version"])] = {"url": version["url"]}
 
-                    if "visibility" in version:
-                        versions[version["version"]]["visibility"] = version[
-                            "visibility"
-                        ]
+                if "mirror_url" in version:
+                    versions[version["version"]]["mirror_url"] = version["mirror_url"]
 
-                    if "os_version" in version:
-                        versions[version["version"]]["os_version"] = version[
-                            "os_version"
-                        ]
+                if "visibility" in version:
+                    versions[version["version"]]["visibility"] = version["visibility"]
 
-                    if "hidden" in version:
-                        versions[version["version"]]["hidden"] = version["hidden"]
+                if "os_version" in version:
+                    versions[version["version"]]["os_version"] = version["os_version"]
 
-                    if "checksum" in version:
-                        versions[version["version"]]["checksum"] = version["checksum"]
+                if "hidden" in version:
+                    versions[version["version"]]["hidden"] = version["hidden"]
 
-                    if version["version"] == "latest":  #
-                        if "checksums_url" in version and "checksum_url" in version:
-                            raise ValueError(
-                                'You may only specify either "checksums_url" or "checksum_url", not both'
-                            )
-                        if "checksums_url" in version:
-                            versions[version["version"]]["checksums_url"] = version[
-                                "checksums_url"
-                            ]
-                        elif "checksum_url" in version:
-                            versions[version["version"]]["checksum_url"] = version[
-                                "checksum_url"
-                            ]
-                        else:
-                            raise ValueError(
-                                'Key "checksums_url" or "checksum_url" is required when using version "latest"'
-                            )
+                if "checksum" in version:
+                    versions[version["version"]]["checksum"] = version["checksum"]
 
-                    if "meta" in version:
-                        versions[version["version"]]["meta"] = version["meta"]
+                if version["version"] == "latest":  #
+                    if "checksums_url" in version and "checksum_url" in version:
+                        raise ValueError(
+                            'You may only specify either "checksums_url" or "checksum_url", not both'
+                        )
+                    if "checksums_url" in version:
+                        versions[version["version"]]["checksums_url"] = version[
+                            "checksums_url"
+                        ]
+                    elif "checksum_url" in version:
+                        versions[version["version"]]["checksum_url"] = version[
+                            "checksum_url"
+                        ]
                     else:
-                        versions[version["version"]]["meta"] = {}
-
-                    if "url" in version:
-                        url = version["url"]
-                        # strip any directory path for file: urls in order to
-                        # avoid exposing local filesystem details to other users
-                        if url.startswith("file:") and "/" in url:
-                            urlfile = url.rsplit("/", 1)[1]
-                            url = f"file:{urlfile}"
-                        versions[version["version"]]["meta"]["image_source"] = url
-
-                    if "build_date" in version:
-                        versions[version["version"]]["meta"]["image_build_date"] = (
-                            date.isoformat(version["build_date"])
+                        raise ValueError(
+                            'Key "checksums_url" or "checksum_url" is required when using version "latest"'
                         )
 
-                    if "id" in version:
-                        versions[version["version"]]["id"] = version["id"]
-            except ValueError as e:
-                logger.error(str(e))
-                continue
-            except Exception as e:
-                logger.error(f"An unexpected error occurred: {e}")
-                continue
-
-            sorted_versions = natsorted(versions.keys())
-            image["tags"].append(self.CONF.tag)
+                if "meta" in version:
+                    versions[version["version"]]["meta"] = version["meta"]
+                else:
+                    versions[version["version"]]["meta"] = {}
+
+                if "url" in version:
+                    url = version["url"]
+                    # strip any directory path for file: urls in order to
+                    # avoid exposing local filesystem details to other users
+                    if url.startswith("file:") and "/" in url:
+                        urlfile = url.rsplit("/", 1)[1]
+                        url = f"file:{urlfile}"
+                    versions[version["version"]]["meta"]["image_source"] = url
+
+                if "build_date" in version:
+                    versions[version["version"]]["meta"]["image_build_date"] = (
+                        date.isoformat(version["build_date"])
+                    )
 
-            if "os_distro" in image["meta"]:
-                image["tags"].append(f"os:{image['meta']['os_distro']}")
+                if "id" in version:
+                    versions[version["version"]]["id"] = version["id"]
+        except ValueError as e:
+            logger.error(str(e))
+            return None
+        except Exception as e:
+            logger.error(f"An unexpected error occurred: {e}")
+            return None
 
-            if "image_description" not in image["meta"]:
-                image["meta"]["image_description"] = image["name"]
+        sorted_versions = natsorted(versions.keys())
+        image["tags"].append(self.CONF.tag)
 
-            if "image_name" not in image["meta"]:
-                image["meta"]["image_name"] = image["name"]
+        if "os_distro" in image["meta"]:
+            image["tags"].append(f"os:{image['meta']['os_distro']}")
 
-            existing_images, imported_image, previous_image = self.process_image(
-                image, versions, sorted_versions, image["meta"].copy()
-            )
-            managed_images = managed_images.union(existing_images)
+        if "image_description" not in image["meta"]:
+            image["meta"]["image_description"] = image["name"]
 
-            if imported_image and image["multi"]:
-                self.rename_images(
-                    image, sorted_versions, imported_image, previous_image
-                )
+        if "image_name" not in image["meta"]:
+            image["meta"]["image_name"] = image["name"]
 
-        return managed_images
+        return versions, sorted_versions
 
     def import_image(
         self,
@@ -515,9 +2686,6 @@ class ImageManager:
             version: currently processed version
             checksum: optional 'sha256:<hex>' digest, used to verify a prefetch
         """
-        logger.info(f"Importing image {name}")
-        logger.info(f"Importing from URL {url}")
-
         properties = {
             "container_format": "bare",
             "disk_format": image["format"],
@@ -529,10 +2697,25 @@ class ImageManager:
         }
         if "id" in versions[version]:
             properties["id"] = versions[version]["id"]
+        stores = self._store_args(image)
 
         new_image: typing.Optional[Image] = None
 
         parsed_url = urllib.parse.urlparse(url)
+        if self._submitting:
+            # local files and streamed prefetches are imported in the
+            # collect phase
+            if parsed_url.scheme == "file":
+                pass
+            elif self.CONF.prefetch != "always":
+                self._submit_import(properties, name, url, stores)
+            elif not self.CONF.prefetch_stream:
+                self._submit_prefetch(properties, name, url, checksum, stores)
+            return None
+
+        logger.info(f"Importing image {name}")
+        logger.info(f"Importing from URL {url}")
+
         if parsed_url.scheme == "file":
             new_image = self.image_proxy.create_image(**properties)
             try:
@@ -541,6 +2724,7 @@ class ImageManager:
                     new_image,
                     parsed_url.path,
                     time.monotonic() + self.CONF.import_timeout,
+                    stores,
                 )
             except Exception as e:
                 self.image_proxy.delete_image(new_image)
@@ -553,11 +2737,24 @@ class ImageManager:
             return result
 
         deadline = time.monotonic() + self.CONF.import_timeout
-        fallback_reserve = 900.0  # seconds kept for aria2 + staging + glance-direct
+        # seconds kept for aria2 + staging + glance-direct
+        fallback_reserve = self._prefetch_reserve(url)
+
+        pending = self._submitted.pop(name, None)
+        if pending is not None:
+            result = self._collect_import(pending)
+            if result is not None:
+                return result
+            if pending.method == "prefetch":
+                self.exit_with_error = True
+                return None
+            logger.warning(f"Submitted import of image {name} failed, importing again")
 
         # prefetch=always: skip web-download entirely
         if self.CONF.prefetch == "always":
-            return self._prefetch_import(properties, name, url, checksum, deadline)
+            return self._prefetch_import(
+                properties, name, url, checksum, deadline, stores
+            )
 
         # Web-download import with retry logic for stuck images
         max_attempts = self.CONF.stuck_retry + 1
@@ -578,8 +2775,13 @@ class ImageManager:
             new_image = None
             try:
                 new_image = self.image_proxy.create_image(**properties)
-                self.image_proxy.import_image(new_image, method="web-download", uri=url)
-                result = self.wait_for_image(new_image, wd_deadline)
+                self._start_import(new_image, "web-download", stores, uri=url)
+                result = self.wait_for_image(
+                    new_image,
+                    wd_deadline,
+                    method="web-download",
+                    size=self._upstream_sizes.get(url),
+                )
             except Exception as e:
                 logger.error(f"Web-download import for image {name} failed\n{e}")
                 result = None
@@ -607,64 +2809,392 @@ class ImageManager:
                     self.image_proxy.delete_image(new_image)
                 except Exception as e:
                     logger.error(f"Failed to delete leftover image {name}\n{e}")
-            return self._prefetch_import(properties, name, url, checksum, deadline)
+            return self._prefetch_import(
+                properties, name, url, checksum, deadline, stores
+            )
+
+        # All retry attempts exhausted
+        self.exit_with_error = True
+        return None
+
+    def _store_args(self, image: dict) -> dict:
+        """
+        import_image() arguments for the Glance stores of an image
+
+        The stores or all_stores keys of the definition take precedence over
+        --stores and --all-stores. A multi-store import does not fail as a
+        whole when a single store fails; process_image() reports the failed
+        stores instead.
+        """
+        if image.get("all_stores", self.CONF.all_stores) and not image.get("stores"):
+            return {"all_stores": True, "all_stores_must_succeed": False}
+        stores = image.get("stores")
+        if stores is None and self.CONF.stores:
+            stores = [x.strip() for x in self.CONF.stores.split(",") if x.strip()]
+        if stores:
+            return {"stores": list(stores), "all_stores_must_succeed": False}
+        return {}
+
+    def _start_import(
+        self,
+        new_image: Image,
+        method: str,
+        stores: typing.Optional[dict] = None,
+        **kwargs,
+    ) -> None:
+        """Start the import of an image into the stores given by _store_args()"""
+        self.image_proxy.import_image(
+            new_image, method=method, **kwargs, **(stores or {})
+        )
+
+    def _submit_import(
+        self,
+        properties: dict,
+        name: str,
+        url: str,
+        stores: typing.Optional[dict] = None,
+    ) -> None:
+        """Create an image and start its web-download import without waiting"""
+        logger.info(f"Submitting import of image {name} from URL {url}")
+        new_image = None
+        try:
+            new_image = self.image_proxy.create_image(**properties)
+            self._start_import(new_image, "web-download", stores, uri=url)
+        except Exception as e:
+            # import_image() of the collect phase imports the image once more
+            logger.warning(f"Submitting the import of image {name} failed\n{e}")
+            if new_image is not None:
+                try:
+                    self.image_proxy.delete_image(new_image)
+                except Exception as e:
+                    logger.error(f"Failed to delete image {name}\n{e}")
+            return
+
+        started = time.monotonic()
+        size = self._upstream_sizes.get(url)
+        watcher = typing.cast(ImportWatcher, self._watcher)  # see process_images()
+        future = watcher.watch(
+            new_image,
+            started + self.CONF.import_timeout,
+            self._import_history.predict("web-download", size),
+        )
+        self._submitted[name] = _PendingImport(
+            "web-download", future, started, image=new_image, size=size
+        )
+
+    def _submit_prefetch(
+        self,
+        properties: dict,
+        name: str,
+        url: str,
+        checksum: typing.Optional[str],
+        stores: typing.Optional[dict] = None,
+    ) -> None:
+        """Queue an image for download and staging in the PrefetchPipeline"""
+        logger.info(f"Submitting prefetch of image {name} from URL {url}")
+        if self._pipeline is None:
+            self._pipeline = PrefetchPipeline(
+                self._pipeline_download, self._pipeline_stage
+            )
+            self._pipeline.start()
+        job = _PrefetchJob(properties, name, url, checksum, stores)
+        self._submitted[name] = _PendingImport(
+            "prefetch", self._pipeline.submit(job), time.monotonic()
+        )
+
+    def _pipeline_download(
+        self, job: _PrefetchJob, directory: str
+    ) -> typing.Optional[str]:
+        job.started = time.monotonic()
+        job.deadline = job.started + self.CONF.import_timeout
+        return self._prefetch_download(
+            job.name, job.url, job.checksum, job.deadline, directory
+        )
+
+    def _pipeline_stage(
+        self, job: _PrefetchJob
+    ) -> typing.Optional[concurrent.futures.Future]:
+        """Stage a downloaded image and hand its import to the ImportWatcher"""
+        if time.monotonic() > job.deadline:
+            logger.error(f"PREFETCH: deadline passed before staging '{job.name}'")
+            return None
+        new_image = None
+        try:
+            new_image = self.image_proxy.create_image(**job.properties)
+            self._start_glance_direct(new_image, typing.cast(str, job.path), job.stores)
+        except Exception as e:
+            logger.error(f"PREFETCH: glance-direct import failed for '{job.name}'\n{e}")
+            if new_image is not None:
+                try:
+                    self.image_proxy.delete_image(new_image)
+                except Exception as e:
+                    logger.error(f"Failed to delete image {job.name}\n{e}")
+            return None
+
+        size = os.path.getsize(typing.cast(str, job.path))
+        watcher = typing.cast(ImportWatcher, self._watcher)  # see process_images()
+        imported = watcher.watch(
+            new_image, job.deadline, self._import_history.predict("glance-direct", size)
+        )
+        imported.add_done_callback(
+            lambda x: self._pipeline_imported(job, new_image, size, x.result())
+        )
+        return imported
+
+    def _pipeline_imported(
+        self,
+        job: _PrefetchJob,
+        new_image: Image,
+        size: int,
+        result: typing.Optional[Image],
+    ) -> None:
+        if result is None:
+            logger.error(f"PREFETCH: glance-direct import failed for '{job.name}'")
+            try:
+                self.image_proxy.delete_image(new_image)
+            except Exception as e:
+                logger.error(f"Failed to delete image {job.name}\n{e}")
+            return
+        logger.info(f"PREFETCH: glance-direct import succeeded for '{job.name}'")
+        self._import_history.record("prefetch", size, time.monotonic() - job.started)
+
+    def _collect_import(self, pending: _PendingImport) -> typing.Optional[Image]:
+        """Wait for a submitted import; a failed image is deleted"""
+        result = pending.future.result()
+        if result is None:
+            if pending.image is not None:
+                try:
+                    self.image_proxy.delete_image(pending.image)
+                except Exception as e:
+                    logger.error(f"Failed to delete image {pending.image.name}\n{e}")
+            return None
+        self._cache_image(result)
+        if pending.size:
+            self._import_history.record(
+                "web-download", pending.size, time.monotonic() - pending.started
+            )
+        return result
+
+    def _discard_submitted(self) -> None:
+        """Delete submitted images that were not collected, e.g. after an error"""
+        for name, pending in list(self._submitted.items()):
+            image = pending.image
+            if image is None and pending.future.done():
+                image = pending.future.result()
+            if image is None:
+                continue
+            logger.warning(f"Deleting uncollected image {name}")
+            try:
+                self.image_proxy.delete_image(image)
+            except Exception as e:
+                logger.error(f"Failed to delete image {name}\n{e}")
+        self._submitted.clear()
+
+    def _prefetch_reserve(self, url: str) -> float:
+        """
+        Seconds of the import budget kept for the on-stuck prefetch fallback
+
+        Derived from the prefetch duration predicted by the import history
+        (with a 50% margin, at least 120 s and at most half of
+        --import-timeout); 900 s when there is no prediction.
+        """
+        predicted = self._import_history.predict(
+            "prefetch", self._upstream_sizes.get(url)
+        )
+        if predicted is None:
+            return 900.0
+        return min(max(predicted * 1.5, 120.0), self.CONF.import_timeout / 2)
+
+    def _prefetch_import(
+        self,
+        properties: dict,
+        name: str,
+        url: str,
+        checksum: typing.Optional[str],
+        deadline: float,
+        stores: typing.Optional[dict] = None,
+    ) -> typing.Union[Image, None]:
+        """Download url with aria2 and import the local file via glance-direct."""
+        if self.CONF.prefetch_stream:
+            return self._stream_import(
+                properties, name, url, checksum, deadline, stores
+            )
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = self._prefetch_download(name, url, checksum, deadline, tmp)
+            if dest is None:
+                self.exit_with_error = True
+                return None
+            if time.monotonic() > deadline:
+                logger.error(f"PREFETCH: deadline passed before staging '{name}'")
+                self.exit_with_error = True
+                return None
+            # create_image is inside the try so a failure (e.g. a fixed image id
+            # not yet freed by the earlier delete) fails cleanly instead of
+            # raising. The staging upload itself is a synchronous SDK call and
+            # is not bounded by the deadline; the import wait that follows is.
+            new_image = None
+            try:
+                new_image = self.image_proxy.create_image(**properties)
+                result = self._glance_direct_import(new_image, dest, deadline, stores)
+            except Exception as e:
+                logger.error(f"glance-direct import failed for {name}\n{e}")
+                result = None
+            if result is None:
+                logger.error(f"PREFETCH: glance-direct import failed for '{name}'")
+                if new_image is not None:
+                    try:
+                        self.image_proxy.delete_image(new_image)
+                    except Exception as e:
+                        logger.error(f"Failed to delete image {name}\n{e}")
+                self.exit_with_error = True
+                return None
+            logger.info(f"PREFETCH: glance-direct import succeeded for '{name}'")
+            try:
+                self._import_history.record(
+                    "prefetch", os.path.getsize(dest), time.monotonic() - started
+                )
+            except OSError:
+                pass
+            return result
+
+    def _stream_import(
+        self,
+        properties: dict,
+        name: str,
+        url: str,
+        checksum: typing.Optional[str],
+        deadline: float,
+        stores: typing.Optional[dict] = None,
+    ) -> typing.Union[Image, None]:
+        """Stream url into the glance-direct staging area and import it.
+
+        The response body is uploaded in chunks as it arrives, so neither
+        disk space nor memory proportional to the image size is needed. A
+        declared checksum is computed on the fly and verified before the
+        import starts; on a mismatch the image is deleted.
+        """
+        started = time.monotonic()
+        parsed = parse_checksum(checksum)
+        new_image = None
+        try:
+            with self._http.get(url, stream=True, timeout=REQUESTS_TIMEOUT) as response:
+                response.raise_for_status()
+                stream = _HashingStream(response, parsed[0] if parsed else None)
+                new_image = self.image_proxy.create_image(**properties)
+                logger.info(f"PREFETCH: streaming '{name}' into the staging area")
+                self.image_proxy.stage_image(new_image, data=stream)
+
+            if parsed and stream.hash is not None:
+                if stream.hash.hexdigest() != parsed[1].lower():
+                    raise ValueError(
+                        f"checksum mismatch: expected {parsed[1]}, "
+                        f"got {stream.hash.hexdigest()}"
+                    )
+            self._start_import(new_image, "glance-direct", stores)
+            result = self.wait_for_image(
+                new_image, deadline, method="glance-direct", size=stream.size
+            )
+        except Exception as e:
+            logger.error(f"PREFETCH: streaming import failed for '{name}'\n{e}")
+            result = None
+
+        if result is None:
+            if new_image is not None:
+                try:
+                    self.image_proxy.delete_image(new_image)
+                except Exception as e:
+                    logger.error(f"Failed to delete image {name}\n{e}")
+            self.exit_with_error = True
+            return None
+        logger.info(f"PREFETCH: streaming import succeeded for '{name}'")
+        self._import_history.record("prefetch", stream.size, time.monotonic() - started)
+        return result
+
+    def _prefetch_download(
+        self,
+        name: str,
+        url: str,
+        checksum: typing.Optional[str],
+        deadline: float,
+        directory: str,
+    ) -> typing.Optional[str]:
+        """Download url with aria2 into directory, return the file path or None
 
-        # All retry attempts exhausted
-        self.exit_with_error = True
-        return None
+        With --prefetch-cache, a cached image is returned without a download
+        and a new download is published to the cache.
+        """
+        cache = self._prefetch_cache
+        key = None
+        if cache is not None:
+            # the ETag only identifies images without a declared checksum
+            etag = None if parse_checksum(checksum) else self._upstream_etag(url)
+            key = cache.key(checksum, url, etag)
+        if cache is None or key is None:
+            return self._prefetch_fetch(name, url, checksum, deadline, directory)
+
+        # concurrent downloads of the same image, e.g. for several clouds,
+        # wait for the first one and use its result
+        with cache.lock(key):
+            cached = cache.get(key, checksum)
+            if cached is not None:
+                logger.info(f"PREFETCH: using cached download for '{name}'")
+                return cached
+            incoming = cache.incoming()
+            try:
+                dest = self._prefetch_fetch(name, url, checksum, deadline, incoming)
+                return None if dest is None else cache.put(key, dest)
+            finally:
+                shutil.rmtree(incoming, ignore_errors=True)
 
-    def _prefetch_import(
+    def _upstream_etag(self, url: str) -> typing.Optional[str]:
+        try:
+            metadata = self._probe(url)
+        except requests.RequestException as e:
+            logger.warning(f"Could not determine ETag of {url}: {e}")
+            return None
+        if metadata.final_status >= 400:
+            logger.warning(
+                f"Could not determine ETag of {url}: {metadata.final_status}"
+            )
+            return None
+        return metadata.etag
+
+    def _prefetch_fetch(
         self,
-        properties: dict,
         name: str,
         url: str,
         checksum: typing.Optional[str],
         deadline: float,
-    ) -> typing.Union[Image, None]:
-        """Download url with aria2 and import the local file via glance-direct."""
-        with tempfile.TemporaryDirectory() as tmp:
-            remaining = deadline - time.monotonic()
-            if remaining <= 0:
-                logger.error(f"PREFETCH: no time budget left for '{name}'")
-                self.exit_with_error = True
-                return None
-            dest = os.path.join(tmp, "image.dat")
-            if not self._has_space_for_download(url, tmp):
-                self.exit_with_error = True
-                return None
-            ok = self._download(url, dest, checksum, timeout=remaining)
+        directory: str,
+    ) -> typing.Optional[str]:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.error(f"PREFETCH: no time budget left for '{name}'")
+            return None
+        dest = os.path.join(directory, "image.dat")
+        if not self._has_space_for_download(url, directory):
+            return None
+        # an interrupted download stays in its partial directory and is
+        # resumed by the next attempt
+        partial = self._partials.path(url, checksum)
+        with self._partials.lock(partial):
+            ok = self._download(
+                url, os.path.join(partial, "image.dat"), checksum, timeout=remaining
+            )
             logger.info(
                 f"PREFETCH: aria2 download {'ok' if ok else 'failed'} for '{name}'"
             )
             if not ok:
-                self.exit_with_error = True
-                return None
-            if time.monotonic() > deadline:
-                logger.error(f"PREFETCH: deadline passed before staging '{name}'")
-                self.exit_with_error = True
+                self._partials.discard(partial)
                 return None
-            # create_image is inside the try so a failure (e.g. a fixed image id
-            # not yet freed by the earlier delete) fails cleanly instead of
-            # raising. The staging upload itself is a synchronous SDK call and
-            # is not bounded by the deadline; the import wait that follows is.
-            new_image = None
             try:
-                new_image = self.image_proxy.create_image(**properties)
-                result = self._glance_direct_import(new_image, dest, deadline)
-            except Exception as e:
-                logger.error(f"glance-direct import failed for {name}\n{e}")
-                result = None
-            if result is None:
-                logger.error(f"PREFETCH: glance-direct import failed for '{name}'")
-                if new_image is not None:
-                    try:
-                        self.image_proxy.delete_image(new_image)
-                    except Exception as e:
-                        logger.error(f"Failed to delete image {name}\n{e}")
-                self.exit_with_error = True
+                shutil.move(os.path.join(partial, "image.dat"), dest)
+            except OSError as e:
+                logger.error(f"PREFETCH: could not move the download of '{name}': {e}")
                 return None
-            logger.info(f"PREFETCH: glance-direct import succeeded for '{name}'")
-            return result
+            shutil.rmtree(partial, ignore_errors=True)
+        return dest
 
     def _has_space_for_download(self, url: str, directory: str) -> bool:
         """Best-effort preflight so a prefetch does not fill the manager disk.
@@ -675,11 +3205,12 @@ class ImageManager:
         real out-of-space error is still caught by _download()).
         """
         try:
-            resp = requests.head(url, timeout=REQUESTS_TIMEOUT, allow_redirects=True)
-            size = int(resp.headers.get("Content-Length", 0))
+            size = self._probe(url).size or 0
         except Exception as e:
             logger.warning(f"Could not determine size of {url}: {e}")
             return True
+        if size > 0:
+            self._upstream_sizes[url] = size
         if size <= 0:
             logger.warning(f"No Content-Length for {url}; skipping disk check")
             return True
@@ -706,13 +3237,60 @@ class ImageManager:
     ) -> bool:
         """Download url to dest with aria2c (robust retry/resume).
 
-        aria2c is a required runtime dependency of the OSISM manager image; if
-        absent, log an error and return False (a clean failure, not a silent
-        skip). timeout bounds the overall aria2c run in seconds.
+        aria2c is a runtime dependency of the OSISM manager image; if absent,
+        the built-in RangeDownloader is used instead. timeout bounds the
+        overall download in seconds.
+
+        The segmentation follows the image size and the throughput seen from
+        the host before (download_tuning). With --prefetch-mirrors the url of
+        a mirror_url is passed as alternative source. With --aria2-rpc the
+        download is submitted to the shared Aria2Daemon.
         """
+        sources = [url] + [x for x in self._download_mirrors.get(url, []) if x != url]
+        host = urllib.parse.urlparse(url).netloc
+        size = self._upstream_sizes.get(url)
+        split, connections, min_split_size = download_tuning(
+            size, self._download_history.throughput(host)
+        )
+        # the split is spread across all sources
+        split = min(split, connections * len(sources))
+
+        started = time.monotonic()
         if shutil.which("aria2c") is None:
-            logger.error("aria2c is not installed; cannot prefetch image")
-            return False
+            logger.info("aria2c is not installed, using the built-in downloader")
+            try:
+                metadata: typing.Optional[UrlMetadata] = self._probe(url)
+            except requests.RequestException:
+                metadata = None
+            ok = self._range_downloader.download(
+                sources, dest, checksum, timeout, split, min_split_size, metadata
+            )
+        elif self._aria2 is not None:
+            ok = self._aria2.download(
+                sources, dest, checksum, timeout, split, connections, min_split_size
+            )
+        else:
+            ok = self._aria2_run(
+                sources, dest, checksum, timeout, split, connections, min_split_size
+            )
+        if ok and size:
+            # throughput per connection, to tell fast hosts from busy mirrors
+            self._download_history.record(
+                host, size, (time.monotonic() - started) * connections
+            )
+        return ok
+
+    def _aria2_run(
+        self,
+        sources: typing.List[str],
+        dest: str,
+        checksum: typing.Optional[str],
+        timeout: typing.Optional[float],
+        split: int,
+        connections: int,
+        min_split_size: int,
+    ) -> bool:
+        url = sources[0]
         directory, filename = os.path.split(dest)
         cmd = [
             "aria2c",
@@ -720,9 +3298,9 @@ class ImageManager:
             "--retry-wait=10",
             "--timeout=60",
             "--connect-timeout=30",
-            "--max-connection-per-server=4",
-            "--split=4",
-            "--min-split-size=20M",
+            f"--max-connection-per-server={connections}",
+            f"--split={split}",
+            f"--min-split-size={min_split_size // 2**20}M",
             "--continue=true",
             "--allow-overwrite=true",
             "--auto-file-renaming=false",
@@ -732,7 +3310,7 @@ class ImageManager:
         aria2_checksum = checksum_to_aria2(checksum)
         if aria2_checksum:
             cmd.append(f"--checksum={aria2_checksum}")
-        cmd.append(url)
+        cmd.extend(sources)
         try:
             result = subprocess.run(cmd, check=False, timeout=timeout)
         except subprocess.TimeoutExpired:
@@ -747,51 +3325,296 @@ class ImageManager:
         return True
 
     def _glance_direct_import(
-        self, new_image: Image, local_path: str, deadline: float
+        self,
+        new_image: Image,
+        local_path: str,
+        deadline: float,
+        stores: typing.Optional[dict] = None,
     ) -> typing.Union[Image, None]:
         """Stage a local file and import it via the glance-direct method, which
         runs the same decompress/convert/store taskflow as web-download."""
+        self._start_glance_direct(new_image, local_path, stores)
+        try:
+            size: typing.Optional[int] = os.path.getsize(local_path)
+        except OSError:
+            size = None
+        return self.wait_for_image(
+            new_image, deadline, method="glance-direct", size=size
+        )
+
+    def _start_glance_direct(
+        self, new_image: Image, local_path: str, stores: typing.Optional[dict] = None
+    ) -> None:
+        """Upload a local file to the staging area and start its import"""
         self.image_proxy.stage_image(new_image, filename=local_path)
-        self.image_proxy.import_image(new_image, method="glance-direct")
-        return self.wait_for_image(new_image, deadline)
+        self._start_import(new_image, "glance-direct", stores)
+
+    def get_images(self) -> ImageCatalog:
+        """
+        Return the managed images of the cloud as an ImageCatalog
+
+        The catalog is listed from Glance once per run and then kept up to
+        date by the write-through helpers (_update_image(), _delete_image(), ...)
+        and by successful imports. Use refresh_images() to force a new listing.
+
+        Returns:
+            an ImageCatalog of openstack.image.v2.image.Image objects, keyed by name
+        """
+        with self._catalog_lock:
+            if self._cloud_images is None:
+                snapshot = self._load_catalog_snapshot()
+                if snapshot is None:
+                    self._cloud_images = self._list_images()
+                    self._catalog_listed_at = time.time()
+                else:
+                    self._cloud_images = self._sync_images(snapshot)
+        return self._cloud_images
+
+    def refresh_images(self) -> ImageCatalog:
+        """Drop the cached catalog and list the managed images again"""
+        self._cloud_images = self._list_images()
+        self._catalog_listed_at = time.time()
+        return self._cloud_images
+
+    def _state_path(self, kind: str, *keys: str) -> typing.Optional[str]:
+        """Path of a state file of this cloud below --cache-dir, if enabled"""
+        if not self.CONF.cache_dir:
+            return None
+        key = re.sub(r"[^A-Za-z0-9_.-]", "_", "-".join((self.CONF.cloud,) + keys))
+        return os.path.join(self.CONF.cache_dir, f"{kind}-{key}.json")
+
+    def _catalog_snapshot_path(self) -> typing.Optional[str]:
+        """
+        Path of the catalog snapshot for this cloud and tag, if enabled
+
+        The cloud name alone is "openstack" for all clouds configured by
+        OS_* variables, so the snapshot is also keyed by the auth URL, the
+        project and --use-os-hidden, which changes what is listed.
+        """
+        auth = getattr(self.conn, "auth", None) or {}
+        hidden = "hidden" if self.CONF.use_os_hidden else ""
+        scope = f"{auth.get('auth_url', '')}|{self.conn.current_project_id}|{hidden}"
+        digest = hashlib.blake2b(scope.encode(), digest_size=8).hexdigest()
+        return self._state_path("catalog", self.CONF.tag, digest)
+
+    def _load_catalog_snapshot(self) -> typing.Optional[dict]:
+        """Load the catalog snapshot written by a previous run
+
+        Returns None when snapshots are disabled, when there is no usable
+        snapshot or when it is older than --catalog-max-age.
+        """
+        path = self._catalog_snapshot_path()
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as fp:
+                snapshot = json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable catalog snapshot {path}: {e}")
+            return None
+        if time.time() - snapshot.get("listed_at", 0) > self.CONF.catalog_max_age:
+            logger.info(f"Catalog snapshot {path} is outdated, listing all images")
+            return None
+        return snapshot
 
-    def get_images(self) -> dict:
+    def _sync_images(self, snapshot: dict) -> ImageCatalog:
+        """
+        Rebuild the catalog from a snapshot and merge the changes since then
+
+        Images updated since the snapshot watermark are listed from Glance
+        regardless of the tag, so images untagged since then are dropped.
+        Glance cannot list deleted images, so the ids of the catalog are
+        checked against the ids of the managed images and the ones deleted
+        since then are dropped as well.
+        """
+        catalog = ImageCatalog(Image(**x) for x in snapshot["images"])
+        self._catalog_listed_at = snapshot["listed_at"]
+
+        watermark = snapshot.get("watermark")
+        if watermark:
+            logger.debug(f"Listing images updated since {watermark}")
+            project_id = self.conn.current_project_id
+            queries: typing.List[dict] = [
+                {"visibility": "public", "updated_at": f"gte:{watermark}"},
+                {"owner": project_id, "updated_at": f"gte:{watermark}"},
+            ]
+            for image in self._query_images(queries):
+                if self._is_managed(image, project_id):
+                    catalog.put(image)
+                elif catalog.discard(image.id) is not None:
+                    logger.info(f"Image '{image.name}' is no longer managed")
+
+        ids = self._list_image_ids()
+        for name in catalog:
+            if catalog[name].id not in ids:
+                logger.info(f"Image '{name}' was deleted meanwhile")
+                catalog.discard(catalog[name].id)
+        return catalog
+
+    def save_catalog_snapshot(self) -> None:
+        """Persist the cached catalog for the incremental sync of the next run"""
+        path = self._catalog_snapshot_path()
+        # the catalog of a dry run includes the planned changes
+        if path is None or self._cloud_images is None or self.CONF.dry_run:
+            return
+
+        images = [x.to_dict(computed=False) for x in self._cloud_images.values()]
+        snapshot = {
+            "listed_at": self._catalog_listed_at,
+            "watermark": max(
+                (x["updated_at"] for x in images if x.get("updated_at")),
+                default=None,
+            ),
+            "images": images,
+        }
+        try:
+            os.makedirs(self.CONF.cache_dir, exist_ok=True)
+            with open(f"{path}.tmp", "w") as fp:
+                json.dump(snapshot, fp)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"Could not write catalog snapshot {path}: {e}")
+
+    def _list_images(self, **filters) -> ImageCatalog:
         """
         Load all images from OpenStack and filter by the tag set by the --tag CLI option
 
+        The tag, owner and visibility predicates are sent to Glance as query
+        filters, so only managed images are transferred. Glance cannot OR two
+        filters, so public images and images owned by the current project are
+        listed separately (plus the hidden ones with --use-os-hidden) and the
+        listings are merged by image id in one pass.
+
+        Params:
+            filters: additional Glance query filters, e.g. updated_at
+
         Returns:
-            a dict containing all matching images as openstack.image.v2.image.Image objects
+            an ImageCatalog of all matching openstack.image.v2.image.Image objects
         """
-        result = {}
+        logger.debug("Listing images from Glance")
+        project_id = self.conn.current_project_id
 
-        for image in self.image_proxy.images():
-            if self.CONF.tag in image.tags and (
-                image.visibility == "public"
-                or image.owner == self.conn.current_project_id
-            ):
-                result[image.name] = image
+        queries: typing.List[dict] = [
+            {"tag": self.CONF.tag, "visibility": "public", **filters},
+            {"tag": self.CONF.tag, "owner": project_id, **filters},
+        ]
+        result = ImageCatalog()
+        for image in self._query_images(queries):
+            # the filters are applied by Glance already, this only guards
+            # against deployments that silently ignore one of them
+            if self._is_managed(image, project_id):
+                result.put(image)
                 logger.debug(f"Managed image '{image.name}' (tags = {image.tags})")
             else:
                 logger.debug(f"Unmanaged image '{image.name}' (tags = {image.tags})")
+        return result
+
+    def _list_image_ids(self) -> Set[str]:
+        """Return the ids of the managed images, without building a catalog"""
+        project_id = self.conn.current_project_id
+        queries: typing.List[dict] = [
+            {"tag": self.CONF.tag, "visibility": "public"},
+            {"tag": self.CONF.tag, "owner": project_id},
+        ]
+        return {
+            image.id
+            for image in self._query_images(queries)
+            if self._is_managed(image, project_id)
+        }
 
+    def _query_images(self, queries: typing.List[dict]) -> typing.Iterator[Image]:
+        """List the images of several Glance queries, each image once"""
         if self.CONF.use_os_hidden:
-            for image in self.image_proxy.images(**{"os_hidden": True}):
-                if self.CONF.tag in image.tags and (
-                    image.visibility == "public"
-                    or image.owner == self.conn.current_project_id
-                ):
-                    result[image.name] = image
-                    logger.debug(
-                        f"Managed hidden image '{image.name}' (tags = {image.tags})"
-                    )
-                else:
-                    logger.debug(
-                        f"Unmanaged hidden image '{image.name}' (tags = {image.tags})"
-                    )
-        return result
+            queries = queries + [dict(query, os_hidden=True) for query in queries]
+        seen: Set[str] = set()
+        for image in itertools.chain.from_iterable(
+            self.image_proxy.images(**query) for query in queries
+        ):
+            if image.id not in seen:
+                seen.add(image.id)
+                yield image
+
+    def _is_managed(self, image: Image, project_id: typing.Optional[str]) -> bool:
+        return self.CONF.tag in image.tags and (
+            image.visibility == "public" or image.owner == project_id
+        )
+
+    def _cache_image(self, image: Image) -> None:
+        """Write an image into the cached catalog, replacing any stale entry"""
+        if self._cloud_images is not None:
+            self._cloud_images.put(image)
+
+    def _cached_image(self, image_id: str) -> typing.Optional[Image]:
+        """Look up an image of the cached catalog by id"""
+        if self._cloud_images is None:
+            return None
+        return self._cloud_images.get_by_id(image_id)
+
+    def _planned(self, kind: str, image_id: str, **params) -> bool:
+        """With --dry-run, add a change to the plan instead of applying it"""
+        if not self.CONF.dry_run:
+            return False
+        if self._plan is None:
+            self._plan = Plan(self.CONF.cloud)
+        cached = self._cached_image(image_id)
+        self._plan.add(kind, image_id, cached.name if cached else image_id, params)
+        return True
+
+    def _image_gone(self, image_id: str) -> None:
+        """Drop an image deleted outside of this tool from the cached catalog"""
+        logger.warning(f"Image {image_id} was deleted meanwhile")
+        if self._cloud_images is not None:
+            self._cloud_images.discard(image_id)
+
+    def _update_image(self, image_id: str, **attrs) -> None:
+        """Update an image in Glance and in the cached catalog"""
+        if not self._planned("update", image_id, **attrs):
+            try:
+                self.image_proxy.update_image(image_id, **attrs)
+            except openstack.exceptions.NotFoundException:
+                self._image_gone(image_id)
+                return
+        if self._cloud_images is not None:
+            self._cloud_images.update(image_id, attrs)
+
+    def _deactivate_image(self, image_id: str) -> None:
+        """Deactivate an image in Glance and in the cached catalog"""
+        if not self._planned("deactivate", image_id):
+            try:
+                self.image_proxy.deactivate_image(image_id)
+            except openstack.exceptions.NotFoundException:
+                self._image_gone(image_id)
+                return
+        cached = self._cached_image(image_id)
+        if cached is not None:
+            cached.status = "deactivated"
+
+    def _reactivate_image(self, image_id: str) -> None:
+        """Reactivate an image in Glance and in the cached catalog"""
+        if not self._planned("reactivate", image_id):
+            try:
+                self.image_proxy.reactivate_image(image_id)
+            except openstack.exceptions.NotFoundException:
+                self._image_gone(image_id)
+                return
+        cached = self._cached_image(image_id)
+        if cached is not None:
+            cached.status = "active"
+
+    def _delete_image(self, image_id: str) -> None:
+        """Delete an image in Glance and drop it from the cached catalog"""
+        if not self._planned("delete", image_id):
+            with contextlib.suppress(openstack.exceptions.NotFoundException):
+                self.image_proxy.delete_image(image_id)
+        if self._cloud_images is not None:
+            self._cloud_images.discard(image_id)
 
     def wait_for_image(
-        self, image: Image, deadline: typing.Optional[float] = None
+        self,
+        image: Image,
+        deadline: typing.Optional[float] = None,
+        method: typing.Optional[str] = None,
+        size: typing.Optional[int] = None,
     ) -> typing.Union[Image, None]:
         """
         Wait for an imported image to reach "active" state.
@@ -803,9 +3626,29 @@ class ImageManager:
         deadline: a time.monotonic() timestamp bounding the overall wait. When
         None, it is computed from self.CONF.import_timeout so single callers
         stay bounded. import_image() passes one shared deadline across attempts.
+
+        While the workers of --parallel run, the wait is delegated to the
+        shared ImportWatcher instead of polling this image on its own.
+
+        method and size (in bytes) describe a running import. The import
+        history turns them into a predicted duration that spaces the status
+        checks (see import_poll_interval()), and the observed duration of a
+        successful import is added to the history.
         """
+        started = time.monotonic()
         if deadline is None:
-            deadline = time.monotonic() + getattr(self.CONF, "import_timeout", 1800)
+            deadline = started + getattr(self.CONF, "import_timeout", 1800)
+        predicted = self._import_history.predict(method, size)
+
+        if self._watcher is not None:
+            result = self._watcher.watch(image, deadline, predicted).result()
+            if result is not None:
+                self._cache_image(result)
+                if method and size:
+                    self._import_history.record(
+                        method, size, time.monotonic() - started
+                    )
+            return result
 
         retry_attempts_for_queued_state = 4
         consecutive_errors = 0
@@ -823,7 +3666,16 @@ class ImageManager:
                 # the background. We need to catch such cases where an image is
                 # indefinitely stuck in "queued" state.
                 status = imported_image.status
-                if status == "active":
+                # with several stores, the image is active once the first
+                # store completes and the remaining ones are still importing
+                if status == "active" and not _import_stores(
+                    imported_image, "os_glance_importing_to_stores"
+                ):
+                    self._cache_image(imported_image)
+                    if method and size:
+                        self._import_history.record(
+                            method, size, time.monotonic() - started
+                        )
                     return imported_image
                 if status == "queued":
                     if retry_attempts_for_queued_state < 0:
@@ -840,7 +3692,9 @@ class ImageManager:
                     return None
                 else:
                     logger.info("Waiting for import to complete...")
-                    time.sleep(10.0)
+                    time.sleep(
+                        import_poll_interval(time.monotonic() - started, predicted)
+                    )
             except Exception as e:
                 consecutive_errors += 1
                 logger.error(f"Exception while importing image {image.name}\n{e}")
@@ -887,7 +3741,13 @@ class ImageManager:
             logger.debug(f"Checking existence of '{name}'")
             existence = name in cloud_images
 
-            if existence and cloud_images[name].status != "active":
+            # the submit phase of --two-phase does not wait, the collect
+            # phase processes the definition again
+            if (
+                existence
+                and cloud_images[name].status != "active"
+                and not self._submitting
+            ):
                 if self.wait_for_image(cloud_images[name]) is None:
                     self.exit_with_error = True
 
@@ -898,18 +3758,19 @@ class ImageManager:
                 and not existence
             ):
                 existence = image["name"] in cloud_images
-                try:
-                    if existence:
-                        existence = (
-                            cloud_images[image["name"]]["properties"][
-                                "internal_version"
-                            ]
-                            == version
+                if existence:
+                    if (
+                        _image_property(cloud_images[image["name"]], "internal_version")
+                        is None
+                    ):
+                        logger.error(
+                            f"Image {image['name']} is missing property 'internal_version'"
+                        )
+                    else:
+                        existence = any(
+                            x.name == image["name"]
+                            for x in cloud_images.find("internal_version", version)
                         )
-                except KeyError:
-                    logger.error(
-                        f"Image {image['name']} is missing property 'internal_version'"
-                    )
 
             elif (
                 image["multi"]
@@ -951,21 +3812,17 @@ class ImageManager:
                     self.exit_with_error = True
                     return existing_images, imported_image, previous_image
 
-                try:
-                    image_checksum = (
-                        cloud_images[image["name"]]["properties"]["upstream_checksum"]
-                        if image["name"] in cloud_images
-                        else ""
-                    )
-                    if image_checksum == upstream_checksum:
-                        logger.info(f"No new version for '{image['name']}'")
-                        existing_images.add(image["name"])
-                        return existing_images, imported_image, previous_image
-                    else:
-                        logger.info(f"New version for '{image['name']}'")
-                        existence = False
-                except KeyError:
-                    # when switching from a release pointer to a latest pointer, the image has no checksum property
+                # when switching from a release pointer to a latest pointer,
+                # the image has no checksum property and counts as new version
+                if any(
+                    x.name == image["name"]
+                    for x in cloud_images.find("upstream_checksum", upstream_checksum)
+                ):
+                    logger.info(f"No new version for '{image['name']}'")
+                    existing_images.add(image["name"])
+                    return existing_images, imported_image, previous_image
+                else:
+                    logger.info(f"New version for '{image['name']}'")
                     existence = False
 
             if not existence and not (
@@ -976,6 +3833,8 @@ class ImageManager:
                 # use `mirror_url` for download if given, else fall back to `url`
                 # in any case, `url` will be used to set `image_source` property
                 url = versions[version].get("mirror_url", versions[version]["url"])
+                if self.CONF.prefetch_mirrors and url != versions[version]["url"]:
+                    self._download_mirrors[url] = [versions[version]["url"]]
                 parsed_url = urllib.parse.urlparse(url)
                 if parsed_url.scheme == "file":
                     file_path = parsed_url.path
@@ -986,14 +3845,16 @@ class ImageManager:
                         self.exit_with_error = True
                         return existing_images, imported_image, previous_image
                 else:
-                    r = requests.head(url)
+                    probed = self._probe(url)
 
-                    if r.status_code in [200, 302]:
-                        logger.info(f"Tested URL {url}: {r.status_code}")
+                    if probed.status in [200, 302]:
+                        logger.info(f"Tested URL {url}: {probed.status}")
+                        if probed.size:
+                            self._upstream_sizes[url] = probed.size
                     else:
-                        logger.error(f"Tested URL {url}: {r.status_code}")
+                        logger.error(f"Tested URL {url}: {probed.status}")
                         logger.error(
-                            f"Skipping '{name}' due to HTTP status code {r.status_code}"
+                            f"Skipping '{name}' due to HTTP status code {probed.status}"
                         )
                         self.exit_with_error = True
                         return existing_images, imported_image, previous_image
@@ -1011,15 +3872,30 @@ class ImageManager:
                         checksum=versions[version].get("checksum"),
                     )
                     if import_result:
-                        logger.info(
-                            f"Import of '{name}' successfully completed, reloading images"
+                        failed_stores = _import_stores(
+                            import_result, "os_glance_failed_import"
                         )
+                        if failed_stores:
+                            logger.error(
+                                f"Import of '{name}' into the stores {failed_stores} failed"
+                            )
+                            self.exit_with_error = True
+                        logger.info(f"Import of '{name}' successfully completed")
+                        if image.get("copy_to_stores"):
+                            self.replicate_image(import_result, image["copy_to_stores"])
                         cloud_images = self.get_images()
                         imported_image = cloud_images.get(name, None)
                 else:
                     logger.info(
                         f"Skipping required import of image '{name}', running in dry-run mode"
                     )
+                    if self._plan is not None:
+                        self._plan.add(
+                            "import",
+                            None,
+                            name,
+                            {"definition": image["name"], "urls": [url]},
+                        )
 
             elif self.CONF.latest and version != sorted_versions[-1]:
                 logger.info(
@@ -1035,8 +3911,78 @@ class ImageManager:
                 self.set_properties(
                     image.copy(), name, versions, version, upstream_checksum, meta
                 )
+            elif self.CONF.reconcile and existence:
+                # the latest version of a multi image carries the plain name
+                if (
+                    image["multi"]
+                    and name not in cloud_images
+                    and version == sorted_versions[-1]
+                ):
+                    current = image["name"]
+                else:
+                    current = name
+                self.set_properties(
+                    image.copy(), current, versions, version, upstream_checksum, meta
+                )
         return existing_images, imported_image, previous_image
 
+    def replicate_image(self, image: Image, stores: typing.List[str]) -> None:
+        """
+        Copy an active image into further Glance stores in the background
+
+        The copy-image import runs on the Glance side while the image stays
+        usable from the store it was imported to. The copies are tracked by a
+        separate ImportWatcher with --copy-timeout as deadline and collected
+        by finish_replications() at the end of the run.
+        """
+        present = _import_stores(image, "stores").split(",")
+        missing = [x for x in stores if x not in present]
+        if not missing:
+            return
+        logger.info(f"Copying image {image.name} to the stores {', '.join(missing)}")
+        try:
+            self._start_import(
+                image,
+                "copy-image",
+                {"stores": missing, "all_stores_must_succeed": False},
+            )
+        except Exception as e:
+            logger.error(f"Copying image {image.name} to other stores failed\n{e}")
+            self.exit_with_error = True
+            return
+
+        with self._replication_lock:
+            if self._replicator is None:
+                self._replicator = ImportWatcher(self.image_proxy)
+                self._replicator.start()
+            future = self._replicator.watch(
+                image, time.monotonic() + self.CONF.copy_timeout, stores=missing
+            )
+            self._replications.append((image, missing, future))
+
+    def finish_replications(self) -> None:
+        """Wait for the copies started by replicate_image() and report them"""
+        with self._replication_lock:
+            replications, self._replications = self._replications, []
+        if replications:
+            logger.info(f"Waiting for {len(replications)} copies to other stores")
+        for image, stores, future in replications:
+            result = future.result()
+            present = "" if result is None else _import_stores(result, "stores")
+            failed = ", ".join(x for x in stores if x not in present.split(","))
+            if failed:
+                logger.error(
+                    f"Copying image {image.name} to the stores {failed} failed"
+                )
+                self.exit_with_error = True
+            else:
+                logger.info(
+                    f"Copied image {image.name} to the stores {', '.join(stores)}"
+                )
+        if self._replicator is not None:
+            self._replicator.stop()
+            self._replicator = None
+
     def set_properties(
         self,
         image: dict,
@@ -1049,6 +3995,11 @@ class ImageManager:
         """
         Set image properties and tags based on the configuration from images.yml
 
+        All changed attributes, properties and tags of an image are applied
+        with a single update (one JSON-patch request), after the status
+        change. The update stores a fingerprint of the desired state in the
+        image; while it matches, the image is not checked again.
+
         Params:
             image: image dict from images.yml
             name: name of the image including the version string
@@ -1060,56 +4011,71 @@ class ImageManager:
         image["meta"] = meta.copy()
 
         if name in cloud_images:
-            logger.info(f"Checking parameters of '{name}'")
-
             cloud_image = cloud_images[name]
+            fingerprint = desired_state_fingerprint(
+                {
+                    "image": {
+                        k: image.get(k)
+                        for k in (
+                            "login",
+                            "min_disk",
+                            "min_ram",
+                            "multi",
+                            "status",
+                            "tags",
+                            "visibility",
+                        )
+                    },
+                    "meta": meta,
+                    "version": versions[version],
+                    "name": version,
+                    "upstream_checksum": upstream_checksum,
+                    "use_os_hidden": self.CONF.use_os_hidden,
+                }
+            )
+            if _image_property(cloud_image, FINGERPRINT_PROPERTY) == fingerprint:
+                logger.info(f"Parameters of '{name}' are up to date")
+                return
+
+            logger.info(f"Checking parameters of '{name}'")
             real_image_size = int(
                 Decimal(cloud_image.size / 2**30).quantize(
                     Decimal("1."), rounding=ROUND_UP
                 )
             )
 
-            if "min_disk" in image and image["min_disk"] != cloud_image.min_disk:
-                logger.info(
-                    f"Setting min_disk: {image['min_disk']} != {cloud_image.min_disk}"
-                )
-                self.image_proxy.update_image(
-                    cloud_image.id, **{"min_disk": int(image["min_disk"])}
-                )
+            # desired changes, applied with one update_image() at the end
+            changes: typing.Dict[str, typing.Any] = {}
 
-            if (
-                "min_disk" in image and real_image_size > image["min_disk"]
-            ) or "min_disk" not in image:
-                logger.info(f"Setting min_disk = {real_image_size}")
-                self.image_proxy.update_image(
-                    cloud_image.id, **{"min_disk": real_image_size}
-                )
+            if "min_disk" in image and real_image_size <= image["min_disk"]:
+                min_disk = int(image["min_disk"])
+            else:
+                min_disk = real_image_size
+            if min_disk != cloud_image.min_disk:
+                logger.info(f"Setting min_disk: {min_disk} != {cloud_image.min_disk}")
+                changes["min_disk"] = min_disk
 
             if "min_ram" in image and image["min_ram"] != cloud_image.min_ram:
                 logger.info(
                     f"Setting min_ram: {image['min_ram']} != {cloud_image.min_ram}"
                 )
-                self.image_proxy.update_image(
-                    cloud_image.id, **{"min_ram": int(image["min_ram"])}
-                )
+                changes["min_ram"] = int(image["min_ram"])
 
             if self.CONF.use_os_hidden:
                 if "hidden" in versions[version]:
-                    logger.info(f"Setting os_hidden = {versions[version]['hidden']}")
-                    self.image_proxy.update_image(
-                        cloud_image.id, **{"os_hidden": versions[version]["hidden"]}
-                    )
-
-                elif version != natsorted(versions.keys())[-1:]:
-                    logger.info("Setting os_hidden = True")
-                    self.image_proxy.update_image(cloud_image.id, **{"os_hidden": True})
+                    hidden = versions[version]["hidden"]
+                else:
+                    hidden = version != natsorted(versions.keys())[-1:]
+                if hidden != cloud_image.is_hidden:
+                    logger.info(f"Setting os_hidden = {hidden}")
+                    changes["os_hidden"] = hidden
 
             if version == "latest":
                 try:
                     url = versions[version]["url"]
-                    modify_date = requests.head(url, allow_redirects=True).headers[
-                        "Last-Modified"
-                    ]
+                    modify_date = self._probe(url).last_modified
+                    if modify_date is None:
+                        raise ValueError(f"{url} has no Last-Modified header")
 
                     date_format = "%a, %d %b %Y %H:%M:%S %Z"
                     modify_date = str(
@@ -1143,12 +4109,13 @@ class ImageManager:
             for tag in image["tags"]:
                 if tag not in cloud_image.tags:
                     logger.info(f"Adding tag {tag}")
-                    self.image_proxy.add_tag(cloud_image.id, tag)
 
             for tag in cloud_image.tags:
                 if tag not in image["tags"]:
                     logger.info(f"Deleting tag {tag}")
-                    self.image_proxy.remove_tag(cloud_image.id, tag)
+
+            if set(image["tags"]) != set(cloud_image.tags):
+                changes["tags"] = list(image["tags"])
 
             if "meta" in versions[version]:
                 for key in versions[version]["meta"].keys():
@@ -1157,13 +4124,11 @@ class ImageManager:
             properties = cloud_image.properties
             for property in properties:
                 if property in image["meta"]:
-                    if image["meta"][property] != properties[property]:
+                    if str(image["meta"][property]) != str(properties[property]):
                         logger.info(
                             f"Setting property {property}: {properties[property]} != {image['meta'][property]}"
                         )
-                        self.image_proxy.update_image(
-                            cloud_image.id, **{property: str(image["meta"][property])}
-                        )
+                        changes[property] = str(image["meta"][property])
 
                 elif property not in [
                     "self",
@@ -1173,14 +4138,28 @@ class ImageManager:
                     # FIXME: handle deletion of properties
                     logger.debug(f"Deleting property {property}")
 
+            # well-known properties like os_distro are image attributes
+            body_mapping = Image._body_mapping()
             for property in image["meta"]:
+                if property in body_mapping and str(image["meta"][property]) == str(
+                    getattr(cloud_image, body_mapping[property])
+                ):
+                    continue
                 if property not in properties:
                     logger.info(
                         f"Setting property {property}: {image['meta'][property]}"
                     )
-                    self.image_proxy.update_image(
-                        cloud_image.id, **{property: str(image["meta"][property])}
-                    )
+                    changes[property] = str(image["meta"][property])
+
+            logger.info(f"Checking visibility of '{name}'")
+            if "visibility" in versions[version]:
+                visibility = versions[version]["visibility"]
+            else:
+                visibility = image["visibility"]
+
+            if cloud_image.visibility != visibility:
+                logger.info(f"Setting visibility of '{name}' to '{visibility}'")
+                changes["visibility"] = visibility
 
             logger.info(f"Checking status of '{name}'")
             if (
@@ -1188,21 +4167,16 @@ class ImageManager:
                 and image["status"] == "deactivated"
             ):
                 logger.info(f"Deactivating image '{name}'")
-                self.image_proxy.deactivate_image(cloud_image.id)
+                self._deactivate_image(cloud_image.id)
 
             elif cloud_image.status != image["status"] and image["status"] == "active":
                 logger.info(f"Reactivating image '{name}'")
-                self.image_proxy.reactivate_image(cloud_image.id)
-
-            logger.info(f"Checking visibility of '{name}'")
-            if "visibility" in versions[version]:
-                visibility = versions[version]["visibility"]
-            else:
-                visibility = image["visibility"]
+                self._reactivate_image(cloud_image.id)
 
-            if cloud_image.visibility != visibility:
-                logger.info(f"Setting visibility of '{name}' to '{visibility}'")
-                self.image_proxy.update_image(cloud_image.id, visibility=visibility)
+            # the fingerprint is written last, so a failed change is retried
+            # by the next run
+            changes[FINGERPRINT_PROPERTY] = fingerprint
+            self._update_image(cloud_image.id, **changes)
 
     def rename_images(
         self,
@@ -1230,13 +4204,11 @@ class ImageManager:
 
             if name in cloud_images and previous_latest not in cloud_images:
                 logger.info(f"Renaming {name} to {previous_latest}")
-                self.image_proxy.update_image(
-                    cloud_images[name].id, name=previous_latest
-                )
+                self._update_image(cloud_images[name].id, name=previous_latest)
 
             if latest in cloud_images:
                 logger.info(f"Renaming {latest} to {name}")
-                self.image_proxy.update_image(cloud_images[latest].id, name=name)
+                self._update_image(cloud_images[latest].id, name=name)
 
         elif len(sorted_versions) == 1 and name in cloud_images:
             if previous_image["properties"]["internal_version"] == "latest":
@@ -1253,24 +4225,24 @@ class ImageManager:
                 logger.info(
                     f"Setting internal_version: {create_date} for {previous_latest}"
                 )
-                self.image_proxy.update_image(
+                self._update_image(
                     previous_image.id, **{"internal_version": create_date}
                 )
             else:
                 previous_latest = f"{name}{separator}({previous_image['properties']['internal_version']})"
 
             logger.info(f"Renaming old latest '{name}' to '{previous_latest}'")
-            self.image_proxy.update_image(previous_image.id, name=previous_latest)
+            self._update_image(previous_image.id, name=previous_latest)
 
             logger.info(f"Renaming imported image '{imported_image.name}' to '{name}'")
-            self.image_proxy.update_image(imported_image.id, name=name)
+            self._update_image(imported_image.id, name=name)
 
         elif len(sorted_versions) == 1:
             latest = f"{name}{separator}({sorted_versions[-1]})"
 
             if latest in cloud_images:
                 logger.info(f"Renaming {latest} to {name}")
-                self.image_proxy.update_image(cloud_images[latest].id, name=name)
+                self._update_image(cloud_images[latest].id, name=name)
 
     def check_image_age(self) -> set:
         """
@@ -1290,52 +4262,55 @@ class ImageManager:
 
         too_old_images = set()
 
-        for cloud_image_name, cloud_image in cloud_images.items():
-            image_name = cloud_image.properties["image_description"]
-
+        for image_name, cloud_image_names in cloud_images.groups().items():
             if image_name not in images:
                 logger.warning(
-                    f"No image definition found for '{image_name}', image will be ignored"
+                    f"No image definition found for '{image_name}', images will be ignored"
                 )
                 continue
 
             image_definition = images[image_name]
-
-            build_date_backend = date.fromisoformat(
-                cloud_image.properties["image_build_date"]
-            )
-
             if image_definition["multi"]:
-                build_date_definition_candidates = [
+                multi_build_dates = [
                     x["build_date"] for x in image_definition["versions"]
                 ]
-            else:
-                build_date_definition_candidates = []
-                for v in image_definition["versions"]:
-                    if v["version"] != cloud_image.os_version:
-                        continue
-                    build_date_definition_candidates.append(v["build_date"])
 
-            if len(build_date_definition_candidates) == 0:
-                logger.warning(
-                    f"No compatible version definition found for '{cloud_image_name}', image will be ignored"
+            for cloud_image_name in cloud_image_names:
+                cloud_image = cloud_images[cloud_image_name]
+
+                build_date_backend = date.fromisoformat(
+                    cloud_image.properties["image_build_date"]
                 )
-                continue
 
-            build_date_definition_candidates.sort(reverse=True)
-            build_date_definition = build_date_definition_candidates[0]
+                if image_definition["multi"]:
+                    build_date_definition_candidates = list(multi_build_dates)
+                else:
+                    build_date_definition_candidates = []
+                    for v in image_definition["versions"]:
+                        if v["version"] != cloud_image.os_version:
+                            continue
+                        build_date_definition_candidates.append(v["build_date"])
 
-            logger.info(
-                f"Image '{cloud_image_name}' was created on {str(build_date_backend)}"
-            )
+                if len(build_date_definition_candidates) == 0:
+                    logger.warning(
+                        f"No compatible version definition found for '{cloud_image_name}', image will be ignored"
+                    )
+                    continue
 
-            age_difference_days = (build_date_definition - build_date_backend).days
-            if age_difference_days > self.CONF.max_age:
-                logger.warning(
-                    f"Image '{cloud_image_name}' is {age_difference_days} days "
-                    f"older than the newest image in the definition"
+                build_date_definition_candidates.sort(reverse=True)
+                build_date_definition = build_date_definition_candidates[0]
+
+                logger.info(
+                    f"Image '{cloud_image_name}' was created on {str(build_date_backend)}"
                 )
-                too_old_images.add(cloud_image_name)
+
+                age_difference_days = (build_date_definition - build_date_backend).days
+                if age_difference_days > self.CONF.max_age:
+                    logger.warning(
+                        f"Image '{cloud_image_name}' is {age_difference_days} days "
+                        f"older than the newest image in the definition"
+                    )
+                    too_old_images.add(cloud_image_name)
 
         return too_old_images
 
@@ -1359,18 +4334,18 @@ class ImageManager:
 
         # NOTE: ensure to not handle images that should be not handled
         if self.CONF.filter:
-            unmanaged_images = natsorted(
-                [
-                    x
-                    for x in cloud_images
-                    if x not in managed_images and re.search(self.CONF.filter, x)
-                ],
-                reverse=True,
-            )
+            candidates = cloud_images.search(self.CONF.filter)
         else:
-            unmanaged_images = natsorted(
-                [x for x in cloud_images if x not in managed_images], reverse=True
-            )
+            candidates = set(cloud_images)
+
+        # the counter below relies on visiting the images of each
+        # image_description group from the newest to the oldest
+        unmanaged_images = [
+            x
+            for group in cloud_images.groups().values()
+            for x in reversed(group)
+            if x not in managed_images and x in candidates
+        ]
 
         counter: Dict[str, int] = {}
 
@@ -1409,26 +4384,20 @@ class ImageManager:
                     f"Image '{image}' will not be deleted, UUID validity is 'none'"
                 )
             elif counter[image_name] > last:
-                if (
-                    self.CONF.delete
-                    and self.CONF.yes_i_really_know_what_i_do
-                    and not self.CONF.dry_run
-                ):
+                if self.CONF.delete and self.CONF.yes_i_really_know_what_i_do:
                     try:
                         logger.info(f"Deactivating image '{image}'")
-                        self.image_proxy.deactivate_image(cloud_image.id)
+                        self._deactivate_image(cloud_image.id)
 
                         logger.info(f"Setting visibility of '{image}' to 'community'")
-                        self.image_proxy.update_image(
-                            cloud_image.id, visibility="community"
-                        )
+                        self._update_image(cloud_image.id, visibility="community")
 
                         if (
                             "keep" not in image_definition
                             or not image_definition["keep"]
                         ):
                             logger.info(f"Deleting {image}")
-                            self.image_proxy.delete_image(cloud_image.id)
+                            self._delete_image(cloud_image.id)
                         else:
                             logger.info(
                                 f"Image '{image}' will not be deleted, because 'keep' flag is True"
@@ -1443,21 +4412,15 @@ class ImageManager:
                         f"Image {image} should be deleted, but deletion is disabled"
                     )
                     try:
-                        if self.CONF.deactivate and not self.CONF.dry_run:
+                        if self.CONF.deactivate:
                             logger.info(f"Deactivating image '{image}'")
-                            self.image_proxy.deactivate_image(cloud_image.id)
+                            self._deactivate_image(cloud_image.id)
 
-                        if (
-                            self.CONF.hide
-                            and not self.CONF.dry_run
-                            and cloud_image.visibility != "community"
-                        ):
+                        if self.CONF.hide and cloud_image.visibility != "community":
                             logger.info(
                                 f"Setting visibility of '{image}' to 'community'"
                             )
-                            self.image_proxy.update_image(
-                                cloud_image.id, visibility="community"
-                            )
+                            self._update_image(cloud_image.id, visibility="community")
                     except Exception as e:
                         logger.error(f"An Exception occurred: \n{e}")
                         self.exit_with_error = True
@@ -1465,20 +4428,12 @@ class ImageManager:
                 logger.info(
                     f"Image '{image}' will not be deleted, {counter[image_name]} <= {last}"
                 )
-                if (
-                    self.CONF.hide
-                    and not self.CONF.dry_run
-                    and cloud_image.visibility != "community"
-                ):
+                if self.CONF.hide and cloud_image.visibility != "community":
                     logger.info(f"Setting visibility of '{image}' to 'community'")
-                    self.image_proxy.update_image(
-                        cloud_image.id, visibility="community"
-                    )
-            elif (
-                counter[image_name] < last and self.CONF.hide and not self.CONF.dry_run
-            ):
+                    self._update_image(cloud_image.id, visibility="community")
+            elif counter[image_name] < last and self.CONF.hide:
                 logger.info(f"Setting visibility of '{image}' to 'community'")
-                self.image_proxy.update_image(cloud_image.id, visibility="community")
+                self._update_image(cloud_image.id, visibility="community")
         return unmanaged_images
 
     def validate_yaml_schema(self):
@@ -1529,21 +4484,88 @@ class ImageManager:
 
         if not member:
             logger.info(f"add - {image.name} - {project.name} ({project.domain_id})")
-            if not self.CONF.dry_run:
-                member = self.image_proxy.add_member(image.id, member_id=project.id)
-
-        if not self.CONF.dry_run and member.status != "accepted":
+        elif member.status != "accepted":
             logger.info(f"accept - {image.name} - {project.name} ({project.domain_id})")
-            self.image_proxy.update_member(member, image.id, status="accepted")
+        else:
+            return
+
+        if not self._planned("share", image.id, project_id=project.id):
+            self._share_image(image.id, project.id, member)
 
     def unshare_image_with_project(self, image, project):
         member = self.image_proxy.find_member(project.id, image.id)
 
         if member:
             logger.info(f"del - {image.name} - {project.name} ({project.domain_id})")
-            if not self.CONF.dry_run:
+            if not self._planned("unshare", image.id, project_id=project.id):
                 self.image_proxy.remove_member(member, image.id)
 
+    def _share_image(self, image_id: str, project_id: str, member=None) -> None:
+        """Add a project as accepted member of an image"""
+        if member is None:
+            member = self.image_proxy.find_member(project_id, image_id)
+        if not member:
+            member = self.image_proxy.add_member(image_id, member_id=project_id)
+        if member.status != "accepted":
+            self.image_proxy.update_member(member, image_id, status="accepted")
+
+    def apply_plan(self, plan: Plan) -> None:
+        """Apply a plan written by a dry run with --plan-file"""
+        definitions = {x["name"]: x for x in self.read_image_files()}
+
+        def execute(action: PlanAction) -> None:
+            params = action.params
+            image_id = typing.cast(str, action.image_id)
+            if action.kind == "import":
+                # the import and the properties and renames that follow it
+                # depend on its result, so the definition is processed anew
+                definition = definitions.get(params["definition"])
+                if definition is None:
+                    raise ValueError(f"No image definition {params['definition']}")
+                # the error flag is sticky, so whether this import failed is
+                # tracked for the worker thread
+                self._thread_errors.failed = False
+                self._process_definition(copy.deepcopy(definition))
+                # like a regular run, keep the cleanup from running after errors
+                if getattr(self._thread_errors, "failed", False):
+                    raise RuntimeError(f"Import of '{action.name}' failed")
+            elif action.kind == "update":
+                self._update_image(image_id, **params)
+            elif action.kind == "deactivate":
+                self._deactivate_image(image_id)
+            elif action.kind == "reactivate":
+                self._reactivate_image(image_id)
+            elif action.kind == "delete":
+                self._delete_image(image_id)
+            elif action.kind == "share":
+                self._share_image(image_id, params["project_id"])
+            elif action.kind == "unshare":
+                member = self.image_proxy.find_member(params["project_id"], image_id)
+                if member:
+                    self.image_proxy.remove_member(member, image_id)
+
+        logger.info(f"Applying {len(plan.actions)} planned changes")
+        if not plan.apply(execute, self.CONF.parallel):
+            self.exit_with_error = True
+        # imports applied from the plan may have started copies to further stores
+        self.finish_replications()
+
+    def report_plan(self) -> None:
+        """Print the plan of a dry run and write it to --plan-file"""
+        plan = self._plan or Plan(self.CONF.cloud)
+        logger.info(
+            f"Planned changes for cloud '{self.CONF.cloud}': {len(plan.actions)}"
+        )
+        for index, action in enumerate(plan.actions):
+            after = (
+                f" (after {', '.join(map(str, action.after))})" if action.after else ""
+            )
+            logger.info(f"  {index}: {action}{after}")
+        if self.CONF.plan_file:
+            path = self.CONF.plan_file.replace("{cloud}", self.CONF.cloud)
+            plan.save(path)
+            logger.info(f"Plan written to {path}")
+
 
 def main():
     image_manager = ImageManager()
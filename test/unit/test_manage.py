@@ -1,6 +1,12 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import copy
+import hashlib
+import json
+import tempfile
+import threading
+import time
+import os
 import requests
 import typer
 import yamale
@@ -8,6 +14,7 @@ import yaml
 from loguru import logger
 from munch import Munch
 from unittest import TestCase, mock
+from openstack.exceptions import NotFoundException
 from openstack.image.v2.image import Image
 from openstack.image.v2._proxy import Proxy
 from typing import Any, Dict
@@ -138,12 +145,19 @@ FAKE_IMAGE_DATA = {
 }
 
 
+def fake_download(url, dest, checksum=None, timeout=None):
+    """a successful ImageManager._download()"""
+    with open(dest, "wb") as fp:
+        fp.write(b"image")
+    return True
+
+
 class TestManage(TestCase):
     def setUp(self):
         """create all necessary test data, gets called before each test"""
 
         self.fake_image_dict = copy.deepcopy(FAKE_IMAGE_DICT)
-        self.fake_image = Image(**FAKE_IMAGE_DATA)
+        self.fake_image = Image(**copy.deepcopy(FAKE_IMAGE_DATA))
         self.fake_name = f"{self.fake_image_dict['name']} (1)"
         self.fake_url = "http://url.com"
         self.fake_checksum_url = "https://url.com/image.qcow2.sha512"
@@ -198,12 +212,32 @@ class TestManage(TestCase):
             hypervisor=None,
             stuck_retry=0,
             import_timeout=1800,
+            copy_timeout=3600,
             prefetch="never",
+            stores=None,
+            all_stores=False,
+            prefetch_cache=None,
+            prefetch_cache_size=50,
+            prefetch_stream=False,
+            aria2_rpc=False,
+            prefetch_mirrors=False,
+            plan_file=None,
+            apply_plan=None,
+            reconcile=False,
+            url_cache_ttl=0,
+            cache_dir=None,
+            catalog_max_age=86400,
+            parallel=1,
+            two_phase=False,
         )
 
         # we can also mimick an openstack connection object with a Munch
         self.sot.conn = Munch(current_project_id="123456789", image=Proxy)
 
+        partials = tempfile.TemporaryDirectory()
+        self.addCleanup(partials.cleanup)
+        self.sot._partials = main.PartialDownloads(partials.name)
+
     @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
     def test_get_images(self, mock_images):
         """test main.ImageManager.get_images()"""
@@ -212,17 +246,223 @@ class TestManage(TestCase):
         expected_result = {self.fake_image.name: self.fake_image}
 
         result = self.sot.get_images()
-        mock_images.assert_called_once()
+        # tag, visibility and owner are filtered by Glance
+        mock_images.assert_has_calls(
+            [
+                mock.call(tag="fake_tag", visibility="public"),
+                mock.call(tag="fake_tag", owner="123456789"),
+            ]
+        )
+        self.assertEqual(mock_images.call_count, 2)
         self.assertEqual(result, expected_result)
 
         mock_images.reset_mock()
 
+        # the catalog is listed only once per run
+        result = self.sot.get_images()
+        mock_images.assert_not_called()
+        self.assertEqual(result, expected_result)
+
         # test with use_os_hidden = True
         self.sot.CONF.use_os_hidden = True
+        result = self.sot.refresh_images()
+        mock_images.assert_called_with(
+            **{"tag": "fake_tag", "owner": "123456789", "os_hidden": True}
+        )
+        self.assertEqual(mock_images.call_count, 4)
+        self.assertEqual(result, expected_result)
+
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    def test_get_images_merges_listings(self, mock_images):
+        """images found by several queries are merged, foreign ones dropped"""
+        own = Image(
+            **dict(
+                FAKE_IMAGE_DATA,
+                id="own",
+                name="Own",
+                owner="123456789",
+                visibility="private",
+            )
+        )
+        foreign = Image(
+            **dict(FAKE_IMAGE_DATA, id="foreign", name="Foreign", visibility="shared")
+        )
+        mock_images.side_effect = [[self.fake_image], [self.fake_image, own, foreign]]
+
         result = self.sot.get_images()
-        mock_images.assert_called_with(**{"os_hidden": True})
+
+        self.assertEqual(list(result.keys()), [self.fake_image.name, "Own"])
+        self.assertIs(result[self.fake_image.name], self.fake_image)
+
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.delete_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.deactivate_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.update_image"
+    )
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    def test_get_images_write_through(
+        self, mock_images, mock_update, mock_deactivate, mock_delete
+    ):
+        """changes made by the manager are written through to the cached catalog"""
+        mock_images.return_value = [self.fake_image]
+        self.sot.get_images()
+
+        self.sot._update_image(
+            self.fake_image.id,
+            name=self.fake_name,
+            min_disk=20,
+            internal_version="2",
+            tags=self.fake_image.tags + ["os:ubuntu"],
+        )
+        self.sot._deactivate_image(self.fake_image.id)
+
+        cloud_images = self.sot.get_images()
+        self.assertNotIn(self.fake_image_dict["name"], cloud_images)
+        cached = cloud_images[self.fake_name]
+        self.assertEqual(cached.min_disk, 20)
+        self.assertEqual(cached.properties["internal_version"], "2")
+        self.assertEqual(cached.properties["image_description"], "Ubuntu 20.04")
+        self.assertIn("os:ubuntu", cached.tags)
+        self.assertEqual(cached.status, "deactivated")
+
+        self.sot._delete_image(self.fake_image.id)
+        self.assertEqual(self.sot.get_images(), {})
         self.assertEqual(mock_images.call_count, 2)
-        self.assertEqual(result, expected_result)
+
+        # an image deleted outside of the manager is dropped instead of failing
+        self.sot._cache_image(self.fake_image)
+        mock_update.side_effect = NotFoundException()
+        self.sot._update_image(self.fake_image.id, name="other")
+        self.assertEqual(self.sot.get_images(), {})
+
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    def test_catalog_snapshot(self, mock_images):
+        """a saved catalog snapshot is reused and only changes are listed"""
+        updated = Image(
+            **dict(
+                copy.deepcopy(FAKE_IMAGE_DATA),
+                id="new",
+                name="Ubuntu 20.04 (2)",
+                updated_at="2021-03-01T00:00:00Z",
+            )
+        )
+        self.fake_image.updated_at = "2021-02-01T00:00:00Z"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sot.CONF.cache_dir = tmp
+            mock_images.return_value = [self.fake_image]
+            self.sot.get_images()
+            self.sot.save_catalog_snapshot()
+
+            mock_images.reset_mock()
+            # the changes since the snapshot, and all ids of managed images
+            mock_images.side_effect = lambda **query: (
+                [updated] if "updated_at" in query else [self.fake_image, updated]
+            )
+            sot = main.ImageManager()
+            sot.CONF = self.sot.CONF
+            sot.conn = self.sot.conn
+
+            result = sot.get_images()
+
+            # changes are listed regardless of the tag
+            mock_images.assert_any_call(
+                owner="123456789", updated_at="gte:2021-02-01T00:00:00Z"
+            )
+            self.assertEqual(sorted(result), [self.fake_image.name, "Ubuntu 20.04 (2)"])
+            self.assertEqual(
+                result[self.fake_image.name].properties,
+                self.fake_image.properties,
+            )
+
+            # an image untagged since the snapshot is dropped
+            untagged = Image(**dict(copy.deepcopy(FAKE_IMAGE_DATA), tags=["os:ubuntu"]))
+            mock_images.side_effect = None
+            mock_images.return_value = [untagged]
+            sot = main.ImageManager()
+            sot.CONF = self.sot.CONF
+            sot.conn = self.sot.conn
+            self.assertEqual(list(sot.get_images()), [])
+
+            # a deleted image is dropped by the check of the ids
+            mock_images.return_value = [updated]
+            sot = main.ImageManager()
+            sot.CONF = self.sot.CONF
+            sot.conn = self.sot.conn
+            self.assertEqual(list(sot.get_images()), ["Ubuntu 20.04 (2)"])
+            mock_images.assert_any_call(tag=self.sot.CONF.tag, owner="123456789")
+
+            # the snapshot of another project or of --use-os-hidden is not used
+            path = self.sot._catalog_snapshot_path()
+            self.sot.CONF.use_os_hidden = True
+            self.assertNotEqual(self.sot._catalog_snapshot_path(), path)
+            self.sot.CONF.use_os_hidden = False
+            self.sot.conn.current_project_id = "other"
+            self.assertNotEqual(self.sot._catalog_snapshot_path(), path)
+            self.sot.conn.current_project_id = "123456789"
+
+            # an outdated snapshot is replaced by a full listing
+            self.sot.CONF.catalog_max_age = -1
+            mock_images.reset_mock()
+            sot = main.ImageManager()
+            sot.CONF = self.sot.CONF
+            sot.conn = self.sot.conn
+            sot.get_images()
+            mock_images.assert_any_call(tag="fake_tag", owner="123456789")
+
+    def test_image_catalog(self):
+        """test main.ImageCatalog indexes"""
+
+        def make_image(id, name, **properties):
+            data = copy.deepcopy(FAKE_IMAGE_DATA)
+            data["properties"].update(properties)
+            return Image(**dict(data, id=id, name=name))
+
+        catalog = main.ImageCatalog(
+            [
+                make_image("a", "Ubuntu 20.04 (10)", internal_version="10"),
+                make_image("b", "Ubuntu 20.04 (9)", internal_version="9"),
+                make_image("c", "Ubuntu 20.04", upstream_checksum=SHA256),
+                make_image("d", "Debian 12", image_description="Debian 12"),
+            ]
+        )
+
+        self.assertEqual(len(catalog), 4)
+        self.assertEqual(catalog.get_by_id("c").name, "Ubuntu 20.04")
+        self.assertEqual(
+            catalog.groups(),
+            {
+                "Ubuntu 20.04": [
+                    "Ubuntu 20.04",
+                    "Ubuntu 20.04 (9)",
+                    "Ubuntu 20.04 (10)",
+                ],
+                "Debian 12": ["Debian 12"],
+            },
+        )
+        self.assertEqual(
+            [x.id for x in catalog.find("upstream_checksum", SHA256)], ["c"]
+        )
+        self.assertEqual(
+            catalog.search(r"\(\d+\)$"), {"Ubuntu 20.04 (9)", "Ubuntu 20.04 (10)"}
+        )
+
+        # changes are reindexed
+        catalog.update("b", {"name": "Debian 11", "image_description": "Debian 11"})
+        self.assertEqual(
+            catalog.group("Ubuntu 20.04"), ["Ubuntu 20.04", "Ubuntu 20.04 (10)"]
+        )
+        self.assertEqual(catalog.group("Debian 11"), ["Debian 11"])
+        self.assertEqual(catalog.search(r"\(\d+\)$"), {"Ubuntu 20.04 (10)"})
+        self.assertEqual([x.id for x in catalog.find("internal_version", "9")], ["b"])
+
+        catalog.discard("c")
+        self.assertNotIn("Ubuntu 20.04", catalog)
+        self.assertEqual(catalog.find("upstream_checksum", SHA256), [])
 
     @mock.patch(
         "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.stage_image"
@@ -282,6 +522,130 @@ class TestManage(TestCase):
         mock_import.assert_called_once_with(mock_image_obj, method="glance-direct")
         mock_get_image.assert_called_once_with(mock_image_obj)
 
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.get_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.import_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image"
+    )
+    def test_import_image_stores(self, mock_create, mock_import, mock_get_image):
+        """the stores of the definition or the CLI are passed to the import"""
+        mock_create.return_value = self.fake_image
+        mock_get_image.return_value = self.fake_image
+        self.sot.CONF.stores = "ceph-az1, ceph-az2"
+
+        self.sot.import_image(
+            self.fake_image_dict, self.fake_name, self.fake_url, self.versions, "1"
+        )
+        mock_import.assert_called_once_with(
+            self.fake_image,
+            method="web-download",
+            uri=self.fake_url,
+            stores=["ceph-az1", "ceph-az2"],
+            all_stores_must_succeed=False,
+        )
+
+        for image, expected in (
+            ({"stores": ["ceph-az3"]}, {"stores": ["ceph-az3"]}),
+            ({"all_stores": True}, {"all_stores": True}),
+            ({"stores": ["ceph-az3"], "all_stores": True}, {"stores": ["ceph-az3"]}),
+        ):
+            with self.subTest(image=image):
+                expected["all_stores_must_succeed"] = False
+                self.assertEqual(self.sot._store_args(image), expected)
+        self.sot.CONF.stores = None
+        self.assertEqual(self.sot._store_args({}), {})
+        self.sot.CONF.all_stores = True
+        self.assertEqual(
+            self.sot._store_args({"all_stores": False}),
+            {},
+        )
+
+    @mock.patch.object(main.ImportWatcher, "TICK", 0.01)
+    @mock.patch("openstack_image_manager.main.import_poll_interval", return_value=0.0)
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.import_image"
+    )
+    def test_replicate_image(self, mock_import, mock_images, mock_interval):
+        """imported images are copied to further stores in the background"""
+        images = {
+            "a": Image(id="a", name="a", status="active", stores="ceph-az1"),
+            "b": Image(id="b", name="b", status="active", stores="ceph-az1"),
+        }
+        copying = {"a": "ceph-az2", "b": "ceph-az2,ceph-az3"}
+        results = {
+            "a": Image(id="a", name="a", status="active", stores="ceph-az1,ceph-az2"),
+            "b": Image(
+                id="b",
+                name="b",
+                status="active",
+                stores="ceph-az1,ceph-az2",
+                os_glance_failed_import="ceph-az3",
+            ),
+        }
+
+        def list_images(**query):
+            result = []
+            for id in query["id"][3:].split(","):
+                # the first check sees the copies not started yet, with
+                # os_glance_importing_to_stores still unset
+                if copying.pop(id, None):
+                    result.append(images[id])
+                else:
+                    result.append(results[id])
+            return result
+
+        mock_images.side_effect = list_images
+
+        self.sot.replicate_image(images["a"], ["ceph-az1", "ceph-az2"])
+        self.sot.replicate_image(images["b"], ["ceph-az2", "ceph-az3"])
+        self.sot.replicate_image(images["b"], ["ceph-az1"])
+        self.sot.finish_replications()
+
+        mock_import.assert_any_call(
+            images["a"],
+            method="copy-image",
+            stores=["ceph-az2"],
+            all_stores_must_succeed=False,
+        )
+        self.assertEqual(mock_import.call_count, 2)
+        self.assertTrue(self.sot.exit_with_error)
+        self.assertIsNone(self.sot._replicator)
+        self.assertEqual(self.sot._replications, [])
+
+    @mock.patch("openstack_image_manager.main.time.sleep")
+    @mock.patch("openstack_image_manager.main.time.monotonic", return_value=0.0)
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.get_image"
+    )
+    def test_wait_for_image_stores(self, mock_get, mock_mono, mock_sleep):
+        """an active image is awaited until all of its stores are imported"""
+        partial = Image(
+            id="a",
+            name="a",
+            status="active",
+            os_glance_importing_to_stores="ceph-az2",
+            os_glance_failed_import="",
+        )
+        complete = Image(
+            id="a",
+            name="a",
+            status="active",
+            os_glance_importing_to_stores="",
+            os_glance_failed_import="ceph-az3",
+        )
+        mock_get.side_effect = [partial, complete]
+
+        self.assertIs(self.sot.wait_for_image(partial), complete)
+        mock_sleep.assert_called_once()
+        self.assertEqual(
+            main._import_stores(complete, "os_glance_failed_import"), "ceph-az3"
+        )
+
     @mock.patch("openstack_image_manager.main.time.sleep")
     @mock.patch("openstack_image_manager.main.time.monotonic")
     @mock.patch(
@@ -321,10 +685,354 @@ class TestManage(TestCase):
         mock_get.side_effect = Exception("boom")
         self.assertIsNone(self.sot.wait_for_image(image=mock.MagicMock()))
 
+    @mock.patch("openstack_image_manager.main.time.monotonic")
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    def test_import_watcher(self, mock_images, mock_mono):
+        """the import watcher polls all due imports with one listing per tick"""
+        mock_mono.return_value = 0.0
+        images = {}
+        for id, status in (("a", "importing"), ("b", "queued"), ("c", "killed")):
+            images[id] = Image(id=id, name=f"image {id}", status=status)
+        mock_images.side_effect = lambda **query: [
+            images[x] for x in query["id"][3:].split(",") if x in images
+        ]
+
+        watcher = main.ImportWatcher(Proxy)
+        futures = {id: watcher.watch(image, 100.0) for id, image in images.items()}
+        # a second caller waits for the same import
+        self.assertIs(watcher.watch(images["a"], 100.0), futures["a"])
+        watcher.tick()
+
+        mock_images.assert_called_once_with(id="in:a,b,c")
+        self.assertIsNone(futures["c"].result(timeout=0))
+        self.assertFalse(futures["a"].done())
+
+        # only the queued image is due after the queued interval
+        mock_mono.return_value = 2.0
+        images["b"].status = "active"
+        watcher.tick()
+        mock_images.assert_called_with(id="in:b")
+        self.assertIs(futures["b"].result(timeout=0), images["b"])
+
+        # the importing image runs into the deadline
+        mock_mono.return_value = 200.0
+        watcher.tick()
+        self.assertIsNone(futures["a"].result(timeout=0))
+        self.assertEqual(mock_images.call_count, 2)
+
+    def test_prefetch_pipeline(self):
+        """downloads overlap with staging, bounded by the pipeline depth"""
+        downloaded = {name: threading.Event() for name in ("a", "b", "c", "d")}
+        release = threading.Event()
+        paths = {}
+
+        def download(job, directory):
+            if job.name == "d":
+                return None
+            paths[job.name] = os.path.join(directory, "image.dat")
+            with open(paths[job.name], "w") as fp:
+                fp.write(job.name)
+            downloaded[job.name].set()
+            return paths[job.name]
+
+        def stage(job):
+            self.assertTrue(os.path.isfile(job.path))
+            release.wait(5)
+            imported = main.concurrent.futures.Future()
+            imported.set_result(f"image {job.name}")
+            return imported
+
+        pipeline = main.PrefetchPipeline(download, stage)
+        pipeline.start()
+        futures = {
+            name: pipeline.submit(main._PrefetchJob({}, name, "http://x/y", None))
+            for name in ("a", "b", "c", "d")
+        }
+        # b downloads while a is staged, c waits for a free slot
+        self.assertTrue(downloaded["b"].wait(5))
+        self.assertFalse(downloaded["c"].wait(0.1))
+
+        release.set()
+        pipeline.stop()
+        self.assertEqual(futures["a"].result(timeout=0), "image a")
+        self.assertEqual(futures["c"].result(timeout=0), "image c")
+        self.assertIsNone(futures["d"].result(timeout=0))
+        for path in paths.values():
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    @mock.patch("openstack_image_manager.main.random.uniform", return_value=1.0)
+    def test_import_poll_interval(self, mock_uniform):
+        """polls are dense around the predicted completion time"""
+        self.assertEqual(main.import_poll_interval(30.0, None), 10.0)
+        self.assertEqual(main.import_poll_interval(0.0, 60.0), 30.0)
+        self.assertEqual(main.import_poll_interval(0.0, 600.0), main.POLL_MAX_INTERVAL)
+        self.assertEqual(main.import_poll_interval(59.0, 60.0), main.POLL_MIN_INTERVAL)
+        self.assertEqual(main.import_poll_interval(100.0, 60.0), 12.0)
+        self.assertEqual(
+            main.import_poll_interval(1000.0, 60.0), main.POLL_MAX_INTERVAL
+        )
+
+    def test_import_history(self):
+        """the history predicts durations from the median throughput and persists"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history.json")
+            history = main.ImportHistory(path)
+            self.assertIsNone(history.predict("web-download", 100))
+            for throughput in (10, 20, 1000):
+                history.record("web-download", throughput * 10, 10.0)
+            history.record("web-download", 100, 0.0)
+            self.assertEqual(history.predict("web-download", 200), 10.0)
+            self.assertIsNone(history.predict("web-download", None))
+            self.assertIsNone(history.predict("glance-direct", 200))
+            history.save()
+
+            self.assertEqual(
+                main.ImportHistory(path).predict("web-download", 400), 20.0
+            )
+
+        history = main.ImportHistory()
+        for i in range(main.ImportHistory.MAX_SAMPLES + 5):
+            history.record("prefetch", 1, 1.0)
+        self.assertEqual(
+            len(history._samples["prefetch"]), main.ImportHistory.MAX_SAMPLES
+        )
+
+    def test_prefetch_reserve(self):
+        """the on-stuck reserve follows the predicted prefetch duration"""
+        self.assertEqual(self.sot._prefetch_reserve(self.fake_url), 900.0)
+        self.sot._upstream_sizes[self.fake_url] = 1000
+        self.sot._import_history.record("prefetch", 1000, 100.0)
+        self.assertEqual(self.sot._prefetch_reserve(self.fake_url), 150.0)
+        self.sot._import_history.record("prefetch", 1000, 1000.0)
+        self.sot._import_history.record("prefetch", 1000, 1000.0)
+        self.assertEqual(
+            self.sot._prefetch_reserve(self.fake_url), self.sot.CONF.import_timeout / 2
+        )
+
+    @mock.patch("openstack_image_manager.main.time.monotonic")
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    def test_import_watcher_stuck_and_errors(self, mock_images, mock_mono):
+        """stuck queued images and repeated errors resolve to None"""
+        mock_mono.return_value = 0.0
+        stuck = Image(id="a", name="stuck", status="queued")
+        watcher = main.ImportWatcher(Proxy)
+
+        mock_images.return_value = [stuck]
+        future = watcher.watch(stuck, 1000.0)
+        for _ in range(6):
+            watcher.tick()
+            mock_mono.return_value += 2.0
+        self.assertIsNone(future.result(timeout=0))
+
+        mock_images.side_effect = Exception("boom")
+        future = watcher.watch(stuck, 1000.0)
+        for _ in range(5):
+            watcher.tick()
+            mock_mono.return_value += 2.0
+        self.assertIsNone(future.result(timeout=0))
+
     @mock.patch("openstack_image_manager.main.shutil.which", return_value=None)
     def test_download_missing_aria2c(self, mock_which):
-        """missing aria2c is a clean False, not a traceback"""
-        self.assertFalse(self.sot._download("http://x/y.qcow2", "/tmp/y", None))
+        """missing aria2c falls back to the built-in downloader"""
+        self.sot._range_downloader = mock.MagicMock()
+        self.sot._range_downloader.download.return_value = False
+        metadata = main.UrlMetadata("http://x/y.qcow2", "http://x/y.qcow2", 200, 200)
+        with mock.patch.object(self.sot, "_probe", return_value=metadata):
+            self.assertFalse(self.sot._download("http://x/y.qcow2", "/tmp/y", None))
+        # the downloader reuses the probe of the URL
+        self.sot._range_downloader.download.assert_called_once_with(
+            ["http://x/y.qcow2"], "/tmp/y", None, None, 4, 20 * 2**20, metadata
+        )
+
+    def _range_downloader(self, content, ranges=True):
+        """a RangeDownloader whose session serves content"""
+        downloader = main.RangeDownloader()
+        requested = []
+        headers = {"Content-Length": str(len(content)), "ETag": '"e1"'}
+        if ranges:
+            headers["Accept-Ranges"] = "bytes"
+
+        def get(url, headers=None, stream=False, timeout=None):
+            if headers is None:
+                body, status = content, 200
+            else:
+                start, end = headers["Range"][6:].split("-")
+                first, stop = int(start), int(end) + 1
+                body, status = content[first:stop], 206
+                requested.append((url, first))
+            resp = mock.MagicMock(status_code=status)
+            resp.iter_content.return_value = [body]
+            resp.__enter__.return_value = resp
+            return resp
+
+        head = mock.Mock(status_code=200, history=[], url="http://x/y", headers=headers)
+        downloader._session = mock.MagicMock(
+            head=mock.MagicMock(return_value=head), get=get
+        )
+        return downloader, requested
+
+    def test_range_downloader(self):
+        content = os.urandom(1000)
+        checksum = "sha256:" + hashlib.sha256(content).hexdigest()
+        downloader, requested = self._range_downloader(content)
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "image.dat")
+            self.assertTrue(
+                downloader.download(
+                    ["http://x/y", "http://z/y"], dest, checksum, 60, 4, 100
+                )
+            )
+            with open(dest, "rb") as fp:
+                self.assertEqual(fp.read(), content)
+            self.assertFalse(os.path.exists(dest + ".state"))
+        self.assertEqual(
+            sorted(requested),
+            [
+                ("http://x/y", 0),
+                ("http://x/y", 500),
+                ("http://z/y", 250),
+                ("http://z/y", 750),
+            ],
+        )
+
+        # a probe of the URL is reused instead of a HEAD request
+        downloader, requested = self._range_downloader(content)
+        metadata = main.UrlMetadata(
+            "http://x/y", "http://x/y", 200, 200, 1000, None, '"e1"', "bytes"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "image.dat")
+            self.assertTrue(
+                downloader.download(
+                    ["http://x/y"], dest, checksum, 60, 2, 100, metadata=metadata
+                )
+            )
+        downloader._session.head.assert_not_called()
+        self.assertEqual(len(requested), 2)
+
+        # without range support the file is fetched in one piece
+        downloader, requested = self._range_downloader(content, ranges=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "image.dat")
+            self.assertTrue(downloader.download(["http://x/y"], dest, checksum))
+            self.assertEqual(requested, [])
+
+        # a checksum mismatch discards the download
+        downloader, requested = self._range_downloader(content)
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "image.dat")
+            self.assertFalse(
+                downloader.download(["http://x/y"], dest, "sha256:" + "0" * 64)
+            )
+            self.assertFalse(os.path.exists(dest))
+
+    def test_range_downloader_resume(self):
+        content = os.urandom(1000)
+        downloader, requested = self._range_downloader(content)
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "image.dat")
+            with open(dest, "wb") as fp:
+                fp.write(content[:500])
+            with open(dest + ".state", "w") as fp:
+                json.dump(
+                    {"url": "http://x/y", "size": 1000, "etag": '"e1"', "done": [0]},
+                    fp,
+                )
+            self.assertTrue(downloader.download(["http://x/y"], dest, None, 60, 2, 100))
+            with open(dest, "rb") as fp:
+                self.assertEqual(fp.read(), content)
+        self.assertEqual(requested, [("http://x/y", 500)])
+
+    def test_range_downloader_stops_segments(self):
+        """a segment failing for good ends the other segments early"""
+        content = os.urandom(1000)
+        downloader, requested = self._range_downloader(content)
+        get = downloader._session.get
+        streamed = []
+
+        def slow_body():
+            for _ in range(500):
+                time.sleep(0.002)
+                streamed.append(1)
+                yield b"x"
+
+        def failing_get(url, headers=None, stream=False, timeout=None):
+            if headers["Range"].startswith("bytes=0-"):
+                raise requests.exceptions.ConnectionError("reset")
+            resp = get(url, headers, stream, timeout)
+            resp.iter_content.return_value = slow_body()
+            return resp
+
+        downloader._session.get = failing_get
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "image.dat")
+            self.assertFalse(
+                downloader.download(["http://x/y"], dest, None, 60, 2, 100)
+            )
+        self.assertLess(len(streamed), 500)
+
+    @mock.patch(
+        "openstack_image_manager.main.ImageManager._has_space_for_download",
+        return_value=True,
+    )
+    @mock.patch("openstack_image_manager.main.ImageManager._download")
+    def test_prefetch_fetch_keeps_partial(self, mock_dl, mock_space):
+        """a failed download is resumed from the same place by the next attempt"""
+        destinations = []
+
+        def failing_download(url, dest, checksum=None, timeout=None):
+            destinations.append(dest)
+            with open(dest + ".state", "w") as fp:
+                fp.write("{}")
+            return False
+
+        mock_dl.side_effect = failing_download
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertIsNone(
+                self.sot._prefetch_fetch(
+                    "x", "http://x/y", None, time.monotonic() + 60, tmp
+                )
+            )
+            self.assertTrue(os.path.exists(destinations[0] + ".state"))
+
+            mock_dl.side_effect = fake_download
+            path = self.sot._prefetch_fetch(
+                "x", "http://x/y", None, time.monotonic() + 60, tmp
+            )
+            self.assertEqual(path, os.path.join(tmp, "image.dat"))
+            self.assertEqual(mock_dl.call_args.args[1], destinations[0])
+            # the partial directory is removed once the download is complete
+            self.assertFalse(os.path.exists(os.path.dirname(destinations[0])))
+
+    def test_partial_downloads_private(self):
+        """partial downloads are only resumed from a directory private to the user"""
+        with tempfile.TemporaryDirectory() as tmp:
+            base = os.path.join(tmp, "partial")
+            partials = main.PartialDownloads(base)
+            path = partials.path("http://x/y", None)
+            self.assertEqual(os.path.dirname(path), base)
+            self.assertEqual(os.stat(base).st_mode & 0o777, 0o700)
+
+            # a planted link is not followed by the next attempt
+            os.symlink("/etc/passwd", os.path.join(path, "image.dat"))
+            self.assertEqual(partials.path("http://x/y", None), path)
+            self.assertEqual(os.listdir(path), [])
+
+            shared = os.path.join(tmp, "shared")
+            os.mkdir(shared)
+            os.chmod(shared, 0o777)
+            partials = main.PartialDownloads(shared)
+            path = partials.path("http://x/y", None)
+            self.assertNotEqual(os.path.dirname(path), shared)
+            partials.discard(path)
+            self.assertFalse(os.path.exists(path))
+
+    @mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/home/u/.cache"})
+    def test_default_partial_directory(self):
+        self.assertEqual(
+            main.default_partial_directory(),
+            "/home/u/.cache/openstack-image-manager/partial",
+        )
 
     @mock.patch("openstack_image_manager.main.subprocess.run")
     @mock.patch(
@@ -347,6 +1055,151 @@ class TestManage(TestCase):
         mock_run.return_value = mock.MagicMock(returncode=1)
         self.assertFalse(self.sot._download("http://x/y", "/tmp/y", None))
 
+    def _aria2_daemon(self, statuses):
+        """an Aria2Daemon whose RPC replies with the given tellStatus results"""
+        daemon = main.Aria2Daemon()
+        daemon._process = mock.MagicMock()
+        daemon.POLL_INTERVAL = 0
+        calls = []
+
+        def post(url, json, timeout):
+            calls.append((json["method"], json["params"]))
+            if json["method"] == "aria2.addUri":
+                result = "gid1"
+            elif json["method"] == "aria2.tellStatus":
+                result = statuses.pop(0)
+            else:
+                result = "OK"
+            return mock.MagicMock(json=mock.MagicMock(return_value={"result": result}))
+
+        daemon._session = mock.MagicMock(post=post)
+        return daemon, calls
+
+    @mock.patch("openstack_image_manager.main.subprocess.Popen")
+    def test_aria2_daemon_start(self, mock_popen):
+        """the secret stays off the command line, a lost port race is retried"""
+        configs = []
+
+        def popen(cmd, stdout=None):
+            conf = [x for x in cmd if x.startswith("--conf-path=")][0][12:]
+            with open(conf) as fp:
+                configs.append((fp.read(), os.stat(conf).st_mode & 0o777))
+            # the first daemon exits, as if its port was taken meanwhile
+            return mock.Mock(
+                poll=mock.Mock(return_value=1 if len(configs) == 1 else None)
+            )
+
+        mock_popen.side_effect = popen
+        daemon = main.Aria2Daemon()
+        daemon._session = mock.MagicMock()
+        daemon._session.post.side_effect = [
+            requests.exceptions.ConnectionError("refused"),
+            mock.Mock(json=mock.Mock(return_value={"result": {"version": "1"}})),
+        ]
+        daemon._start()
+
+        self.assertEqual(mock_popen.call_count, 2)
+        for cmd in (x.args[0] for x in mock_popen.call_args_list):
+            self.assertFalse([x for x in cmd if daemon._secret in x])
+        self.assertEqual(configs[1], (f"rpc-secret={daemon._secret}\n", 0o600))
+        # the configuration file is removed once aria2c read it
+        conf = mock_popen.call_args.args[0][1][12:]
+        self.assertFalse(os.path.exists(conf))
+
+    def test_aria2_daemon_download(self):
+        daemon, calls = self._aria2_daemon(
+            [
+                {"status": "active", "completedLength": "5", "totalLength": "10"},
+                {"status": "complete", "completedLength": "10"},
+            ]
+        )
+        self.assertTrue(
+            daemon.download(
+                ["http://x/y", "http://z/y"], "/tmp/d/y", "sha256:" + "a" * 64, 60, 8, 4
+            )
+        )
+        method, params = calls[0]
+        self.assertEqual(method, "aria2.addUri")
+        self.assertEqual(params[1], ["http://x/y", "http://z/y"])
+        self.assertEqual(params[2]["dir"], "/tmp/d")
+        self.assertEqual(params[2]["out"], "y")
+        self.assertEqual(params[2]["split"], "8")
+        self.assertEqual(params[2]["max-connection-per-server"], "4")
+        self.assertEqual(params[2]["min-split-size"], "20M")
+        self.assertEqual(params[2]["checksum"], "sha-256=" + "a" * 64)
+        self.assertEqual(calls[-1][0], "aria2.removeDownloadResult")
+        self.assertEqual(daemon._active, 0)
+
+    def test_aria2_daemon_error(self):
+        daemon, calls = self._aria2_daemon(
+            [{"status": "error", "errorMessage": "404 Not Found"}]
+        )
+        self.assertFalse(daemon.download(["http://x/y"], "/tmp/d/y"))
+
+    @mock.patch("openstack_image_manager.main.time.monotonic")
+    def test_aria2_daemon_deadline(self, mock_mono):
+        mock_mono.side_effect = [0, 5, 100]
+        daemon, calls = self._aria2_daemon([{"status": "active"}, {"status": "active"}])
+        self.assertFalse(daemon.download(["http://x/y"], "/tmp/d/y", timeout=60))
+        self.assertIn(("aria2.forceRemove", [mock.ANY, "gid1"]), calls)
+
+    @mock.patch(
+        "openstack_image_manager.main.shutil.which", return_value="/usr/bin/aria2c"
+    )
+    def test_download_uses_aria2_daemon(self, mock_which):
+        self.sot._aria2 = mock.MagicMock()
+        self.sot._aria2.download.return_value = True
+        self.assertTrue(self.sot._download("http://x/y", "/tmp/y", "abc", 30))
+        self.sot._aria2.download.assert_called_once_with(
+            ["http://x/y"], "/tmp/y", "abc", 30, 4, 4, 20 * 2**20
+        )
+
+    def test_upstream_session(self):
+        retry = main.upstream_session().get_adapter("https://x/").max_retries
+        self.assertEqual(retry.total, main.UPSTREAM_RETRIES)
+        self.assertIn(429, retry.status_forcelist)
+        self.assertIn(503, retry.status_forcelist)
+        self.assertTrue(retry.respect_retry_after_header)
+        # Retry-After is honoured up to a bound
+        response = mock.MagicMock(headers={"Retry-After": "5"})
+        self.assertEqual(retry.get_retry_after(response), 5)
+        response = mock.MagicMock(headers={"Retry-After": "3600"})
+        self.assertEqual(retry.get_retry_after(response), main.UPSTREAM_RETRY_AFTER_MAX)
+        # the policy survives the copies urllib3 makes per attempt
+        self.assertIsInstance(retry.increment(method="GET", url="/"), type(retry))
+
+    def test_download_tuning(self):
+        # unknown size and host: the former fixed settings
+        self.assertEqual(main.download_tuning(None, None), (4, 4, 20 * 2**20))
+        # a small image is fetched with one connection
+        self.assertEqual(main.download_tuning(15 * 2**20, None), (1, 1, 20 * 2**20))
+        # a large image from an unknown host: many segments, 4 connections
+        self.assertEqual(main.download_tuning(10 * 2**30, None), (16, 4, 640 * 2**20))
+        # ... from a fast host: 16 connections, from a slow mirror: 2
+        self.assertEqual(main.download_tuning(10 * 2**30, 20 * 2**20)[1], 16)
+        self.assertEqual(main.download_tuning(10 * 2**30, 100 * 2**10)[1], 2)
+        # segments are capped at aria2's maximum min-split-size
+        self.assertEqual(main.download_tuning(100 * 2**30, None)[2], 2**30)
+
+    @mock.patch("openstack_image_manager.main.subprocess.run")
+    @mock.patch(
+        "openstack_image_manager.main.shutil.which", return_value="/usr/bin/aria2c"
+    )
+    @mock.patch("openstack_image_manager.main.time.monotonic", side_effect=[0, 10])
+    def test_download_mirrors_and_history(self, mock_mono, mock_which, mock_run):
+        mock_run.return_value = mock.MagicMock(returncode=0)
+        self.sot._upstream_sizes["http://mirror/y"] = 4 * 2**30
+        self.sot._download_mirrors["http://mirror/y"] = ["http://x/y"]
+        self.assertTrue(self.sot._download("http://mirror/y", "/tmp/y"))
+        args = mock_run.call_args[0][0]
+        self.assertEqual(args[-2:], ["http://mirror/y", "http://x/y"])
+        self.assertIn("--split=8", args)
+        self.assertIn("--max-connection-per-server=4", args)
+        self.assertIn("--min-split-size=256M", args)
+        self.assertEqual(
+            self.sot._download_history.throughput("mirror"), 4 * 2**30 / 40
+        )
+
     @mock.patch("openstack_image_manager.main.ImageManager._glance_direct_import")
     @mock.patch("openstack_image_manager.main.ImageManager._download")
     @mock.patch(
@@ -374,7 +1227,7 @@ class TestManage(TestCase):
         fresh.status = "active"
         mock_create.side_effect = [stuck, fresh]  # web-download img + fallback img
         mock_get.return_value = stuck  # wait_for_image sees 'queued' -> None
-        mock_dl.return_value = True
+        mock_dl.side_effect = fake_download
         mock_gd.return_value = fresh
 
         result = self.sot.import_image(
@@ -438,6 +1291,10 @@ class TestManage(TestCase):
         self.assertTrue(self.sot.exit_with_error)
         mock_dl.assert_not_called()
 
+    @mock.patch(
+        "openstack_image_manager.main.ImageManager._has_space_for_download",
+        return_value=True,
+    )
     @mock.patch("openstack_image_manager.main.ImageManager._glance_direct_import")
     @mock.patch("openstack_image_manager.main.ImageManager._download")
     @mock.patch(
@@ -447,14 +1304,14 @@ class TestManage(TestCase):
         "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image"
     )
     def test_import_always_uses_prefetch(
-        self, mock_create, mock_import, mock_dl, mock_gd
+        self, mock_create, mock_import, mock_dl, mock_gd, mock_space
     ):
         """prefetch=always skips web-download entirely"""
         self.sot.CONF.prefetch = "always"
         fresh = mock.MagicMock()
         fresh.status = "active"
         mock_create.return_value = fresh
-        mock_dl.return_value = True
+        mock_dl.side_effect = fake_download
         mock_gd.return_value = fresh
         result = self.sot.import_image(
             self.fake_image_dict, self.fake_name, self.fake_url, self.versions, "1"
@@ -464,12 +1321,16 @@ class TestManage(TestCase):
         mock_gd.assert_called_once()
         mock_import.assert_not_called()  # web-download never used
 
+    @mock.patch(
+        "openstack_image_manager.main.ImageManager._has_space_for_download",
+        return_value=True,
+    )
     @mock.patch("openstack_image_manager.main.ImageManager._glance_direct_import")
     @mock.patch("openstack_image_manager.main.ImageManager._download")
     @mock.patch(
         "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image"
     )
-    def test_prefetch_download_failure(self, mock_create, mock_dl, mock_gd):
+    def test_prefetch_download_failure(self, mock_create, mock_dl, mock_gd, mock_space):
         """a failed download flags an error and never stages an image"""
         self.sot.CONF.prefetch = "always"
         mock_dl.return_value = False
@@ -498,12 +1359,16 @@ class TestManage(TestCase):
         self.assertIs(result, fresh)
         mock_pf.assert_called_once()
 
+    @mock.patch(
+        "openstack_image_manager.main.ImageManager._has_space_for_download",
+        return_value=True,
+    )
     @mock.patch("openstack_image_manager.main.ImageManager._download")
     @mock.patch(
         "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image",
         side_effect=Exception("409 conflict on fixed id"),
     )
-    def test_prefetch_create_conflict(self, mock_create, mock_dl):
+    def test_prefetch_create_conflict(self, mock_create, mock_dl, mock_space):
         """a create conflict in the fallback fails cleanly, no traceback"""
         self.sot.CONF.prefetch = "always"
         mock_dl.return_value = True
@@ -513,8 +1378,150 @@ class TestManage(TestCase):
         self.assertIsNone(result)
         self.assertTrue(self.sot.exit_with_error)
 
+    @mock.patch("openstack_image_manager.main.ImageManager._download")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.get_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.delete_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.import_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.stage_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image"
+    )
+    def test_prefetch_stream(
+        self,
+        mock_create,
+        mock_stage,
+        mock_import,
+        mock_delete,
+        mock_get_image,
+        mock_get,
+        mock_dl,
+    ):
+        """--prefetch-stream stages the response body and verifies its checksum"""
+        self.sot.CONF.prefetch = "always"
+        self.sot.CONF.prefetch_stream = True
+        chunks = [b"fake ", b"image ", b"data"]
+        response = mock_get.return_value.__enter__.return_value
+        response.iter_content.return_value = chunks
+        mock_create.return_value = self.fake_image
+        mock_get_image.return_value = self.fake_image
+        staged = []
+        mock_stage.side_effect = lambda image, data: staged.extend(data)
+        digest = main.hashlib.sha256(b"".join(chunks)).hexdigest()
+
+        result = self.sot.import_image(
+            self.fake_image_dict,
+            self.fake_name,
+            self.fake_url,
+            self.versions,
+            "1",
+            checksum=f"sha256:{digest.upper()}",
+        )
+        self.assertIs(result, self.fake_image)
+        self.assertEqual(staged, chunks)
+        mock_get.assert_called_once_with(
+            self.fake_url, stream=True, timeout=main.REQUESTS_TIMEOUT
+        )
+        mock_import.assert_called_once_with(self.fake_image, method="glance-direct")
+        mock_dl.assert_not_called()
+        mock_delete.assert_not_called()
+
+        # a checksum mismatch deletes the staged image before its import
+        staged.clear()
+        mock_import.reset_mock()
+        result = self.sot.import_image(
+            self.fake_image_dict,
+            self.fake_name,
+            self.fake_url,
+            self.versions,
+            "1",
+            checksum="sha256:" + "a" * 64,
+        )
+        self.assertIsNone(result)
+        self.assertEqual(staged, chunks)
+        mock_import.assert_not_called()
+        mock_delete.assert_called_once_with(self.fake_image)
+        self.assertTrue(self.sot.exit_with_error)
+
+    def test_prefetch_cache(self):
+        """cache entries are verified on a hit and evicted least recently used"""
+        digest = main.hashlib.sha256(b"image").hexdigest()
+        self.assertEqual(
+            main.PrefetchCache.key(f"sha256:{digest.upper()}", "http://x/y", None),
+            f"sha256-{digest}",
+        )
+        self.assertTrue(
+            main.PrefetchCache.key(None, "http://x/y", '"abc"').startswith("url-")
+        )
+        self.assertIsNone(main.PrefetchCache.key(None, "http://x/y", None))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = main.PrefetchCache(tmp, budget=10)
+            checksum = f"sha256:{digest}"
+            key = cache.key(checksum, "http://x/y", None)
+            self.assertIsNone(cache.get(key, checksum))
+
+            for name, content in ((key, b"image"), ("url-old", b"older")):
+                incoming = cache.incoming()
+                path = os.path.join(incoming, "image.dat")
+                with open(path, "wb") as fp:
+                    fp.write(content)
+                entry = cache.put(name, path)
+                os.rmdir(incoming)
+            self.assertEqual(cache.get(key, checksum), os.path.join(tmp, key))
+            self.assertEqual((cache.hits, cache.misses, cache.bytes_saved), (1, 1, 5))
+
+            # the least recently used entry makes room for a new one
+            os.utime(entry, (0, 0))
+            incoming = cache.incoming()
+            path = os.path.join(incoming, "image.dat")
+            with open(path, "wb") as fp:
+                fp.write(b"new")
+            cache.put("url-new", path)
+            self.assertEqual(
+                sorted(x for x in os.listdir(tmp) if not x.startswith(".")),
+                [key, "url-new"],
+            )
+
+            # a corrupt entry is a miss and removed
+            with open(os.path.join(tmp, key), "wb") as fp:
+                fp.write(b"corrupt")
+            self.assertIsNone(cache.get(key, checksum))
+            self.assertFalse(os.path.exists(os.path.join(tmp, key)))
+
+    @mock.patch("openstack_image_manager.main.ImageManager._has_space_for_download")
+    @mock.patch("openstack_image_manager.main.ImageManager._download")
+    def test_prefetch_download_cached(self, mock_dl, mock_space):
+        """a cached image skips the download, a new download is published"""
+        checksum = "sha256:" + main.hashlib.sha256(b"image").hexdigest()
+
+        def download(url, dest, checksum=None, timeout=None):
+            with open(dest, "wb") as fp:
+                fp.write(b"image")
+            return True
+
+        mock_dl.side_effect = download
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sot._prefetch_cache = main.PrefetchCache(tmp, budget=2**30)
+            for _ in range(2):
+                path = self.sot._prefetch_download(
+                    self.fake_name, self.fake_url, checksum, time.monotonic() + 60, "/x"
+                )
+                self.assertEqual(os.path.dirname(path), tmp)
+            mock_dl.assert_called_once()
+            self.assertEqual(self.sot._prefetch_cache.hits, 1)
+            self.assertEqual(os.listdir(tmp), [os.path.basename(path)])
+
     @mock.patch("openstack_image_manager.main.shutil.disk_usage")
-    @mock.patch("openstack_image_manager.main.requests.head")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
     def test_has_space_insufficient(self, mock_head, mock_du):
         """a too-small filesystem is detected before downloading"""
         mock_head.return_value = mock.MagicMock(
@@ -524,7 +1531,7 @@ class TestManage(TestCase):
         self.assertFalse(self.sot._has_space_for_download("http://x/y", "/tmp"))
 
     @mock.patch("openstack_image_manager.main.shutil.disk_usage")
-    @mock.patch("openstack_image_manager.main.requests.head")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
     def test_has_space_enough(self, mock_head, mock_du):
         """enough free space returns True"""
         mock_head.return_value = mock.MagicMock(
@@ -533,7 +1540,7 @@ class TestManage(TestCase):
         mock_du.return_value = mock.MagicMock(free=10 * 1024**3)
         self.assertTrue(self.sot._has_space_for_download("http://x/y", "/tmp"))
 
-    @mock.patch("openstack_image_manager.main.requests.head")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
     def test_has_space_unknown_size(self, mock_head):
         """an unknown image size does not block the download"""
         mock_head.return_value = mock.MagicMock(headers={})
@@ -573,7 +1580,9 @@ class TestManage(TestCase):
         """
 
         mock_read_image_files.return_value = [self.fake_image_dict]
-        mock_get_images.return_value = {self.fake_name: self.fake_image}
+        mock_get_images.return_value = main.ImageCatalog(
+            [Image(**dict(copy.deepcopy(FAKE_IMAGE_DATA), name=self.fake_name))]
+        )
         too_old_images = self.sot.check_image_age()
         mock_get_images.assert_called_once()
         mock_read_image_files.assert_called_once()
@@ -587,7 +1596,91 @@ class TestManage(TestCase):
 
     @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
     @mock.patch("openstack_image_manager.main.ImageManager.import_image")
-    @mock.patch("openstack_image_manager.main.requests.head")
+    @mock.patch("openstack_image_manager.main.ImageManager.get_images")
+    def test_process_image_reconcile(
+        self, mock_get_images, mock_import_image, mock_set_properties
+    ):
+        """existing images are only checked with --reconcile"""
+        mock_get_images.return_value = main.ImageCatalog([self.fake_image])
+        meta = self.fake_image_dict["meta"]
+
+        self.sot.process_image(
+            self.fake_image_dict, self.versions, self.sorted_versions, meta
+        )
+        mock_import_image.assert_not_called()
+        mock_set_properties.assert_not_called()
+
+        self.sot.CONF.reconcile = True
+        self.sot.process_image(
+            self.fake_image_dict, self.versions, self.sorted_versions, meta
+        )
+        mock_import_image.assert_not_called()
+        # the latest version of a multi image carries the plain name
+        mock_set_properties.assert_called_once_with(
+            self.fake_image_dict, self.fake_image.name, self.versions, "1", "", meta
+        )
+
+    @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
+    @mock.patch("openstack_image_manager.main.ImageManager.import_image")
+    @mock.patch("openstack_image_manager.main.ImageManager.get_images")
+    def test_process_image_missing_internal_version(
+        self, mock_get_images, mock_import_image, mock_set_properties
+    ):
+        """an existing latest image without internal_version is not re-imported"""
+        del self.fake_image.properties["internal_version"]
+        mock_get_images.return_value = main.ImageCatalog([self.fake_image])
+
+        self.sot.process_image(
+            self.fake_image_dict,
+            self.versions,
+            self.sorted_versions,
+            self.fake_image_dict["meta"],
+        )
+        mock_import_image.assert_not_called()
+
+    @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
+    @mock.patch("openstack_image_manager.main.ImageManager.import_image")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
+    @mock.patch("openstack_image_manager.main.ImageManager.wait_for_image")
+    @mock.patch("openstack_image_manager.main.ImageManager.get_images")
+    def test_process_image_submit_phase(
+        self,
+        mock_get_images,
+        mock_wait,
+        mock_head,
+        mock_import_image,
+        mock_set_properties,
+    ):
+        """the submit phase of --two-phase does not wait for existing images"""
+        mock_head.return_value = mock.Mock(
+            status_code=200, history=[], headers={}, url=self.fake_url
+        )
+        self.fake_image.status = "queued"
+        self.fake_image.name = self.fake_name
+        mock_get_images.return_value = main.ImageCatalog([self.fake_image])
+        self.sot.CONF.latest = False
+
+        self.sot._submitting = True
+        self.sot.process_image(
+            self.fake_image_dict,
+            self.versions,
+            self.sorted_versions,
+            self.fake_image_dict["meta"],
+        )
+        mock_wait.assert_not_called()
+
+        self.sot._submitting = False
+        self.sot.process_image(
+            self.fake_image_dict,
+            self.versions,
+            self.sorted_versions,
+            self.fake_image_dict["meta"],
+        )
+        mock_wait.assert_called_once_with(self.fake_image)
+
+    @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
+    @mock.patch("openstack_image_manager.main.ImageManager.import_image")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
     @mock.patch("openstack_image_manager.main.ImageManager.get_images")
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
@@ -602,7 +1695,9 @@ class TestManage(TestCase):
     ):
         """test main.ImageManager.process_image()"""
 
-        mock_requests.return_value.status_code = 200
+        mock_requests.return_value = mock.Mock(
+            status_code=200, history=[], headers={}, url=self.fake_url
+        )
         meta = self.fake_image_dict["meta"]
 
         result = self.sot.process_image(
@@ -610,7 +1705,12 @@ class TestManage(TestCase):
         )
 
         self.assertEqual(mock_get_images.call_count, 2)
-        mock_requests.assert_called_once_with(self.fake_url)
+        mock_requests.assert_called_once_with(
+            self.fake_url,
+            allow_redirects=True,
+            timeout=main.REQUESTS_TIMEOUT,
+            headers={},
+        )
         mock_import_image.assert_called_once_with(
             self.fake_image_dict,
             self.fake_name,
@@ -667,14 +1767,19 @@ class TestManage(TestCase):
         )
 
         mock_get_images.assert_called_once()
-        mock_requests.assert_called_once_with(self.fake_url)
+        mock_requests.assert_called_once_with(
+            self.fake_url,
+            allow_redirects=True,
+            timeout=main.REQUESTS_TIMEOUT,
+            headers={},
+        )
         mock_import_image.assert_not_called()
         mock_set_properties.assert_not_called()
         self.assertEqual(result, ({self.fake_image_dict["name"]}, None, None))
 
     @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
     @mock.patch("openstack_image_manager.main.ImageManager.import_image")
-    @mock.patch("openstack_image_manager.main.requests.head")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
     @mock.patch("openstack_image_manager.main.ImageManager.get_images")
     def test_process_image_separator(
         self,
@@ -683,7 +1788,9 @@ class TestManage(TestCase):
         mock_import_image,
         mock_set_properties,
     ):
-        mock_requests.return_value.status_code = 200
+        mock_requests.return_value = mock.Mock(
+            status_code=200, history=[], headers={}, url=self.fake_url
+        )
         meta = self.fake_image_dict["meta"]
         self.fake_image_dict["separator"] = "-"
         self.fake_image_dict["multi"] = False
@@ -696,7 +1803,7 @@ class TestManage(TestCase):
 
     @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
     @mock.patch("openstack_image_manager.main.ImageManager.import_image")
-    @mock.patch("openstack_image_manager.main.requests.head")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
     @mock.patch("openstack_image_manager.main.ImageManager.get_images")
     def test_process_image_separator_multi(
         self,
@@ -705,11 +1812,12 @@ class TestManage(TestCase):
         mock_import_image,
         mock_set_properties,
     ):
-        mock_old_image = mock.MagicMock()
-        mock_old_image.status = "active"
-        mock_get_images.return_value = {"Ubuntu 20.04": mock_old_image}
+        mock_old_image = Image(**copy.deepcopy(FAKE_IMAGE_DATA))
+        mock_get_images.return_value = main.ImageCatalog([mock_old_image])
 
-        mock_requests.return_value.status_code = 200
+        mock_requests.return_value = mock.Mock(
+            status_code=200, history=[], headers={}, url=self.fake_url
+        )
         meta = self.fake_image_dict["meta"]
         self.fake_image_dict["separator"] = "-"
         self.fake_image_dict["multi"] = True
@@ -771,11 +1879,60 @@ class TestManage(TestCase):
         )
 
         mock_get_images.assert_called_once()
-        mock_update_image.assert_called()
-        mock_add_tag.assert_called_once_with(self.fake_image.id, "my_tag")
-        mock_remove_tag.assert_called_once_with(self.fake_image.id, "fake_tag")
+        # attributes, properties and tags are changed with a single update
+        mock_update_image.assert_called_once()
+        args, kwargs = mock_update_image.call_args
+        self.assertEqual(args[0], self.fake_image.id)
+        self.assertEqual(kwargs["tags"], ["my_tag"])
+        self.assertEqual(kwargs["image_build_date"], "2021-01-21")
+        mock_add_tag.assert_not_called()
+        mock_remove_tag.assert_not_called()
         mock_deactivate.assert_called_once_with(self.fake_image.id)
 
+        # an image in the desired state is not updated at all
+        mock_update_image.reset_mock()
+        data = copy.deepcopy(FAKE_IMAGE_DATA)
+        for key, value in kwargs.items():
+            if key in Image._body_mapping():
+                data[key] = value
+            else:
+                data["properties"][key] = value
+        cloud_image = Image(**data)
+        mock_get_images.return_value = {self.fake_name: cloud_image}
+        self.sot.set_properties(
+            self.fake_image_dict, self.fake_name, self.versions, "1", "", meta
+        )
+        mock_update_image.assert_not_called()
+
+        # a matching fingerprint skips all checks
+        fingerprint = kwargs[main.FINGERPRINT_PROPERTY]
+        data = copy.deepcopy(FAKE_IMAGE_DATA)
+        data["properties"][main.FINGERPRINT_PROPERTY] = fingerprint
+        mock_get_images.return_value = {self.fake_name: Image(**data)}
+        self.sot.set_properties(
+            self.fake_image_dict, self.fake_name, self.versions, "1", "", meta
+        )
+        mock_update_image.assert_not_called()
+
+        # a changed definition is checked and gets a new fingerprint
+        self.fake_image_dict["tags"] = ["other_tag"]
+        self.sot.set_properties(
+            self.fake_image_dict, self.fake_name, self.versions, "1", "", meta
+        )
+        mock_update_image.assert_called_once()
+        kwargs = mock_update_image.call_args[1]
+        self.assertEqual(kwargs["tags"], ["other_tag"])
+        self.assertNotEqual(kwargs[main.FINGERPRINT_PROPERTY], fingerprint)
+
+        # the fingerprint is not written when the status change fails
+        mock_update_image.reset_mock()
+        mock_deactivate.side_effect = RuntimeError("forbidden")
+        with self.assertRaises(RuntimeError):
+            self.sot.set_properties(
+                self.fake_image_dict, self.fake_name, self.versions, "1", "", meta
+            )
+        mock_update_image.assert_not_called()
+
     @mock.patch(
         "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.update_image"
     )
@@ -906,7 +2063,7 @@ class TestManage(TestCase):
         """test main.ImageManager.manage_outdated_images"""
 
         managed_images = {"some_image_name"}
-        mock_get_images.return_value = {self.fake_image.name: self.fake_image}
+        mock_get_images.return_value = main.ImageCatalog([self.fake_image])
 
         self.sot.manage_outdated_images(managed_images)
         mock_get_images.assert_called_once()
@@ -936,7 +2093,16 @@ class TestManage(TestCase):
         """test main.ImageManager.manage_outdated_images in delete conditions"""
 
         managed_images = {"some_image_name"}
-        mock_get_images.return_value = {self.fake_image.name + "_2": self.fake_image}
+        mock_get_images.return_value = main.ImageCatalog(
+            [
+                Image(
+                    **dict(
+                        copy.deepcopy(FAKE_IMAGE_DATA),
+                        name=self.fake_image.name + "_2",
+                    )
+                )
+            ]
+        )
         mock_read_image_files.return_value = [self.fake_image_dict]
 
         self.sot.CONF.delete = True
@@ -962,6 +2128,135 @@ class TestManage(TestCase):
         mock_update_image.assert_called_once()
         mock_delete_image.assert_not_called()
 
+    @mock.patch("openstack_image_manager.main.ImageManager.read_image_files")
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.delete_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.update_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.deactivate_image"
+    )
+    @mock.patch("openstack_image_manager.main.ImageManager.get_images")
+    def test_manage_outdated_images_dry_run(
+        self,
+        mock_get_images,
+        mock_deactivate,
+        mock_update_image,
+        mock_delete_image,
+        mock_read_image_files,
+    ):
+        """a dry run plans the cleanup instead of applying it"""
+        mock_get_images.return_value = main.ImageCatalog(
+            [Image(**dict(copy.deepcopy(FAKE_IMAGE_DATA), name="outdated"))]
+        )
+        mock_read_image_files.return_value = [self.fake_image_dict]
+        self.sot.CONF.delete = True
+        self.sot.CONF.yes_i_really_know_what_i_do = True
+        self.sot.CONF.dry_run = True
+
+        self.sot.manage_outdated_images({"some_image_name"})
+        mock_deactivate.assert_not_called()
+        mock_update_image.assert_not_called()
+        mock_delete_image.assert_not_called()
+        actions = self.sot._plan.actions
+        self.assertEqual(
+            [(x.kind, x.image_id, x.params, x.after) for x in actions],
+            [
+                ("deactivate", self.fake_image.id, {}, []),
+                ("update", self.fake_image.id, {"visibility": "community"}, [0]),
+                ("delete", self.fake_image.id, {}, [0, 1]),
+            ],
+        )
+
+    def test_plan(self):
+        plan = main.Plan("cloud")
+        plan.add("import", None, "a (2)", {"definition": "a", "urls": ["http://x/a"]})
+        plan.add("update", "id1", "a", {"name": "a (1)"})
+        plan.add("update", "id2", "b", {"visibility": "community"})
+        plan.add("delete", "id2", "b")
+        plan.add("update", "id3", "c", {"name": "c (1)"})
+        self.assertEqual(
+            [x.after for x in plan.actions], [[], [0], [0], [0, 2], [0, 1]]
+        )
+        self.assertRaises(ValueError, plan.add, "explode", "id1", "a")
+        # the versions of a definition are imported by one action
+        plan.add("import", None, "a (3)", {"definition": "a", "urls": ["http://x/b"]})
+        self.assertEqual(len(plan.actions), 5)
+        self.assertEqual(plan.actions[0].params["urls"], ["http://x/a", "http://x/b"])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            plan.save(os.path.join(tmp, "plan.json"))
+            loaded = main.Plan.load(os.path.join(tmp, "plan.json"))
+        self.assertEqual(loaded.cloud, "cloud")
+        self.assertEqual(
+            [x.to_dict() for x in loaded.actions], [x.to_dict() for x in plan.actions]
+        )
+
+        # a failed action skips the actions that depend on it
+        applied = []
+
+        def execute(action):
+            if action.image_id == "id2":
+                raise RuntimeError("boom")
+            applied.append(str(action))
+
+        self.assertFalse(loaded.apply(execute, 4))
+        self.assertEqual(
+            sorted(applied),
+            [
+                "import 'a (2)': definition='a', urls=['http://x/a', 'http://x/b']",
+                "update 'a' (id1): name='a (1)'",
+                "update 'c' (id3): name='c (1)'",
+            ],
+        )
+        applied.clear()
+        loaded.actions = loaded.actions[:2]
+        self.assertTrue(loaded.apply(execute, 4))
+        self.assertEqual(len(applied), 2)
+
+    @mock.patch("openstack_image_manager.main.ImageManager._process_definition")
+    @mock.patch("openstack_image_manager.main.ImageManager.read_image_files")
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.update_image"
+    )
+    def test_apply_plan(self, mock_update_image, mock_read_image_files, mock_process):
+        mock_read_image_files.return_value = [self.fake_image_dict]
+        plan = main.Plan("cloud")
+        plan.add("import", None, "x", {"definition": self.fake_image_dict["name"]})
+        plan.add("update", "id1", "old", {"visibility": "community"})
+
+        with mock.patch.object(self.sot, "finish_replications") as mock_finish:
+            self.sot.apply_plan(plan)
+        mock_finish.assert_called_once()
+        mock_process.assert_called_once_with(self.fake_image_dict)
+        mock_update_image.assert_called_once_with("id1", visibility="community")
+        self.assertFalse(self.sot.exit_with_error)
+
+        # an unknown definition fails the import and skips the cleanup
+        mock_update_image.reset_mock()
+        plan.actions[0].params["definition"] = "unknown"
+        self.sot.apply_plan(plan)
+        mock_update_image.assert_not_called()
+        self.assertTrue(self.sot.exit_with_error)
+
+        # an earlier error does not fail the imports that follow
+        mock_process.reset_mock()
+        plan.actions[0].params["definition"] = self.fake_image_dict["name"]
+        self.sot.apply_plan(plan)
+        mock_process.assert_called_once()
+        mock_update_image.assert_called_once_with("id1", visibility="community")
+
+        # an import is failed by the errors of its own definition
+        def process(definition):
+            self.sot.exit_with_error = True
+
+        mock_update_image.reset_mock()
+        mock_process.side_effect = process
+        self.sot.apply_plan(plan)
+        mock_update_image.assert_not_called()
+
     @mock.patch("openstack_image_manager.main.ImageManager.unshare_image_with_project")
     @mock.patch("openstack_image_manager.main.ImageManager.share_image_with_project")
     @mock.patch("openstack_image_manager.main.ImageManager.validate_yaml_schema")
@@ -1066,6 +2361,30 @@ class TestManage(TestCase):
         mock_share_image.assert_not_called()
         mock_unshare_image.assert_not_called()
 
+    @mock.patch("openstack_image_manager.main.openstack.connect")
+    def test_main_share_dry_run(self, mock_connect):
+        """a dry run of --share-image writes its plan"""
+        conn = mock_connect.return_value
+        conn.image.find_member.return_value = None
+        conn.get_image.return_value = Munch(id="image-id", name="image")
+        conn.get_project.return_value = Munch(
+            id="project-id", name="project", domain_id="default"
+        )
+        self.sot.CONF.update(
+            share_image="image",
+            share_type="project",
+            share_action="add",
+            share_domain="default",
+            share_target="project",
+            dry_run=True,
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sot.CONF.plan_file = os.path.join(tmp, "plan.json")
+            self.sot.main()
+            plan = main.Plan.load(self.sot.CONF.plan_file)
+        self.assertEqual([x.kind for x in plan.actions], ["share"])
+        conn.image.add_member.assert_not_called()
+
     def test_validate_images(self):
         """Validate the image definitions in this repo against the schema"""
         self.sot.CONF.check_only = True
@@ -1084,9 +2403,12 @@ class TestManage(TestCase):
         result = self.sot.read_image_files()
         self.assertEqual(result, [self.fake_image_dict])
 
+    @mock.patch("openstack_image_manager.main.ImageManager.preflight")
     @mock.patch("openstack_image_manager.main.ImageManager.rename_images")
     @mock.patch("openstack_image_manager.main.ImageManager.process_image")
-    def test_process_images(self, mock_process_image, mock_rename_images):
+    def test_process_images(
+        self, mock_process_image, mock_rename_images, mock_preflight
+    ):
         """test main.ImageManager.process_images()"""
         meta = self.fake_image_dict["meta"]
         self.fake_image_dict["tags"] = [
@@ -1115,6 +2437,265 @@ class TestManage(TestCase):
         self.assertEqual(
             self.fake_image_dict["meta"]["image_name"], self.fake_image_dict["name"]
         )
+        mock_preflight.assert_called_once_with([self.fake_image_dict])
+
+    @mock.patch("openstack_image_manager.main.ImageManager.preflight")
+    @mock.patch("openstack_image_manager.main.ImageManager.rename_images")
+    @mock.patch("openstack_image_manager.main.ImageManager.process_image")
+    def test_process_images_parallel(
+        self, mock_process_image, mock_rename_images, mock_preflight
+    ):
+        """test main.ImageManager.process_images() with --parallel"""
+        self.sot.CONF.parallel = 4
+        images = []
+        for name in ("Ubuntu 20.04", "Debian 12", "Rocky 9"):
+            image = copy.deepcopy(self.fake_image_dict)
+            image["name"] = name
+            images.append(image)
+
+        def process_image(image, versions, sorted_versions, meta):
+            if image["name"] == "Debian 12":
+                self.sot.exit_with_error = True
+                return set(), None, None
+            return {image["name"]}, self.imported_image, self.previous_image
+
+        mock_process_image.side_effect = process_image
+
+        result = self.sot.process_images(images)
+
+        self.assertEqual(result, {"Ubuntu 20.04", "Rocky 9"})
+        self.assertEqual(mock_process_image.call_count, 3)
+        self.assertEqual(mock_rename_images.call_count, 2)
+        self.assertTrue(self.sot.exit_with_error)
+
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
+    def test_url_metadata_cache(self, mock_head):
+        """one probe per URL and run, revalidated in later runs"""
+        redirect = mock.Mock(status_code=302)
+        mock_head.return_value = mock.Mock(
+            status_code=200,
+            history=[redirect],
+            url="http://mirror/y",
+            headers={"Content-Length": "42", "ETag": '"abc"'},
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "url-metadata.json")
+            self.sot._url_cache = main.UrlMetadataCache(path)
+            self.sot._upstream = main.UpstreamMemo()
+            meta = self.sot._probe("http://x/y")
+            self.assertEqual(
+                (meta.status, meta.final_url, meta.size), (302, "http://mirror/y", 42)
+            )
+            self.assertEqual(self.sot._upstream_etag("http://x/y"), '"abc"')
+            self.assertTrue(self.sot._has_space_for_download("http://x/y", tmp))
+            mock_head.assert_called_once_with(
+                "http://x/y",
+                allow_redirects=True,
+                timeout=main.REQUESTS_TIMEOUT,
+                headers={},
+            )
+            self.sot._url_cache.save()
+
+            # the next run revalidates with a conditional request
+            mock_head.reset_mock()
+            mock_head.return_value = mock.Mock(status_code=304, history=[])
+            self.sot._url_cache = main.UrlMetadataCache(path)
+            self.sot._upstream = main.UpstreamMemo()
+            self.assertEqual(self.sot._probe("http://x/y").size, 42)
+            self.assertEqual(
+                mock_head.call_args.kwargs["headers"], {"If-None-Match": '"abc"'}
+            )
+
+            # within the ttl no request is sent at all
+            mock_head.reset_mock()
+            self.sot._url_cache = main.UrlMetadataCache(path, ttl=3600)
+            self.sot._upstream = main.UpstreamMemo()
+            self.assertEqual(self.sot._probe("http://x/y").status, 302)
+            mock_head.assert_not_called()
+
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
+    @mock.patch("openstack_image_manager.main.ImageManager.get_images")
+    def test_preflight(self, mock_get_images, mock_head):
+        """missing versions are probed once, up front"""
+        mock_get_images.return_value = main.ImageCatalog([self.fake_image])
+        image = copy.deepcopy(self.fake_image_dict)
+        # versions are imported in natural order, not in definition order
+        image["versions"] = [
+            {"version": "2", "url": "file:///images/2.img"},
+            {"version": "0", "url": "http://x/0.img"},
+            {"version": "1", "url": "http://x/1.img", "mirror_url": "http://m/1.img"},
+        ]
+        other = copy.deepcopy(self.fake_image_dict)
+        other["name"] = "Other"
+        other["multi"] = False
+        other["versions"] = [{"version": "1", "url": "http://x/other.img"}]
+
+        def head(url, **kwargs):
+            status = 404 if "other" in url else 200
+            return mock.Mock(status_code=status, history=[], headers={}, url=url)
+
+        mock_head.side_effect = head
+        # with --latest only the last version of a multi image is imported
+        self.assertEqual(
+            self.sot._preflight_urls([image, other]), ["http://x/other.img"]
+        )
+        self.sot.CONF.latest = False
+        self.assertEqual(
+            self.sot._preflight_urls([image, other]),
+            ["http://x/0.img", "http://m/1.img", "http://x/other.img"],
+        )
+        self.sot.preflight([image, other])
+        self.assertEqual(mock_head.call_count, 3)
+
+        # process_image() uses the results of the preflight
+        self.assertEqual(self.sot._probe("http://x/other.img").status, 404)
+        self.assertEqual(mock_head.call_count, 3)
+
+        # the latest version of a multi image that is up to date is skipped
+        image["versions"] = [{"version": "0", "url": "http://x/0.img"}]
+        self.fake_image.properties["internal_version"] = "0"
+        self.assertEqual(self.sot._preflight_urls([image]), [])
+
+    @mock.patch.object(main.ImportWatcher, "TICK", 0.01)
+    @mock.patch("openstack_image_manager.main.ImageManager.rename_images")
+    @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.delete_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.import_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image"
+    )
+    def test_process_images_two_phase(
+        self,
+        mock_create,
+        mock_import,
+        mock_delete,
+        mock_images,
+        mock_head,
+        mock_set_properties,
+        mock_rename_images,
+    ):
+        """test main.ImageManager.process_images() with --two-phase"""
+        self.sot.CONF.two_phase = True
+        self.sot._cloud_images = main.ImageCatalog()
+        mock_head.return_value = mock.Mock(
+            status_code=200, history=[], headers={}, url="http://x"
+        )
+        images = []
+        for name in ("Ubuntu 20.04", "Debian 12"):
+            image = copy.deepcopy(self.fake_image_dict)
+            image["name"] = name
+            images.append(image)
+
+        created = {}
+
+        def create_image(**properties):
+            image = Image(id=str(len(created)), status="queued", **properties)
+            created[image.id] = image
+            return image
+
+        def list_images(**query):
+            result = []
+            for id in query["id"][3:].split(","):
+                # the first import of Debian fails on the Glance side
+                created[id].status = "killed" if id == "1" else "active"
+                result.append(created[id])
+            return result
+
+        mock_create.side_effect = create_image
+        mock_images.side_effect = list_images
+
+        result = self.sot.process_images(images)
+
+        self.assertEqual(result, {"Ubuntu 20.04", "Debian 12"})
+        self.assertEqual(mock_create.call_count, 3)
+        # both imports are submitted before any of them is collected
+        self.assertEqual(mock_import.call_args_list[1].args[0].id, "1")
+        mock_delete.assert_called_once_with(created["1"])
+        self.assertEqual(mock_set_properties.call_count, 2)
+        self.assertEqual(mock_rename_images.call_count, 2)
+        self.assertEqual(
+            sorted(self.sot.get_images()), ["Debian 12 (1)", "Ubuntu 20.04 (1)"]
+        )
+        self.assertFalse(self.sot.exit_with_error)
+        self.assertEqual(self.sot._submitted, {})
+
+    @mock.patch.object(main.ImportWatcher, "TICK", 0.01)
+    @mock.patch("openstack_image_manager.main.ImageManager.rename_images")
+    @mock.patch("openstack_image_manager.main.ImageManager.set_properties")
+    @mock.patch("openstack_image_manager.main.ImageManager._download")
+    @mock.patch("openstack_image_manager.main.requests.Session.head")
+    @mock.patch("openstack_image_manager.main.openstack.image.v2._proxy.Proxy.images")
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.stage_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.import_image"
+    )
+    @mock.patch(
+        "openstack_image_manager.main.openstack.image.v2._proxy.Proxy.create_image"
+    )
+    def test_process_images_two_phase_prefetch(
+        self,
+        mock_create,
+        mock_import,
+        mock_stage,
+        mock_images,
+        mock_head,
+        mock_download,
+        mock_set_properties,
+        mock_rename_images,
+    ):
+        """test main.ImageManager.process_images() with --two-phase --prefetch always"""
+        self.sot.CONF.two_phase = True
+        self.sot.CONF.prefetch = "always"
+        self.sot._cloud_images = main.ImageCatalog()
+        mock_head.return_value = mock.Mock(
+            status_code=200, history=[], headers={}, url="http://x"
+        )
+        images = []
+        for name in ("Ubuntu 20.04", "Debian 12"):
+            image = copy.deepcopy(self.fake_image_dict)
+            image["name"] = name
+            images.append(image)
+
+        def download(url, dest, checksum=None, timeout=None):
+            with open(dest, "w") as fp:
+                fp.write("image")
+            return True
+
+        created = {}
+
+        def create_image(**properties):
+            image = Image(id=str(len(created)), status="queued", **properties)
+            created[image.id] = image
+            return image
+
+        def list_images(**query):
+            for id in query["id"][3:].split(","):
+                created[id].status = "active"
+            return [created[x] for x in query["id"][3:].split(",")]
+
+        mock_download.side_effect = download
+        mock_create.side_effect = create_image
+        mock_images.side_effect = list_images
+
+        result = self.sot.process_images(images)
+
+        self.assertEqual(result, {"Ubuntu 20.04", "Debian 12"})
+        self.assertEqual(mock_download.call_count, 2)
+        self.assertEqual(mock_stage.call_count, 2)
+        for call in mock_import.call_args_list:
+            self.assertEqual(call.kwargs, {"method": "glance-direct"})
+        self.assertEqual(mock_set_properties.call_count, 2)
+        self.assertFalse(self.sot.exit_with_error)
+        self.assertIsNone(self.sot._pipeline)
+        self.assertIsNotNone(self.sot._import_history.predict("prefetch", 5))
 
     def test_is_checksum(self):
         """test main.ImageManager.is_checksum()"""
@@ -1131,7 +2712,7 @@ class TestManage(TestCase):
         self.assertFalse(self.sot.is_checksum(f"{SHA256}  image.qcow2"))
         self.assertFalse(self.sot.is_checksum(""))
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksum_url(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksum_url()"""
         mock_get.return_value = mock.Mock(text=f"{SHA512}\n")
@@ -1139,9 +2720,11 @@ class TestManage(TestCase):
         result = self.sot.get_checksum_from_checksum_url(self.fake_checksum_url)
 
         self.assertEqual(result, SHA512)
-        mock_get.assert_called_once_with(self.fake_checksum_url, timeout=mock.ANY)
+        mock_get.assert_called_once_with(
+            self.fake_checksum_url, timeout=mock.ANY, headers={}
+        )
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksum_url_invalid_content(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksum_url() with junk"""
         mock_get.return_value = mock.Mock(text="<html>not a checksum</html>")
@@ -1150,7 +2733,7 @@ class TestManage(TestCase):
 
         self.assertEqual(result, "")
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksum_url_http_error(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksum_url() with an
         HTTP error status whose body looks like a valid checksum"""
@@ -1165,7 +2748,7 @@ class TestManage(TestCase):
 
         self.assertEqual(result, "")
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksum_url_request_exception(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksum_url() with a
         connection failure"""
@@ -1175,7 +2758,7 @@ class TestManage(TestCase):
 
         self.assertEqual(result, "")
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksums_url(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksums_url()"""
         checksums_file = f"{SHA256} *other.qcow2\n{SHA512} *image.qcow2\n"
@@ -1186,9 +2769,111 @@ class TestManage(TestCase):
         )
 
         self.assertEqual(result, SHA512)
-        mock_get.assert_called_once_with(self.fake_checksums_url, timeout=mock.ANY)
+        mock_get.assert_called_once_with(
+            self.fake_checksums_url, timeout=mock.ANY, headers={}
+        )
+
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
+    def test_checksum_file_cache(self, mock_get):
+        """unchanged checksum files are not downloaded again in later runs"""
+        mock_get.return_value = mock.Mock(
+            status_code=200,
+            text=f"{SHA512}  image.qcow2\n",
+            headers={"ETag": '"v1"', "Last-Modified": "Mon, 02 Jan 2023 00:00:00 GMT"},
+        )
+        url = "https://url.com/image.qcow2"
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "checksum-files.json")
+            self.sot._checksum_cache = main.ChecksumFileCache(path)
+            self.assertEqual(
+                self.sot.get_checksum_from_checksums_url(url, self.fake_checksums_url),
+                SHA512,
+            )
+            self.sot._checksum_cache.save()
+
+            mock_get.reset_mock()
+            mock_get.return_value = mock.Mock(status_code=304, text="")
+            self.sot._checksum_cache = main.ChecksumFileCache(path)
+            self.assertEqual(
+                self.sot.get_checksum_from_checksums_url(url, self.fake_checksums_url),
+                SHA512,
+            )
+            mock_get.assert_called_once_with(
+                self.fake_checksums_url,
+                timeout=mock.ANY,
+                headers={"If-None-Match": '"v1"'},
+            )
+
+            # a changed file replaces the cached result
+            mock_get.return_value = mock.Mock(
+                status_code=200,
+                text=f"{SHA256}  image.qcow2\n",
+                headers={"ETag": '"v2"'},
+            )
+            self.assertEqual(
+                self.sot.get_checksum_from_checksums_url(url, self.fake_checksums_url),
+                SHA256,
+            )
+            self.assertEqual(
+                self.sot._checksum_cache.get(self.fake_checksums_url)["etag"], '"v2"'
+            )
+
+    def test_parse_checksums_file(self):
+        """GNU, BSD and binary-mode lines are indexed by their exact filename"""
+        checksums_file = (
+            "-----BEGIN PGP SIGNED MESSAGE-----\n"
+            "Hash: SHA256\n"
+            f"{SHA256}  image.qcow2.manifest\n"
+            f"{SHA1} *image.qcow2\n"
+            f"{MD5}\timage.vmdk\n"
+            f"SHA512 (images/other.raw) = {SHA512}\n"
+            f"# {MD5}  comment\n"
+        )
+        self.assertEqual(
+            main.parse_checksums_file(checksums_file),
+            {
+                "image.qcow2.manifest": ("sha256", SHA256),
+                "image.qcow2": ("sha1", SHA1),
+                "image.vmdk": ("md5", MD5),
+                "images/other.raw": ("sha512", SHA512),
+                "other.raw": ("sha512", SHA512),
+            },
+        )
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
+    def test_get_checksum_from_checksums_url_memoized(self, mock_get):
+        """a checksums file is fetched once for all images listed in it"""
+        mock_get.return_value = mock.Mock(
+            text=f"{SHA256}  other.qcow2\n{SHA512}  image.qcow2\n"
+        )
+        self.sot._upstream = main.UpstreamMemo()
+        for filename, checksum in (("image.qcow2", SHA512), ("other.qcow2", SHA256)):
+            self.assertEqual(
+                self.sot.get_checksum_from_checksums_url(
+                    f"https://url.com/{filename}", self.fake_checksums_url
+                ),
+                checksum,
+            )
+        # no substring matches
+        self.assertEqual(
+            self.sot.get_checksum_from_checksums_url(
+                "https://url.com/image.qcow", self.fake_checksums_url
+            ),
+            "",
+        )
+        mock_get.assert_called_once()
+
+        # the same holds for a checksum file with a single digest
+        mock_get.reset_mock()
+        mock_get.return_value = mock.Mock(text=f"{SHA256}\n")
+        for _ in range(2):
+            self.assertEqual(
+                self.sot.get_checksum_from_checksum_url("https://url.com/sum"),
+                SHA256,
+            )
+        mock_get.assert_called_once()
+
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksums_url_http_error(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksums_url() with an
         HTTP error status whose body looks like a valid checksums file"""
@@ -1205,7 +2890,7 @@ class TestManage(TestCase):
 
         self.assertEqual(result, "")
 
-    @mock.patch("openstack_image_manager.main.requests.get")
+    @mock.patch("openstack_image_manager.main.requests.Session.get")
     def test_get_checksum_from_checksums_url_request_exception(self, mock_get):
         """test main.ImageManager.get_checksum_from_checksums_url() with a
         connection failure"""
@@ -1273,6 +2958,81 @@ class TestManage(TestCase):
         mock_process_images.assert_called_once_with([self.fake_image_dict])
         mock_manage_outdated.assert_not_called()
 
+    @mock.patch("openstack_image_manager.main.openstack.config.loader.OpenStackConfig")
+    def test_resolve_clouds(self, mock_config):
+        """--cloud names a cloud, a list of clouds or a group of clouds"""
+        mock_config.return_value.cloud_config = {
+            "clouds": {"fake-cloud": {}, "region-1": {}, "region-2": {}},
+            "groups": {"regions": ["region-1", "region-2"], "fake-cloud": ["x"]},
+        }
+        for cloud, expected in (
+            ("fake-cloud", ["fake-cloud"]),
+            ("region-1, region-2", ["region-1", "region-2"]),
+            ("regions", ["region-1", "region-2"]),
+        ):
+            with self.subTest(cloud=cloud):
+                self.sot.CONF.cloud = cloud
+                self.assertEqual(self.sot.resolve_clouds(), expected)
+
+    @mock.patch("openstack_image_manager.main.ImageManager.manage", autospec=True)
+    @mock.patch("openstack_image_manager.main.openstack.connect")
+    def test_manage_clouds(self, mock_connect, mock_manage):
+        """every cloud is managed by its own manager sharing the upstream state"""
+        managers = {}
+
+        def manage(manager):
+            managers[manager.CONF.cloud] = manager
+            if manager.CONF.cloud == "region-2":
+                manager.exit_with_error = True
+
+        mock_manage.side_effect = manage
+
+        with mock.patch(
+            "openstack_image_manager.main.shutil.disk_usage",
+            return_value=mock.Mock(free=10 * 2**30),
+        ):
+            self.sot.manage_clouds(["region-1", "region-2"])
+
+        self.assertEqual(
+            sorted(x.kwargs["cloud"] for x in mock_connect.call_args_list),
+            ["region-1", "region-2"],
+        )
+        self.assertEqual(self.sot.CONF.cloud, "fake-cloud")
+        for manager in managers.values():
+            self.assertIs(manager._upstream, self.sot._upstream)
+            self.assertIs(manager._prefetch_cache, self.sot._prefetch_cache)
+            self.assertIs(manager._upstream_sizes, self.sot._upstream_sizes)
+        self.assertTrue(self.sot.exit_with_error)
+        # the temporary cache keeps half of the free space free
+        self.assertEqual(self.sot._prefetch_cache.budget, 5 * 2**30)
+
+    def test_upstream_memo(self):
+        """concurrent lookups of one key run once"""
+        memo = main.UpstreamMemo()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def lookup():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "result"
+
+        first = threading.Thread(target=memo.get, args=(("head", "url"), lookup))
+        first.start()
+        started.wait(5)
+        second = main.concurrent.futures.ThreadPoolExecutor(1).submit(
+            memo.get, ("head", "url"), lookup
+        )
+        release.set()
+        first.join()
+        self.assertEqual(second.result(timeout=5), "result")
+        self.assertEqual(len(calls), 1)
+
+        with self.assertRaises(ValueError):
+            memo.get(("checksum", "url"), mock.Mock(side_effect=ValueError))
+
     def test_schema_url_fields_reject_ftp(self):
         """the checksum URL fields must only accept URLs that
         requests.get() can actually fetch (no FTP adapter)"""